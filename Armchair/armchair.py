@@ -1,30 +1,52 @@
 from bidict import bidict
-from datetime import datetime
 import os
-import dill
 import functools
+import time
+import zlib
+from Armchair.codec import PackCodec
+from Armchair.logger import ArmchairLog, NullArmchairLog
+from Armchair.metrics import ArmchairMetrics, NullArmchairMetrics
+from Armchair.recorder import SessionRecorder, NullSessionRecorder, SENT, RECIEVED
+from Armchair.transport import Transport, SocketTransport
 
 #used for armchair file transfer initialized from armchair instructions
 
 class Armchair():
     '''
-    This class facilitates all Armchair interactions over socket. Detailed documentation on the
+    This class facilitates all Armchair interactions over a Transport (usually a socket, but an
+    in memory pipe may be used for simulations. see transport.py). Detailed documentation on the
     protocol can be found in acompanying armchair_specs.txt
-    The class maintains a buffer of packets in a conversation, and if the buffer is full, it will
-    block until the buffer is emptied. Note however that this abstraction is broken in the case
+    The class maintains a sliding window of packets in a conversation, and if the window is full,
+    it will block until the reciever acknowledges enough packets to make room. Acks are
+    cumulative: a ready for cid n acknowledges every inflight packet with cid <= n. Note however that this abstraction is broken in the case
     of GHOST packets, which are sent without waiting for a ready response and without changing the
     cid  
     ATTRIBUTES:  
-        socket sock: a connected socket  
-        int buffsize: this is the number of allowed inflight packets (i.e. the number of packets
-          to send to the reciever before waiting for a ready response)  
+        Transport sock: the transport of the conversation  
+        int buffsize: this is the maximum number of allowed inflight packets (i.e. the number of
+          packets to send to the reciever before waiting for a ready response)  
+        bool adaptive: if True, the window also shrinks to hold only about lead_time seconds of
+          work on the reciever (but never fewer than min_buffsize packets). The work of each
+          packet is estimated from how long the reciever took to ack packets of the same type
+          (or the pause time for pauses). If False, the window is always buffsize packets  
+        int min_buffsize: the adaptive window never shrinks below this many packets  
+        float lead_time: the number of seconds of work the adaptive window tries to keep queued
+          on the reciever  
         int cid: the current command id. This is a constantly increasing number. It is used to 
           communicate between Armchair objects about where the other end is in terms of processing
           packages.  
         str name: the name of this armchair object. Used for loging purposes  
-        str log_path: the path to the log file for this Armchair  
-        int state: the state of the robot. 0 is good. 1 is bad
+        str log_path: the path to the directory of the log file for this Armchair  
+        NullArmchairLog log: the log of this conversation. An ArmchairLog unless logging was
+          turned off, in which case nothing is recorded  
+        int state: the state of the robot. 0 is good. 1 is bad  
+        PackCodec codec: encodes and decodes packet payloads. See codec.py  
+        NullArmchairMetrics metrics: timings and sizes of every packet. An ArmchairMetrics
+          unless metrics were turned off. Dumped to log_path and summarized on close  
+        NullSessionRecorder recorder: records every packet and ftp byte to a session file if
+          a record_path was given. See recorder.py  
     CONSTANTS:  
+        int FTP_CHUNK_SIZE: the size of the buffer used to stream files during ftp  
         bidict PACK_TYPES: this is a key for translating between byte codes and string labels
           for different packet types  
         GHOST_TYPES: this is a list of all str types that classify as GHOST packets. i.e. they do
@@ -39,31 +61,85 @@ class Armchair():
         send_pack(pack_type, *args) int: returns the cid it sent. This is used to send a packet 
           of pack_type with args.  
         burn_pipe() void: This command waits until the pipe is clear  
+        recv_ftp(str dst_path) tuple<list,list>: recieves files sent with send_ftp  
+        recv_ftp_async(str dst_path, func callback) void: arranges for the next files sent to be
+          recieved whenever they arrive, without waiting for them now  
+        queued_work() float: the estimated seconds of work inflight on the reciever  
+        open_ftp_dst(str filepath, int offset) file: static. opens the local copy of a file
+          for an ftp section, or returns None if the section is a stale delta  
         close() void: terminate the connection  
     '''
 
-    FTP_EOF = 'AFKJldkjvaJKDvJDFDFGHowCouldYouEverHaveThisInAFile'.encode('ascii')
-    PACK_TYPES = bidict({'init':b'\x00','close':b'\x01','error':b'\x02','ready':b'\x03','transfer':b'\x04','init_containers':b'\x05','sending_files':b'\x06','pause':b'\x07','stop':b'\x08','continue':b'\x09','stopped':b'\x0A','loc_req':b'\x0B','loc_resp':b'\x0C','home':b'\x0D','make':b'\x0E','mix':b'\x0F','save':b'\x10'})
+    FTP_CHUNK_SIZE = 64 * 1024 #bytes read/written at a time during file transfer
+    PACK_TYPES = bidict({'init':b'\x00','close':b'\x01','error':b'\x02','ready':b'\x03','transfer':b'\x04','init_containers':b'\x05','sending_files':b'\x06','pause':b'\x07','stop':b'\x08','continue':b'\x09','stopped':b'\x0A','loc_req':b'\x0B','loc_resp':b'\x0C','home':b'\x0D','make':b'\x0E','mix':b'\x0F','save':b'\x10','batch':b'\x11'})
     GHOST_TYPES = ['continue', 'stopped', 'loc_resp','loc_req', 'save','error'] 
     #These are necessary because we never want to wait on a
     #buffer. These packs should be send as soon as possible
     #They also do not require ready's / are not added to inflight packs. Do not modify CID.
 
 
-    def __init__(self, socket, name, log_path='', buffsize=4):
+    #weight given to the newest observation in the running estimate of the service time of a
+    #pack type
+    SERVICE_TIME_SMOOTHING = 0.3
+
+    def __init__(self, socket, name, log_path='', buffsize=4, dill_fallback=False, log_enabled=True,
+            adaptive=False, min_buffsize=2, lead_time=10.0, metrics_enabled=True,
+            record_path=None):
+        '''
+        params:  
+            Transport|BufferedSocket socket: the transport to talk over. A BufferedSocket is
+              wrapped in a SocketTransport  
+            str name: the name of this armchair object. Used for logging purposes  
+            str log_path: the directory to put the log file in  
+            int buffsize: the maximum number of allowed inflight packets. Must be at least 1  
+            bool dill_fallback: if True, payloads that don't fit the schema of their packet type
+              are pickled with dill rather than raising a TypeError  
+            bool log_enabled: False turns off logging completely (e.g. for benchmark runs)  
+            bool adaptive: True to size the window by the work queued on the reciever  
+            int min_buffsize: the smallest the adaptive window may get  
+            float lead_time: seconds of work the adaptive window tries to keep queued  
+            bool metrics_enabled: False turns off recording of metrics  
+            str record_path: if given, the conversation is recorded to a session file at this
+              path for later replay (see replay.py)  
+        '''
+        if buffsize < 1:
+            raise ValueError('Armchair buffsize must be at least 1, but got {}'.format(buffsize))
         self.state = 0
         self.error_payload = None
-        self.sock = socket
+        self.sock = socket if isinstance(socket, Transport) else SocketTransport(socket)
+        self.codec = PackCodec(dill_fallback)
         self.cid = 0
         self.buffsize = buffsize
+        self.adaptive = adaptive
+        self.min_buffsize = min(min_buffsize, buffsize)
+        self.lead_time = lead_time
         self._inflight_packs = []
+        #maps cid to (list of pack_types, send time, estimated seconds of work, seconds of that
+        #work that are pauses) for inflight packs. The list has the types of the sub commands
+        #for batches
+        self._inflight_work = {}
+        #maps pack_type to running estimate of the seconds the reciever takes to process it
+        self._service_times = {}
+        self._last_ack_time = None
+        #maps filepath to the (size, crc32) of the file when it was last sent with send_ftp
+        self._ftp_shipped = {}
+        #(dst_path, callback) of each recv_ftp_async whose sending_files has not arrived, in order
+        self._pending_ftp = []
         #bidirectional dictionary for conversions from byte codes to string names for commands and back
         self.name = name
         self.log_path = log_path
-        if not os.path.exists(self.log_path):
-            os.makedirs(self.log_path)
-        with open(os.path.join(self.log_path, '{}_armchair.log'.format(self.name)), 'w') as armchair_log:
-            armchair_log.write('Armchair Log: {}, {}\n'.format(self.name, datetime.now().strftime('%H:%M:%S:%f')))
+        if log_enabled:
+            self.log = ArmchairLog(self.log_path, self.name)
+        else:
+            self.log = NullArmchairLog()
+        if metrics_enabled:
+            self.metrics = ArmchairMetrics(self.log_path, self.name)
+        else:
+            self.metrics = NullArmchairMetrics()
+        if record_path:
+            self.recorder = SessionRecorder(record_path, self.name)
+        else:
+            self.recorder = NullSessionRecorder()
 
     def state_dependent(func):
         def decorated(*args, **kwargs):
@@ -131,11 +207,16 @@ class Armchair():
         header_cid = self._get_cid(header)
         if header_len > 0: #if there were arguments
             payload = self.sock.recv_size(header_len)
-            payload = dill.loads(payload)
+            self.recorder.record_pack(RECIEVED, header, payload)
+            decode_start = time.perf_counter()
+            payload = self.codec.decode(header_type, payload)
+            decode_time = time.perf_counter() - decode_start
         else:
+            self.recorder.record_pack(RECIEVED, header, b'')
             payload = None
-        with open(os.path.join(self.log_path, '{}_armchair.log'.format(self.name)), 'a+') as armchair_log:
-                armchair_log.write("{}\trecieved {}, cid {}\n".format(datetime.now().strftime('%H:%M:%S:%f'),header_type,self.cid))
+            decode_time = 0.0
+        self.log.record('recieved', header_type, header_cid)
+        self.metrics.record_recv(header_cid, header_type, header_len, decode_time)
         if header_type == 'error':
             self._handle_error_pack(payload)
         return header_type, header_cid, payload
@@ -149,6 +230,7 @@ class Armchair():
         '''
         self.error_payload = payload
         self.state = 1
+        self.log.flush()
         raise ConnectionError('Armchair Error: error pack recieved')
 
     def reset_error(self):
@@ -158,38 +240,45 @@ class Armchair():
         Postconditions:  
             state is reset  
             error_payload is wiped  
-            inflight_packs are cleared without waiting for ready
+            inflight_packs are cleared without waiting for ready  
+            pending ftps are forgotten (the other end won't send them after an error)
         '''
         self.state = 0
         self.error_payload = None
+        self._pending_ftp = []
         self._inflight_packs = []
+        self._inflight_work = {}
+        self._last_ack_time = None
 
     def recv_pack(self):
         '''
         processes the next packet and returns None if nothing to read
         If the next packet was a ready packet it will be ignored and corresponding send will be
-        removed  
+        removed. If it was a sending_files that a recv_ftp_async is waiting on, the files are
+        recieved and it is skipped as well  
         Not state dependent because recv is state dependent
         returns:  
             str: type of packet  
             int: the cid of the recived packet  
             Obj: the argmuents/payload  
         '''
-        header_type = 'ready' #do while
-        while header_type == 'ready':
+        while True:
             header_type, header_cid, payload = self._recv()
             if header_type == 'ready':
-                self._inflight_packs.remove(payload[0])
-        return header_type, header_cid, payload
+                self._ack(payload[-1])
+            elif header_type == 'sending_files' and self._pending_ftp:
+                self._serve_pending_ftp(header_cid, payload)
+            else:
+                return header_type, header_cid, payload
         
     @state_dependent
     def send_pack(self, pack_type, *args):
         '''
-        will first check the buffer. If buffer size is exceded will wait on a ready
+        will first check the window. If the window is full will wait on readys until it has room
         constructs a packet and sends it over network  
         params:  
             str pack_type: the type of packet being sent (string form)  
-            args*: the objects to pickle  
+            args*: the arguments of the packet. Must fit the schema of pack_type (see codec.py)  
         returns:  
             int: the cid of the sent packet  
         Postconditions:  
@@ -197,23 +286,104 @@ class Armchair():
             has created log entry of send  
             cid has been appended to self._inflight_packs  
         '''
-        if len(self._inflight_packs) > self.buffsize and pack_type not in self.GHOST_TYPES:
-            self._block_on_ready()
+        inflight = pack_type != 'ready' and pack_type not in self.GHOST_TYPES
+        blocked_time = 0.0
+        if inflight:
+            while not self._has_room():
+                blocked_time += self._block_on_ready()
         if args:
-            payload = dill.dumps(args)
+            encode_start = time.perf_counter()
+            payload = self.codec.encode(pack_type, args)
+            encode_time = time.perf_counter() - encode_start
             n_bytes = len(payload)
             header = self._construct_head(n_bytes, pack_type)
             self.sock.send(header+payload)
+            self.recorder.record_pack(SENT, header, payload)
         else:
+            encode_time = 0.0
             n_bytes = 0
             header = self._construct_head(n_bytes, pack_type)
             self.sock.send(header)
-        with open(os.path.join(self.log_path, '{}_armchair.log'.format(self.name)), 'a+') as armchair_log:
-            armchair_log.write("{}\tsending {}, cid {}\n".format(datetime.now().strftime('%H:%M:%S:%f'), pack_type,self.cid))
-        if pack_type != 'ready' and pack_type not in self.GHOST_TYPES:
+            self.recorder.record_pack(SENT, header, b'')
+        self.log.record('sending', pack_type, self.cid)
+        self.metrics.record_send(self.cid, pack_type, n_bytes, encode_time, blocked_time,
+                inflight)
+        if inflight:
             self._inflight_packs.append(self.cid)
+            commands = args[0] if pack_type == 'batch' else [(pack_type, args)]
+            self._inflight_work[self.cid] = ([sub_type for sub_type, _ in commands],
+                    time.monotonic(), self._estimate_work(pack_type, args),
+                    sum([float(sub_args[0]) for sub_type, sub_args in commands if sub_type == 'pause']))
         return self.cid
 
+    def _estimate_work(self, pack_type, args):
+        '''
+        params:  
+            str pack_type: the type of packet being sent  
+            tuple args: the arguments of the packet  
+        returns:  
+            float: the estimated number of seconds the reciever will spend processing the packet  
+        '''
+        if pack_type == 'pause':
+            return float(args[0])
+        if pack_type == 'batch':
+            return sum([self._estimate_work(sub_type, sub_args) for sub_type, sub_args in args[0]])
+        return self._service_times.get(pack_type, 0.0)
+
+    def queued_work(self):
+        '''
+        returns:  
+            float: the estimated seconds of work inflight on the reciever  
+        '''
+        return sum([work for _, _, work, _ in self._inflight_work.values()])
+
+    def _has_room(self):
+        '''
+        returns:  
+            bool: True if another packet may be sent without waiting for a ready  
+        '''
+        n_inflight = len(self._inflight_packs)
+        if n_inflight >= self.buffsize:
+            return False
+        if not self.adaptive or n_inflight < self.min_buffsize:
+            return True
+        return self.queued_work() < self.lead_time
+
+    def _ack(self, cid):
+        '''
+        handles a ready by acknowledging every inflight packet up to and including cid. The
+        reciever executes packets in order, so a ready for cid implies all earlier cids are done  
+        params:  
+            int cid: the last cid acknowledged by the ready  
+        Postconditions:  
+            all cids <= cid have been removed from self._inflight_packs  
+            the service time estimates of the acked pack types have been updated  
+        '''
+        now = time.monotonic()
+        acked = []
+        while self._inflight_packs and self._inflight_packs[0] <= cid:
+            acked.append(self._inflight_packs.pop(0))
+        if not acked:
+            return
+        #the reciever started on the first of these when it was sent, or when it finished the
+        #last thing we heard about, whichever was later. Split the time evenly between them
+        first_sent = self._inflight_work[acked[0]][1]
+        start = first_sent if self._last_ack_time is None else max(first_sent, self._last_ack_time)
+        service_time = (now - start) / len(acked)
+        for acked_cid in acked:
+            self.metrics.record_ack(acked_cid)
+            pack_types, _, _, pause_time = self._inflight_work.pop(acked_cid)
+            #pauses take as long as they take. Split whatever time is left between the rest
+            work_types = [pack_type for pack_type in pack_types if pack_type != 'pause']
+            if not work_types:
+                continue
+            sub_service_time = max(service_time - pause_time, 0.0) / len(work_types)
+            for pack_type in work_types:
+                old_estimate = self._service_times.get(pack_type, sub_service_time)
+                self._service_times[pack_type] = old_estimate + self.SERVICE_TIME_SMOOTHING * \
+                        (sub_service_time - old_estimate)
+        self._last_ack_time = now
+
     def burn_pipe(self):
         '''
         burns through the pipe by reading all of the ready commands  
@@ -222,7 +392,7 @@ class Armchair():
             Nothing left in the inflight packets buffer  
         '''
         while self._inflight_packs:
-            self._block_on_ready()
+            self.metrics.record_blocked(self._block_on_ready())
 
     def recv_first(self,pack_type):
         '''
@@ -241,54 +411,235 @@ class Armchair():
             pack_type, cid, payload = self._recv()
         return pack_type, cid, payload
 
-    def recv_ftp(self):
+    def recv_ftp(self, dst_path):
         '''
         violates the armchair protocol a little bit because rather than sending an entire  
-        file as a payload, ftp is sent in a raw stream with delimiters after a sending_files   
-        is sent  
+        file as a payload, ftp is sent in a raw stream after a sending_files is sent. The
+        sending_files announces the offset, length, and crc32 of the bytes sent for each file, and
+        the bytes are then sent back to back. A file with offset 0 is sent in full and replaces
+        the local copy. A file with a nonzero offset is a delta, and its bytes are appended to the
+        local copy, which must be exactly offset bytes long. If it is not (e.g. the local copy was
+        deleted) the delta is discarded and the filename is returned as stale, so that the caller
+        can request a full resync. Each file is streamed to disk a chunk at a time, so it is never
+        held in memory  
+        params:  
+            str dst_path: the directory to write the recieved files to  
         returns:  
-            list<tuple<str:bytes>>: linked filenames and files as bytestreams  
+            list<tuple<str:str>>: linked filenames and the paths they were written to  
+            list<str>: the filenames of stale deltas that could not be applied  
+        raises:  
+            ConnectionError: if the bytes of a file did not match the announced checksum  
         '''
         pack_type, cid, arguments = self.recv_pack()
         assert(pack_type == 'sending_files')
-        filenames = arguments[0]
+        return self._recv_files(cid, arguments, dst_path)
+
+    def recv_ftp_async(self, dst_path, callback):
+        '''
+        Like recv_ftp, but doesn't wait for the files. Used when the other end will send files
+        only after it has worked through what is queued ahead (e.g. a save). The files are
+        recieved by whichever call reads their sending_files (recv_pack, a send blocked on the
+        window, or burn_pipe), and then callback is called. Transfers
+        arranged this way are recieved in the order they were arranged, and before any recv_ftp
+        arranged after them  
+        params:  
+            str dst_path: the directory to write the recieved files to  
+            func callback: called with the files and stale lists that recv_ftp would return  
+        '''
+        self._pending_ftp.append((dst_path, callback))
+
+    def _serve_pending_ftp(self, cid, arguments):
+        '''
+        recieves the files of the oldest recv_ftp_async and calls its callback  
+        params:  
+            int cid: the cid of the sending_files  
+            list arguments: the payload of the sending_files  
+        '''
+        dst_path, callback = self._pending_ftp.pop(0)
+        files, stale = self._recv_files(cid, arguments, dst_path)
+        callback(files, stale)
+
+    def _recv_files(self, cid, arguments, dst_path):
+        '''
+        streams the files announced by a sending_files to disk and acks it  
+        params:  
+            int cid: the cid of the sending_files  
+            list arguments: the payload of the sending_files  
+            str dst_path: the directory to write the recieved files to  
+        returns:  
+            list<tuple<str:str>>: linked filenames and the paths they were written to  
+            list<str>: the filenames of stale deltas that could not be applied  
+        raises:  
+            ConnectionError: if the bytes of a file did not match the announced checksum  
+        '''
+        view = memoryview(bytearray(self.FTP_CHUNK_SIZE))
         files = []
-        for filename in filenames:
-            file_bytes = self.sock.recv_until(self.FTP_EOF)
-            files.append((filename, file_bytes))
+        stale = []
+        corrupted = []
+        for filename, offset, n_bytes, checksum in arguments[0]:
+            filepath = os.path.join(dst_path, filename)
+            local_file = self.open_ftp_dst(filepath, offset)
+            if not local_file:
+                stale.append(filename)
+            try:
+                if self._recv_file(local_file, n_bytes, view) != checksum:
+                    corrupted.append(filename)
+            finally:
+                if local_file:
+                    local_file.close()
+            if local_file:
+                files.append((filename, filepath))
         #ack the send files
         self.send_pack('ready',cid)
-        return files
+        if corrupted:
+            raise ConnectionError('Armchair Error: checksum mismatch in ftp of {}'.format(corrupted))
+        return files, stale
 
-    def send_ftp(self, filepaths):
+    @staticmethod
+    def open_ftp_dst(filepath, offset):
         '''
+        opens the local copy of a file for the bytes of an ftp section to be written to  
         params:  
-            list<str> filenames: the names of the files to send  
-            str filepath: the path where all the files live  
+            str filepath: the path of the local copy  
+            int offset: the offset the section starts at (see recv_ftp)  
+        returns:  
+            file: the local copy opened for writing (offset 0) or appending (a delta that fits
+              the local copy), or None if the delta cannot be applied and must be discarded  
+        '''
+        if offset == 0:
+            return open(filepath, 'wb')
+        if os.path.exists(filepath) and os.path.getsize(filepath) == offset:
+            return open(filepath, 'ab')
+        return None
+
+    def _recv_file(self, local_file, n_bytes, view):
         '''
-        self.send_pack('sending_files', [os.path.basename(filepath) for filepath in filepaths])
+        streams the bytes of a single file off the socket onto disk  
+        params:  
+            file local_file: an open binary file to write to, or None to discard the bytes  
+            int n_bytes: the number of bytes to recieve  
+            memoryview view: a preallocated buffer to recieve into  
+        returns:  
+            int: the crc32 of the bytes recieved  
+        '''
+        checksum = 0
+        remaining = n_bytes
+        while remaining:
+            n_recvd = self.sock.recv_into(view[:min(remaining, len(view))])
+            chunk = view[:n_recvd]
+            if local_file:
+                local_file.write(chunk)
+            self.recorder.record_ftp(RECIEVED, chunk)
+            checksum = zlib.crc32(chunk, checksum)
+            remaining -= n_recvd
+        return checksum
+
+    def _checksum_file(self, filepath, view, split=0):
+        '''
+        reads a file once to get checksums of the part before split, the part after split, and
+        the whole file  
+        params:  
+            str filepath: the path of the file  
+            memoryview view: a preallocated buffer to read into  
+            int split: the offset to split the file at  
+        returns:  
+            int: the size of the file in bytes  
+            int: the crc32 of the bytes before split  
+            int: the crc32 of the bytes from split on  
+            int: the crc32 of the whole file  
+        '''
+        size = 0
+        head_checksum = 0
+        tail_checksum = 0
+        checksum = 0
+        with open(filepath, 'rb') as local_file:
+            n_bytes = local_file.readinto(view)
+            while n_bytes:
+                chunk = view[:n_bytes]
+                checksum = zlib.crc32(chunk, checksum)
+                n_head = min(n_bytes, max(split - size, 0))
+                if n_head:
+                    head_checksum = zlib.crc32(chunk[:n_head], head_checksum)
+                if n_head < n_bytes:
+                    tail_checksum = zlib.crc32(chunk[n_head:], tail_checksum)
+                size += n_bytes
+                n_bytes = local_file.readinto(view)
+        return size, head_checksum, tail_checksum, checksum
+
+    def send_ftp(self, filepaths, incremental=False):
+        '''
+        sends files to the other end. Each file is announced with the offset, length, and crc32
+        of the bytes being sent in a sending_files pack, and then the bytes are streamed back to
+        back with sendfile  
+        If incremental, only the bytes appended to a file since it was last sent by this
+        Armchair are sent. If the previously sent part of the file has changed since then, the
+        whole file is sent.  
+        params:  
+            list<str> filepaths: the paths of the files to send  
+            bool incremental: True to send only what was appended since the last send  
+        Postconditions:  
+            self._ftp_shipped has the size and crc32 of each file as sent  
+        '''
+        view = memoryview(bytearray(self.FTP_CHUNK_SIZE))
+        sections = []
+        announcement = []
         for filepath in filepaths:
-            with open(filepath,'rb') as local_file:
-                self.sock.sock.sendfile(local_file)
-                self.sock.send(self.FTP_EOF)
+            shipped_size, shipped_checksum = self._ftp_shipped.get(filepath, (0, 0)) \
+                    if incremental else (0, 0)
+            size, head_checksum, tail_checksum, checksum = self._checksum_file(filepath, view,
+                    shipped_size)
+            if size >= shipped_size and head_checksum == shipped_checksum:
+                #what was shipped is still there. only send what's new
+                offset, section_checksum = shipped_size, tail_checksum
+            else:
+                #file was rewritten. send it in full
+                offset, section_checksum = 0, checksum
+            sections.append((offset, size - offset))
+            announcement.append((os.path.basename(filepath), offset, size - offset,
+                    section_checksum))
+            self._ftp_shipped[filepath] = (size, checksum)
+        self.send_pack('sending_files', announcement)
+        for filepath, (offset, n_bytes) in zip(filepaths, sections):
+            if n_bytes:
+                with open(filepath,'rb') as local_file:
+                    self.sock.sendfile(local_file, offset, n_bytes)
+                self.recorder.record_file(SENT, filepath, offset, n_bytes)
 
     def _block_on_ready(self):
         '''
         used to block until the other side responds with a 'ready' packet  
         Preconditions: self._inflight_packs contains cids of packets that have been sent 
         not yet acknowledged  
+        returns:  
+            float: the number of seconds spent blocked  
         Postconditions:  
             has stalled until a ready command was recieved.  
-            The cid in the ready command has been removed from self.inflight_packs  
+            The cids acknowledged by the ready command have been removed from self.inflight_packs  
+            any files arranged with recv_ftp_async that arrived first have been recieved  
         '''
-        pack_type, _, arguments = self._recv()
+        block_start = time.monotonic()
+        pack_type, cid, arguments = self._recv()
+        while pack_type == 'sending_files' and self._pending_ftp:
+            self._serve_pending_ftp(cid, arguments)
+            pack_type, cid, arguments = self._recv()
         assert (pack_type == 'ready'), "was expecting a ready packet, but instead recieved a {}".format(pack_type)
-        cid = arguments[0]
-        self._inflight_packs.remove(cid)
+        self._ack(arguments[-1])
+        return time.monotonic() - block_start
 
     def close(self):
         '''
-        shutsdown this Armchair. Will burn through all readys before closing connection
+        shutsdown this Armchair. Will burn through all readys before closing connection  
+        Postconditions:  
+            the log has been flushed and closed  
+            metrics have been dumped to log_path, and a summary of round trip times printed  
         '''
-        self.burn_pipe()
-        self.sock.close()
+        try:
+            self.burn_pipe()
+            self.sock.close()
+        finally:
+            self.log.close()
+            self.recorder.close()
+            self.metrics.dump()
+            summary = self.metrics.summary()
+            if summary:
+                print('<<{}>> Armchair metrics\n{}'.format(self.name, summary))
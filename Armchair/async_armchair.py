@@ -0,0 +1,474 @@
+'''
+asyncio implementation of the Armchair protocol. Wire format, packet types, codec, and logging are  
+shared with Armchair (see armchair.py and armchair_specs.txt).  
+Rather than having the caller read packets one at a time, an AsyncArmchair runs a background  
+reader task that routes every incoming packet by type:  
+    ready: acknowledges inflight packets (cumulative), making room in the window  
+    loc_resp, stopped: resolve the oldest outstanding request for them (see request)  
+    sending_files: the files are streamed to the destination of the oldest outstanding  
+      request_ftp, and the files are acked  
+    error: puts the Armchair in error state and fails everything that is waiting. Reading  
+      continues, so GHOST requests (e.g. the save of the error flow) can still be made.  
+      reset_error clears the error state, as with Armchair  
+    anything else: passed to the handler registered for its type, or queued for recv  
+This means several GHOST requests (e.g. loc_req) can be in flight at once, and a response never  
+has to wait behind readys, nor are packets of other types thrown away while waiting for one.
+'''
+import asyncio
+from collections import deque
+import os
+import zlib
+from Armchair.armchair import Armchair
+from Armchair.codec import PackCodec
+from Armchair.logger import ArmchairLog, NullArmchairLog
+
+class AsyncArmchair():
+    '''
+    Armchair over asyncio streams. Create one with the connect coroutine, or construct it from a  
+    connected StreamReader/StreamWriter pair and await start().  
+    Only the packet count limits the window (buffsize). The adaptive window of Armchair is not  
+    supported.  
+    ATTRIBUTES:  
+        asyncio.StreamReader reader: the stream packets are read from  
+        asyncio.StreamWriter writer: the stream packets are written to  
+        int buffsize: the maximum number of allowed inflight packets  
+        int cid: the current command id. See Armchair  
+        str name: the name of this armchair object. Used for loging purposes  
+        str log_path: the path to the directory of the log file for this Armchair  
+        NullArmchairLog log: the log of this conversation  
+        int state: the state of the robot. 0 is good. 1 is bad. Only GHOST packets can be sent  
+          while the state is bad  
+        tuple error_payload: the args of the error packet that put this in error state  
+        Exception reader_error: the exception that stopped the reader task, if any. Everything  
+          that was waiting on the reader failed with it  
+        PackCodec codec: encodes and decodes packet payloads. See codec.py  
+        dict<str:func> handlers: maps pack_type to a function called with (cid, payload) for  
+          each packet of that type that is not a response to a request. A handler for 'error'  
+          is called with (cid, payload) when an error packet is recieved  
+    CONSTANTS:  
+        bidict PACK_TYPES: shared with Armchair  
+        list<str> GHOST_TYPES: shared with Armchair  
+        int FTP_CHUNK_SIZE: shared with Armchair  
+        dict<str:str> RESPONSE_TYPES: maps the type of a request to the type of its response  
+    METHODS:  
+        connect(str host, int port, str name, **kwargs) AsyncArmchair: coroutine. opens a  
+          connection and starts the reader  
+        start() void: coroutine. starts the reader task  
+        send_pack(str pack_type, *args) int: coroutine. waits for room in the window if  
+          necessary, sends, and returns the cid  
+        request(str pack_type, *args) tuple: coroutine. sends a request (e.g. loc_req) and  
+          returns the args of its response  
+        request_ftp(str dst_path, *args) tuple<list,list>: coroutine. sends a save and returns  
+          the files written to dst_path and the stale filenames (see Armchair.recv_ftp)  
+        recv(str pack_type) tuple<int,Obj>: coroutine. returns the cid and payload of the next  
+          unhandled packet of pack_type  
+        reset_error() void: clears the error state after an error packet  
+        burn_pipe() void: coroutine. waits until nothing is inflight  
+        close() void: coroutine. burns the pipe and terminates the connection
+    '''
+    PACK_TYPES = Armchair.PACK_TYPES
+    GHOST_TYPES = Armchair.GHOST_TYPES
+    FTP_CHUNK_SIZE = Armchair.FTP_CHUNK_SIZE
+    RESPONSE_TYPES = {'loc_req':'loc_resp', 'stop':'stopped', 'save':'sending_files'}
+
+    def __init__(self, reader, writer, name, log_path='', buffsize=4, dill_fallback=False,
+            log_enabled=True):
+        '''
+        params:  
+            asyncio.StreamReader reader: the stream to read from  
+            asyncio.StreamWriter writer: the stream to write to  
+            str name: the name of this armchair object. Used for logging purposes  
+            str log_path: the directory to put the log file in  
+            int buffsize: the maximum number of allowed inflight packets. Must be at least 1  
+            bool dill_fallback: see Armchair  
+            bool log_enabled: False turns off logging completely
+        '''
+        if buffsize < 1:
+            raise ValueError('Armchair buffsize must be at least 1, but got {}'.format(buffsize))
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.log_path = log_path
+        self.buffsize = buffsize
+        self.codec = PackCodec(dill_fallback)
+        self.cid = 0
+        self.state = 0
+        self.error_payload = None
+        self.reader_error = None
+        self.handlers = {}
+        self._inflight_packs = []
+        #maps response type to a deque of futures of outstanding requests. Responses arrive in
+        #the order the requests were sent. ftp futures are stored with their dst_path
+        self._pending = {response_type:deque() for response_type in self.RESPONSE_TYPES.values()}
+        self._queues = {}
+        self._window = None
+        self._errored = None #set while in error state, so recvs stop waiting
+        self._reader_task = None
+        self._closed = False
+        if log_enabled:
+            self.log = ArmchairLog(self.log_path, self.name)
+        else:
+            self.log = NullArmchairLog()
+
+    @classmethod
+    async def connect(cls, host, port, name, **kwargs):
+        '''
+        params:  
+            str host: the ip address to connect to  
+            int port: the port to connect to  
+            str name: the name of the armchair  
+            **kwargs: passed to the constructor  
+        returns:  
+            AsyncArmchair: a started armchair
+        '''
+        reader, writer = await asyncio.open_connection(host, port)
+        portal = cls(reader, writer, name, **kwargs)
+        await portal.start()
+        return portal
+
+    async def start(self):
+        '''
+        Postconditions:  
+            the reader task is running on the current event loop
+        '''
+        self._window = asyncio.Condition()
+        self._errored = asyncio.Event()
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    def _check_state(self, pack_type=None):
+        '''
+        params:  
+            str pack_type: the type of packet about to be sent. None if not sending  
+        raises:  
+            ConnectionError: if in error state (unless sending a GHOST packet) or the connection  
+              is closed
+        '''
+        if self.state != 0 and pack_type not in self.GHOST_TYPES:
+            raise ConnectionError('Armchair Error: cannot send or recieve with error state {}, please call reset_error first'.format(self.state))
+        if self.reader_error is not None:
+            raise ConnectionError('Armchair Error: reader failed') from self.reader_error
+        if self._closed:
+            raise ConnectionError('Armchair Error: connection closed')
+
+    def _write(self, pack_type, args):
+        '''
+        constructs a packet and writes it to the stream. Does not wait for the write to drain  
+        params:  
+            str pack_type: the type of packet being sent  
+            tuple args: the arguments of the packet  
+        returns:  
+            int: the cid of the packet
+        '''
+        payload = self.codec.encode(pack_type, args) if args else b''
+        if pack_type not in self.GHOST_TYPES:
+            self.cid += 1
+        self.writer.write(len(payload).to_bytes(8,'big') + self.PACK_TYPES[pack_type] +
+                self.cid.to_bytes(8,'big') + payload)
+        self.log.record('sending', pack_type, self.cid)
+        if pack_type != 'ready' and pack_type not in self.GHOST_TYPES:
+            self._inflight_packs.append(self.cid)
+        return self.cid
+
+    async def _wait_for_room(self, pack_type):
+        '''
+        waits until a packet of pack_type may be sent  
+        params:  
+            str pack_type: the type of the packet
+        '''
+        self._check_state(pack_type)
+        if pack_type == 'ready' or pack_type in self.GHOST_TYPES:
+            return
+        async with self._window:
+            while len(self._inflight_packs) >= self.buffsize:
+                await self._window.wait()
+                self._check_state()
+
+    async def send_pack(self, pack_type, *args):
+        '''
+        params:  
+            str pack_type: the type of packet being sent  
+            *args: the arguments of the packet. Must fit the schema of pack_type (see codec.py)  
+        returns:  
+            int: the cid of the sent packet
+        '''
+        await self._wait_for_room(pack_type)
+        cid = self._write(pack_type, args)
+        await self.writer.drain()
+        return cid
+
+    async def request(self, pack_type, *args):
+        '''
+        sends a packet that is answered by a response packet (see RESPONSE_TYPES) and waits for  
+        the response. Any number of requests may be outstanding at once  
+        params:  
+            str pack_type: the type of the request  
+            *args: the arguments of the request  
+        returns:  
+            tuple: the args of the response  
+        raises:  
+            ConnectionError: if an error packet is recieved or the connection closes first
+        '''
+        future = await self._send_request(pack_type, args)
+        return await future
+
+    async def request_ftp(self, dst_path, *args):
+        '''
+        sends a save and waits for the files to be recieved  
+        params:  
+            str dst_path: the directory to write the recieved files to  
+            *args: the arguments of the save  
+        returns:  
+            list<tuple<str:str>>: linked filenames and the paths they were written to  
+            list<str>: the filenames of stale deltas that could not be applied  
+        raises:  
+            ConnectionError: if the bytes of a file did not match the announced checksum
+        '''
+        future = await self._send_request('save', args, dst_path)
+        return await future
+
+    async def _send_request(self, pack_type, args, dst_path=None):
+        '''
+        params:  
+            str pack_type: the type of the request  
+            tuple args: the arguments of the request  
+            str dst_path: for saves, the directory to write the files to  
+        returns:  
+            asyncio.Future: resolved with the response
+        '''
+        await self._wait_for_room(pack_type)
+        #nothing may be awaited between the write and registering the future, or the response
+        #could be routed before the request is pending
+        self._write(pack_type, args)
+        future = asyncio.get_running_loop().create_future()
+        response_type = self.RESPONSE_TYPES[pack_type]
+        self._pending[response_type].append((future, dst_path))
+        await self.writer.drain()
+        return future
+
+    async def recv(self, pack_type):
+        '''
+        params:  
+            str pack_type: the type of packet to wait for  
+        returns:  
+            int: the cid of the packet  
+            Obj: the args of the packet  
+        raises:  
+            ConnectionError: if an error packet is recieved or the reader stops before a packet  
+              of pack_type arrives
+        '''
+        self._check_state()
+        get = asyncio.ensure_future(self._get_queue(pack_type).get())
+        errored = asyncio.ensure_future(self._errored.wait())
+        await asyncio.wait([get, errored, self._reader_task], return_when=asyncio.FIRST_COMPLETED)
+        errored.cancel()
+        if not get.done():
+            get.cancel()
+            self._check_state()
+        return get.result()
+
+    def _get_queue(self, pack_type):
+        if pack_type not in self._queues:
+            self._queues[pack_type] = asyncio.Queue()
+        return self._queues[pack_type]
+
+    async def _read_loop(self):
+        '''
+        body of the reader task. Reads and routes packets until the connection closes or  
+        reading or routing a packet raises. An error packet puts this in error state, but  
+        reading goes on  
+        raises:  
+            Exception: whatever stopped the reader, other than the connection closing. It is  
+              also stored in reader_error
+        '''
+        try:
+            while True:
+                header = await self.reader.readexactly(17)
+                n_bytes = int.from_bytes(header[:8], 'big')
+                pack_type = self.PACK_TYPES.inv[header[8:9]]
+                cid = int.from_bytes(header[9:17], 'big')
+                if n_bytes > 0:
+                    payload = self.codec.decode(pack_type, await self.reader.readexactly(n_bytes))
+                else:
+                    payload = None
+                self.log.record('recieved', pack_type, cid)
+                if pack_type == 'error':
+                    self._handle_error_pack(cid, payload)
+                    #wake sends waiting on the window, so they see the error
+                    await self._notify_window()
+                else:
+                    await self._route(pack_type, cid, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._fail_all(ConnectionError('Armchair Error: connection closed'))
+        except Exception as e:
+            #e.g. a corrupt payload, an unknown pack type, or a handler that raised. Everything
+            #waiting fails with e, and the task is left holding it so it is reported
+            self.reader_error = e
+            self.log.flush()
+            self._fail_all(e)
+            raise
+        finally:
+            self._closed = True
+            await self._notify_window()
+
+    async def _route(self, pack_type, cid, payload):
+        '''
+        params:  
+            str pack_type: the type of the packet  
+            int cid: the cid of the packet  
+            Obj payload: the args of the packet
+        '''
+        if pack_type == 'ready':
+            await self._ack(payload[-1])
+        elif pack_type == 'sending_files':
+            await self._recv_files(cid, payload)
+        elif pack_type in self._pending and self._pending[pack_type]:
+            future, _ = self._pending[pack_type].popleft()
+            if not future.done():
+                future.set_result(payload)
+        elif pack_type in self.handlers:
+            self.handlers[pack_type](cid, payload)
+        else:
+            self._get_queue(pack_type).put_nowait((cid, payload))
+
+    async def _ack(self, cid):
+        '''
+        acknowledges every inflight packet up to and including cid  
+        params:  
+            int cid: the last cid acknowledged by the ready
+        '''
+        while self._inflight_packs and self._inflight_packs[0] <= cid:
+            self._inflight_packs.pop(0)
+        await self._notify_window()
+
+    async def _notify_window(self):
+        if self._window:
+            async with self._window:
+                self._window.notify_all()
+
+    async def _recv_files(self, cid, payload):
+        '''
+        streams the files of a sending_files to the destination of the oldest outstanding  
+        request_ftp, and acks them. If no request_ftp is outstanding the bytes are discarded  
+        and every file is reported stale on the 'sending_files' queue  
+        params:  
+            int cid: the cid of the sending_files  
+            tuple payload: the args of the sending_files (see armchair_specs.txt)
+        '''
+        if self._pending['sending_files']:
+            future, dst_path = self._pending['sending_files'].popleft()
+        else:
+            future, dst_path = None, None
+        files = []
+        stale = []
+        corrupted = []
+        for filename, offset, n_bytes, checksum in payload[0]:
+            filepath = os.path.join(dst_path, filename) if dst_path else None
+            local_file = Armchair.open_ftp_dst(filepath, offset) if filepath else None
+            try:
+                if await self._recv_file(local_file, n_bytes) != checksum:
+                    corrupted.append(filename)
+            finally:
+                if local_file:
+                    local_file.close()
+            if local_file:
+                files.append((filename, filepath))
+            else:
+                stale.append(filename)
+        self._write('ready', (cid,))
+        await self.writer.drain()
+        if future is None:
+            self._get_queue('sending_files').put_nowait((cid, (files, stale)))
+        elif corrupted:
+            future.set_exception(ConnectionError(
+                    'Armchair Error: checksum mismatch in ftp of {}'.format(corrupted)))
+        else:
+            future.set_result((files, stale))
+
+    async def _recv_file(self, local_file, n_bytes):
+        '''
+        params:  
+            file local_file: an open binary file to write to, or None to discard the bytes  
+            int n_bytes: the number of bytes to recieve  
+        returns:  
+            int: the crc32 of the bytes recieved
+        '''
+        checksum = 0
+        remaining = n_bytes
+        while remaining:
+            chunk = await self.reader.read(min(remaining, self.FTP_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError('connection closed during ftp')
+            if local_file:
+                local_file.write(chunk)
+            checksum = zlib.crc32(chunk, checksum)
+            remaining -= len(chunk)
+        return checksum
+
+    def _handle_error_pack(self, cid, payload):
+        '''
+        Postconditions:  
+            state is 1 and error_payload is set  
+            every outstanding request and recv has failed with a ConnectionError  
+            the error handler (if any) has been called
+        '''
+        self.error_payload = payload
+        self.state = 1
+        self._errored.set()
+        self.log.flush()
+        self._fail_all(ConnectionError('Armchair Error: error pack recieved'))
+        if 'error' in self.handlers:
+            self.handlers['error'](cid, payload)
+
+    def reset_error(self):
+        '''
+        Used after an error packet to go back to normal use of the connection, e.g. to close it  
+        Postconditions:  
+            state is reset  
+            error_payload is wiped  
+            inflight_packs are cleared without waiting for ready
+        '''
+        self.state = 0
+        self.error_payload = None
+        self._inflight_packs = []
+        self._errored.clear()
+
+    def _fail_all(self, e):
+        '''
+        params:  
+            Exception e: the exception to fail every outstanding request with
+        '''
+        for pending in self._pending.values():
+            while pending:
+                future, _ = pending.popleft()
+                if not future.done():
+                    future.set_exception(e)
+
+    async def burn_pipe(self):
+        '''
+        Postconditions:  
+            Nothing left in the inflight packets buffer  
+        raises:  
+            ConnectionError: if the connection fails first
+        '''
+        async with self._window:
+            while self._inflight_packs:
+                self._check_state()
+                await self._window.wait()
+
+    async def close(self):
+        '''
+        shutsdown this Armchair. Will burn through all readys before closing connection  
+        Postconditions:  
+            the reader task has finished and the log has been closed
+        '''
+        try:
+            await self.burn_pipe()
+        finally:
+            self.writer.close()
+            if self._reader_task:
+                self._reader_task.cancel()
+                try:
+                    await self._reader_task
+                except asyncio.CancelledError:
+                    pass
+            self.log.close()
@@ -0,0 +1,358 @@
+'''
+This module holds the payload codecs used by Armchair. Rather than pickling every payload with  
+dill, each packet type in Armchair.PACK_TYPES that carries arguments is registered with a Schema  
+describing the shape of its arguments (e.g. a transfer is a str followed by a  
+list<tuple<str,float>>). Schemas are built from Fields that pack values directly with struct.  
+Every encoded payload begins with a single byte that says how the rest was encoded:  
+    b'\x00': schema encoded (see PACK_SCHEMAS)  
+    b'\x01': dill pickled. Only produced if the sending PackCodec was built with  
+      dill_fallback=True and the arguments did not fit the schema  
+Because nothing is pickled by default, no pandas/numpy objects cross the wire, which sidesteps  
+the pandas .25 (robot) vs 1.3 (controller) pickle incompatibility.
+'''
+from abc import ABC
+from abc import abstractmethod
+import builtins
+import numbers
+import struct
+
+_U8 = struct.Struct('>B')
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+
+SCHEMA_ENCODING = b'\x00'
+DILL_ENCODING = b'\x01'
+
+class Field(ABC):
+    '''
+    Abstract field of a schema. A field knows how to write a single python value to a list of  
+    byte chunks and how to read it back out of a buffer.  
+    METHODS:  
+        encode(Obj obj, list<bytes> out) void: appends the encoding of obj to out  
+        decode(memoryview buf, int offset) tuple<Obj,int>: returns the value and the offset  
+          of the first byte after it
+    '''
+    @abstractmethod
+    def encode(self, obj, out):
+        '''
+        params:  
+            Obj obj: the value to encode  
+            list<bytes> out: the chunks of the payload so far. The encoding is appended  
+        raises:  
+            TypeError: if obj can't be encoded by this field
+        '''
+        pass
+
+    @abstractmethod
+    def decode(self, buf, offset):
+        '''
+        params:  
+            memoryview buf: the payload  
+            int offset: the offset of the first byte of the value  
+        returns:  
+            Obj: the value  
+            int: the offset of the first byte after the value
+        '''
+        pass
+
+class Int(Field):
+    '''
+    signed 64 bit integer. Accepts anything int() accepts (e.g. numpy ints)
+    '''
+    def encode(self, obj, out):
+        out.append(_I64.pack(int(obj)))
+
+    def decode(self, buf, offset):
+        return _I64.unpack_from(buf, offset)[0], offset + 8
+
+class Float(Field):
+    '''
+    64 bit float. Accepts anything float() accepts (e.g. numpy floats)
+    '''
+    def encode(self, obj, out):
+        out.append(_F64.pack(float(obj)))
+
+    def decode(self, buf, offset):
+        return _F64.unpack_from(buf, offset)[0], offset + 8
+
+class Bool(Field):
+    '''
+    single byte boolean
+    '''
+    def encode(self, obj, out):
+        out.append(b'\x01' if obj else b'\x00')
+
+    def decode(self, buf, offset):
+        return buf[offset] != 0, offset + 1
+
+class Str(Field):
+    '''
+    utf-8 string prefixed with a 4 byte length
+    '''
+    def encode(self, obj, out):
+        if not isinstance(obj, str):
+            raise TypeError('expected str, but got {}'.format(type(obj).__name__))
+        data = obj.encode('utf-8')
+        out.append(_U32.pack(len(data)))
+        out.append(data)
+
+    def decode(self, buf, offset):
+        n = _U32.unpack_from(buf, offset)[0]
+        offset += 4
+        return str(buf[offset:offset+n], 'utf-8'), offset + n
+
+class ListOf(Field):
+    '''
+    list of elements that all have the same field type, prefixed with a 4 byte count  
+    ATTRIBUTES:  
+        Field field: the field of each element
+    '''
+    def __init__(self, field):
+        self.field = field
+
+    def encode(self, obj, out):
+        out.append(_U32.pack(len(obj)))
+        for elem in obj:
+            self.field.encode(elem, out)
+
+    def decode(self, buf, offset):
+        n = _U32.unpack_from(buf, offset)[0]
+        offset += 4
+        elems = []
+        for i in range(n):
+            elem, offset = self.field.decode(buf, offset)
+            elems.append(elem)
+        return elems, offset
+
+class TupleOf(Field):
+    '''
+    fixed size tuple with a field for each position  
+    ATTRIBUTES:  
+        tuple<Field> fields: the field at each position of the tuple
+    '''
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def encode(self, obj, out):
+        if len(obj) != len(self.fields):
+            raise TypeError('expected tuple of length {}, but got length {}'.format(
+                    len(self.fields), len(obj)))
+        for field, elem in zip(self.fields, obj):
+            field.encode(elem, out)
+
+    def decode(self, buf, offset):
+        elems = []
+        for field in self.fields:
+            elem, offset = field.decode(buf, offset)
+            elems.append(elem)
+        return tuple(elems), offset
+
+class Any(Field):
+    '''
+    Self describing field for arguments without a fixed shape, e.g. the DataFrame.to_dict()  
+    blobs in init. Each value is prefixed with a one byte tag. Supports None, bool, int,  
+    float, str, bytes, list, tuple, and dict, and numpy scalars (which are converted to their  
+    python equivalents with .item())
+    '''
+    def encode(self, obj, out):
+        if obj is None:
+            out.append(b'N')
+        elif obj is True or obj is False:
+            out.append(b'T' if obj else b'F')
+        elif isinstance(obj, str):
+            data = obj.encode('utf-8')
+            out.append(b's')
+            out.append(_U32.pack(len(data)))
+            out.append(data)
+        elif isinstance(obj, numbers.Integral) and not isinstance(obj, bool):
+            out.append(b'i')
+            out.append(_I64.pack(int(obj)))
+        elif isinstance(obj, numbers.Real):
+            out.append(b'd')
+            out.append(_F64.pack(float(obj)))
+        elif isinstance(obj, (bytes, bytearray)):
+            out.append(b'b')
+            out.append(_U32.pack(len(obj)))
+            out.append(bytes(obj))
+        elif isinstance(obj, (list, tuple)):
+            out.append(b'l' if isinstance(obj, list) else b't')
+            out.append(_U32.pack(len(obj)))
+            for elem in obj:
+                self.encode(elem, out)
+        elif isinstance(obj, dict):
+            out.append(b'm')
+            out.append(_U32.pack(len(obj)))
+            for key, val in obj.items():
+                self.encode(key, out)
+                self.encode(val, out)
+        elif hasattr(obj, 'item'):
+            #numpy scalars (np.bool_ in particular is not a numbers.Integral)
+            self.encode(obj.item(), out)
+        else:
+            raise TypeError('cannot encode object of type {}'.format(type(obj).__name__))
+
+    def decode(self, buf, offset):
+        tag = buf[offset:offset+1].tobytes()
+        offset += 1
+        if tag == b'N':
+            return None, offset
+        elif tag == b'T':
+            return True, offset
+        elif tag == b'F':
+            return False, offset
+        elif tag == b'i':
+            return _I64.unpack_from(buf, offset)[0], offset + 8
+        elif tag == b'd':
+            return _F64.unpack_from(buf, offset)[0], offset + 8
+        elif tag == b's' or tag == b'b':
+            n = _U32.unpack_from(buf, offset)[0]
+            offset += 4
+            data = buf[offset:offset+n]
+            return (str(data, 'utf-8') if tag == b's' else data.tobytes()), offset + n
+        elif tag == b'l' or tag == b't':
+            n = _U32.unpack_from(buf, offset)[0]
+            offset += 4
+            elems = []
+            for i in range(n):
+                elem, offset = self.decode(buf, offset)
+                elems.append(elem)
+            return (elems if tag == b'l' else tuple(elems)), offset
+        elif tag == b'm':
+            n = _U32.unpack_from(buf, offset)[0]
+            offset += 4
+            d = {}
+            for i in range(n):
+                key, offset = self.decode(buf, offset)
+                d[key], offset = self.decode(buf, offset)
+            return d, offset
+        else:
+            raise ValueError('unknown Any tag {}'.format(tag))
+
+class ExceptionField(Field):
+    '''
+    Exceptions are sent as their class name and message. On decode, the exception is rebuilt  
+    as the builtin exception of the same name if there is one, otherwise as a RuntimeError  
+    with the class name prepended to the message.
+    '''
+    def encode(self, obj, out):
+        Str().encode(type(obj).__name__, out)
+        Str().encode(str(obj), out)
+
+    def decode(self, buf, offset):
+        type_name, offset = Str().decode(buf, offset)
+        message, offset = Str().decode(buf, offset)
+        exc_type = getattr(builtins, type_name, None)
+        if isinstance(exc_type, type) and issubclass(exc_type, BaseException):
+            try:
+                return exc_type(message), offset
+            except TypeError:
+                #some builtins (e.g. UnicodeDecodeError) need more args
+                pass
+        return RuntimeError('{}: {}'.format(type_name, message)), offset
+
+class Schema():
+    '''
+    The full argument list of a packet type.  
+    The encoding starts with a one byte count of the arguments present, so that trailing  
+    optional arguments may be omitted by the sender.  
+    ATTRIBUTES:  
+        tuple<Field> fields: the field of each argument in order  
+        int n_required: the number of arguments that must be present. Defaults to all of them  
+    METHODS:  
+        encode(tuple args) bytes: encodes the arguments  
+        decode(memoryview buf) tuple: decodes the arguments
+    '''
+    def __init__(self, *fields, n_required=None):
+        self.fields = fields
+        self.n_required = len(fields) if n_required is None else n_required
+
+    def encode(self, args):
+        if not (self.n_required <= len(args) <= len(self.fields)):
+            raise TypeError('expected between {} and {} args, but got {}'.format(
+                    self.n_required, len(self.fields), len(args)))
+        out = [_U8.pack(len(args))]
+        for field, arg in zip(self.fields, args):
+            field.encode(arg, out)
+        return b''.join(out)
+
+    def decode(self, buf):
+        n_args = buf[0]
+        offset = 1
+        args = []
+        for field in self.fields[:n_args]:
+            arg, offset = field.decode(buf, offset)
+            args.append(arg)
+        return tuple(args)
+
+#the schema of every packet type that carries arguments. See armchair_spec.txt
+PACK_SCHEMAS = {
+    'init':Schema(Bool(), Bool(), Any(), Any(), Any(), Any(), Str(), Any()),
+    'error':Schema(ExceptionField(), Int(), n_required=1),
+    'ready':Schema(Int(), Int(), n_required=1),
+    'transfer':Schema(Str(), ListOf(TupleOf(Str(), Float())), Bool(), Float(), n_required=2),
+    'init_containers':Schema(Any()),
+    'sending_files':Schema(ListOf(TupleOf(Str(), Int(), Int(), Int()))),
+    'save':Schema(Bool(), n_required=0),
+    'batch':Schema(ListOf(TupleOf(Str(), Any()))),
+    'pause':Schema(Float()),
+    'loc_req':Schema(Any()),
+    'loc_resp':Schema(ListOf(TupleOf(Str(), Str(), Int(), Float(), Float()))),
+    'make':Schema(Str(), Float()),
+    'mix':Schema(ListOf(TupleOf(Str(), Int())))
+}
+
+class PackCodec():
+    '''
+    Encodes and decodes the payloads of Armchair packets using PACK_SCHEMAS.  
+    ATTRIBUTES:  
+        bool dill_fallback: if True, arguments that cannot be encoded with the schema of their  
+          packet type (or packet types without a schema) are pickled with dill instead of  
+          raising. Decoding of dill payloads is always supported.  
+        dict<str:Schema> schemas: the schema for each packet type  
+    METHODS:  
+        encode(str pack_type, tuple args) bytes: the payload for a packet  
+        decode(str pack_type, bytes payload) tuple: the args of a packet
+    '''
+    def __init__(self, dill_fallback=False, schemas=PACK_SCHEMAS):
+        self.dill_fallback = dill_fallback
+        self.schemas = schemas
+
+    def encode(self, pack_type, args):
+        '''
+        params:  
+            str pack_type: the type of the packet  
+            tuple args: the arguments of the packet  
+        returns:  
+            bytes: the encoded payload with its leading encoding byte  
+        raises:  
+            TypeError: if args do not fit the schema and dill_fallback is False
+        '''
+        try:
+            if pack_type not in self.schemas:
+                raise TypeError("no schema for packet type '{}'".format(pack_type))
+            return SCHEMA_ENCODING + self.schemas[pack_type].encode(args)
+        except (TypeError, ValueError, struct.error) as e:
+            if not self.dill_fallback:
+                raise TypeError("Armchair could not encode args of '{}' packet: {}".format(
+                        pack_type, e))
+            import dill
+            return DILL_ENCODING + dill.dumps(args)
+
+    def decode(self, pack_type, payload):
+        '''
+        params:  
+            str pack_type: the type of the packet  
+            bytes payload: the payload as recieved, including the encoding byte  
+        returns:  
+            tuple: the arguments of the packet
+        '''
+        buf = memoryview(payload)
+        encoding = buf[0:1].tobytes()
+        if encoding == SCHEMA_ENCODING:
+            return self.schemas[pack_type].decode(buf[1:])
+        elif encoding == DILL_ENCODING:
+            import dill
+            return dill.loads(buf[1:].tobytes())
+        else:
+            raise ValueError('unknown payload encoding {}'.format(encoding))
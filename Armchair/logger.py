@@ -0,0 +1,115 @@
+'''
+Logging backends for Armchair. The ArmchairLog keeps a single file handle open for the life of  
+the connection and buffers entries in memory. The buffer is written out by a background thread,  
+when it fills up, or when the log is flushed/closed explicitly (e.g. on close or error), so the  
+send/recv hot path never touches the filesystem.
+'''
+from collections import deque
+from datetime import datetime
+import os
+import threading
+import time
+
+class NullArmchairLog():
+    '''
+    Log that discards everything. Used when logging is turned off (e.g. for benchmarking)  
+    METHODS:  
+        record(str event, str pack_type, int cid) void: does nothing  
+        flush() void: does nothing  
+        close() void: does nothing
+    '''
+    def record(self, event, pack_type, cid):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class ArmchairLog(NullArmchairLog):
+    '''
+    Buffered log of an Armchair conversation.  
+    Entries are stored unformatted as (monotonic time, event, pack_type, cid) and are only  
+    formatted when they are written to disk. The file begins with a line relating the monotonic  
+    clock to the wall clock.  
+    ATTRIBUTES:  
+        str path: the path to the log file  
+        int capacity: the maximum number of entries held in memory. If a record would exceed  
+          this, the buffer is flushed synchronously by the recording thread  
+        float flush_interval: seconds between flushes by the background thread  
+    METHODS:  
+        record(str event, str pack_type, int cid) void: adds an entry to the log  
+        flush() void: writes all buffered entries to disk  
+        close() void: flushes, stops the background thread, and closes the file
+    '''
+    def __init__(self, log_path, name, capacity=1024, flush_interval=0.5):
+        '''
+        params:  
+            str log_path: the directory to write the log in  
+            str name: the name of the Armchair. The log will be {name}_armchair.log  
+            int capacity: the maximum number of entries held in memory  
+            float flush_interval: seconds between background flushes
+        '''
+        if not os.path.exists(log_path):
+            os.makedirs(log_path)
+        self.path = os.path.join(log_path, '{}_armchair.log'.format(name))
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._file = open(self.path, 'w')
+        self._file.write('Armchair Log: {}, {}, monotonic {:.6f}\n'.format(name,
+                datetime.now().strftime('%H:%M:%S:%f'), time.monotonic()))
+        self._file.flush()
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+
+    def record(self, event, pack_type, cid):
+        '''
+        params:  
+            str event: what happened to the packet, e.g. 'sending' or 'recieved'  
+            str pack_type: the type of the packet  
+            int cid: the cid of the packet
+        '''
+        entry = (time.monotonic(), event, pack_type, cid)
+        with self._lock:
+            self._buffer.append(entry)
+            full = len(self._buffer) >= self.capacity
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Postconditions:  
+            every entry recorded before the call has been written to the file
+        '''
+        with self._file_lock:
+            with self._lock:
+                entries = self._buffer
+                self._buffer = deque()
+            if self._file.closed:
+                return
+            self._file.write(''.join(['{:.6f}\t{} {}, cid {}\n'.format(*entry) for entry in entries]))
+            self._file.flush()
+
+    def _flush_loop(self):
+        '''
+        body of the background thread. flushes every flush_interval until closed
+        '''
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        '''
+        Postconditions:  
+            all entries have been written, the background thread has stopped, and the file is  
+              closed
+        '''
+        self._closed.set()
+        self._flush_thread.join()
+        self.flush()
+        with self._file_lock:
+            self._file.close()
@@ -0,0 +1,192 @@
+'''
+Latency and throughput metrics for Armchair conversations. An ArmchairMetrics records, for every  
+packet sent, when it was sent, when it was acked by a ready, how big its payload was, how long  
+it took to encode, and how long the sender was blocked waiting for room in the window before it  
+could be sent. For every packet recieved it records when, how big, and how long it took to  
+decode. This separates time spent on the network/serialization from time the reciever spent  
+executing. All times are seconds on the monotonic clock, relative to the creation of the  
+metrics.
+'''
+import csv
+import json
+import os
+import time
+
+class NullArmchairMetrics():
+    '''
+    Metrics that discard everything. Used when metrics are turned off  
+    METHODS:  
+        record_send(int cid, str pack_type, int n_bytes, float encode_time, float blocked_time,  
+          bool inflight) void: does nothing  
+        record_ack(int cid) void: does nothing  
+        record_recv(int cid, str pack_type, int n_bytes, float decode_time) void: does nothing  
+        record_blocked(float blocked_time) void: does nothing  
+        rtt_summary() dict: always empty  
+        summary() str: always empty  
+        dump() void: does nothing
+    '''
+    def record_send(self, cid, pack_type, n_bytes, encode_time, blocked_time, inflight):
+        pass
+
+    def record_ack(self, cid):
+        pass
+
+    def record_recv(self, cid, pack_type, n_bytes, decode_time):
+        pass
+
+    def record_blocked(self, blocked_time):
+        pass
+
+    def rtt_summary(self):
+        return {}
+
+    def summary(self):
+        return ''
+
+    def dump(self):
+        pass
+
+class ArmchairMetrics(NullArmchairMetrics):
+    '''
+    In memory metrics of an Armchair conversation  
+    ATTRIBUTES:  
+        str path: the path of the dump without extension. The dump is {path}.csv and {path}.json  
+        list<dict> sent: a row for each packet sent, in order. keys are cid, pack_type, sent,  
+          acked, rtt, n_bytes, encode_time, and blocked_time. acked and rtt are None for  
+          packets that were not (or not yet) acked, e.g. GHOST packets  
+        list<dict> recieved: a row for each packet recieved, in order. keys are cid, pack_type,  
+          recieved, n_bytes, and decode_time  
+        float unattributed_blocked_time: time blocked on readys that did not hold up a send  
+          (e.g. burning the pipe on close)  
+    METHODS:  
+        record_send(int cid, str pack_type, int n_bytes, float encode_time, float blocked_time,  
+          bool inflight) void: records a sent packet  
+        record_ack(int cid) void: records that cid was acked now  
+        record_recv(int cid, str pack_type, int n_bytes, float decode_time) void: records a  
+          recieved packet  
+        record_blocked(float blocked_time) void: records blocking that held up no send  
+        rtt_summary() dict<str:tuple<int,float,float>>: count, p50, and p95 round trip time for  
+          each pack type  
+        summary() str: a printable table of rtt_summary  
+        dump() void: writes the rows to {path}.csv and {path}.json
+    '''
+    CSV_FIELDS = ['direction', 'cid', 'pack_type', 'sent', 'acked', 'rtt', 'recieved', 'n_bytes',
+            'encode_time', 'decode_time', 'blocked_time']
+
+    def __init__(self, log_path, name):
+        '''
+        params:  
+            str log_path: the directory to dump metrics to  
+            str name: the name of the Armchair. The dump will be {name}_metrics.csv/json
+        '''
+        self.path = os.path.join(log_path, '{}_metrics'.format(name))
+        self.sent = []
+        self.recieved = []
+        self.unattributed_blocked_time = 0.0
+        self._start = time.monotonic()
+        #maps cid to its row in self.sent for cids not yet acked
+        self._unacked = {}
+
+    def record_send(self, cid, pack_type, n_bytes, encode_time, blocked_time, inflight):
+        '''
+        params:  
+            int cid: the cid of the packet  
+            str pack_type: the type of the packet  
+            int n_bytes: the size of the payload  
+            float encode_time: seconds spent encoding the payload  
+            float blocked_time: seconds spent waiting on readys before the packet could be sent  
+            bool inflight: True if the packet will be acked by a ready. GHOST packets share the  
+              cid of the last inflight packet, so they must not be matched to readys
+        '''
+        row = {'cid':cid, 'pack_type':pack_type, 'sent':time.monotonic() - self._start,
+                'acked':None, 'rtt':None, 'n_bytes':n_bytes, 'encode_time':encode_time,
+                'blocked_time':blocked_time}
+        self.sent.append(row)
+        if inflight:
+            self._unacked[cid] = row
+
+    def record_ack(self, cid):
+        '''
+        params:  
+            int cid: the cid that was acked
+        '''
+        row = self._unacked.pop(cid, None)
+        if row:
+            row['acked'] = time.monotonic() - self._start
+            row['rtt'] = row['acked'] - row['sent']
+
+    def record_recv(self, cid, pack_type, n_bytes, decode_time):
+        '''
+        params:  
+            int cid: the cid of the packet  
+            str pack_type: the type of the packet  
+            int n_bytes: the size of the payload  
+            float decode_time: seconds spent decoding the payload
+        '''
+        self.recieved.append({'cid':cid, 'pack_type':pack_type,
+                'recieved':time.monotonic() - self._start, 'n_bytes':n_bytes,
+                'decode_time':decode_time})
+
+    def record_blocked(self, blocked_time):
+        '''
+        params:  
+            float blocked_time: seconds spent waiting on readys that held up no send
+        '''
+        self.unattributed_blocked_time += blocked_time
+
+    def rtt_summary(self):
+        '''
+        percentiles are nearest rank  
+        returns:  
+            dict<str:tuple<int,float,float>>: maps pack_type to the number of acked packets of  
+              that type and the p50 and p95 of their round trip times
+        '''
+        rtts = {}
+        for row in self.sent:
+            if row['rtt'] is not None:
+                rtts.setdefault(row['pack_type'], []).append(row['rtt'])
+        summary = {}
+        for pack_type, times in rtts.items():
+            times.sort()
+            p50 = times[max(int(round(0.50 * len(times))) - 1, 0)]
+            p95 = times[max(int(round(0.95 * len(times))) - 1, 0)]
+            summary[pack_type] = (len(times), p50, p95)
+        return summary
+
+    def summary(self):
+        '''
+        returns:  
+            str: a table of the round trip times of each pack type, and the total time spent  
+              blocked, encoding, and decoding
+        '''
+        lines = ['{:<16}{:>8}{:>12}{:>12}'.format('pack_type', 'n', 'p50 rtt', 'p95 rtt')]
+        for pack_type, (n, p50, p95) in sorted(self.rtt_summary().items()):
+            lines.append('{:<16}{:>8}{:>12.4f}{:>12.4f}'.format(pack_type, n, p50, p95))
+        blocked = sum([row['blocked_time'] for row in self.sent]) + \
+                self.unattributed_blocked_time
+        lines.append('blocked on ready: {:.4f}s, encoding: {:.4f}s, decoding: {:.4f}s'.format(
+                blocked, sum([row['encode_time'] for row in self.sent]),
+                sum([row['decode_time'] for row in self.recieved])))
+        return '\n'.join(lines)
+
+    def dump(self):
+        '''
+        Postconditions:  
+            {path}.csv has a row for every packet sent or recieved  
+            {path}.json has the sent and recieved rows, unattributed blocked time, and the rtt  
+              summary
+        '''
+        dump_dir = os.path.dirname(self.path)
+        if dump_dir and not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+        with open(self.path + '.csv', 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, self.CSV_FIELDS)
+            writer.writeheader()
+            for row in self.sent:
+                writer.writerow(dict(row, direction='sent'))
+            for row in self.recieved:
+                writer.writerow(dict(row, direction='recieved'))
+        with open(self.path + '.json', 'w') as json_file:
+            json.dump({'sent':self.sent, 'recieved':self.recieved,
+                    'unattributed_blocked_time':self.unattributed_blocked_time,
+                    'rtt_summary':self.rtt_summary()}, json_file, indent=1)
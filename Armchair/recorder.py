@@ -0,0 +1,117 @@
+'''
+Records the full packet stream of an Armchair conversation to a compact session file, so that  
+real sessions can be replayed offline for benchmarking (see replay.py).  
+A session file starts with SESSION_MAGIC, followed by the name of the recording Armchair (4B  
+length + utf-8). Then there is an entry for each packet or chunk of ftp bytes, in the order  
+they crossed the wire:  
+    1B kind: 0 for a packet, 1 for raw ftp bytes  
+    1B direction: 0 if sent by the recording Armchair, 1 if recieved  
+    8B float time: seconds since the recording started (monotonic clock)  
+    4B n_bytes: the length of the data  
+    nB data: for packets, the 17B Armchair header followed by the encoded payload exactly as  
+      sent. For ftp, the raw bytes  
+All numbers are big endian.
+'''
+import os
+import struct
+import time
+
+SESSION_MAGIC = b'ARMSESS1'
+ENTRY_HEAD = struct.Struct('>BBdI')
+PACK_ENTRY = 0
+FTP_ENTRY = 1
+SENT = 0
+RECIEVED = 1
+
+class NullSessionRecorder():
+    '''
+    Recorder that discards everything. Used when recording is off  
+    METHODS:  
+        record_pack(int direction, bytes header, bytes payload) void: does nothing  
+        record_ftp(int direction, bytes data) void: does nothing  
+        record_file(int direction, str filepath, int offset, int n_bytes) void: does nothing  
+        close() void: does nothing
+    '''
+    def record_pack(self, direction, header, payload):
+        pass
+
+    def record_ftp(self, direction, data):
+        pass
+
+    def record_file(self, direction, filepath, offset, n_bytes):
+        pass
+
+    def close(self):
+        pass
+
+class SessionRecorder(NullSessionRecorder):
+    '''
+    Writes a session file. The file is opened once and written through a large buffer  
+    ATTRIBUTES:  
+        str path: the path of the session file  
+    METHODS:  
+        record_pack(int direction, bytes header, bytes payload) void: records a packet  
+        record_ftp(int direction, bytes data) void: records raw ftp bytes  
+        record_file(int direction, str filepath, int offset, int n_bytes) void: records a  
+          section of a file as raw ftp bytes  
+        close() void: closes the file
+    '''
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path, name):
+        '''
+        params:  
+            str path: the path of the session file. Overwritten if it exists  
+            str name: the name of the recording Armchair
+        '''
+        session_dir = os.path.dirname(path)
+        if session_dir and not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        self.path = path
+        self._start = time.monotonic()
+        self._file = open(path, 'wb', buffering=self.BUFFER_SIZE)
+        name = name.encode('utf-8')
+        self._file.write(SESSION_MAGIC + len(name).to_bytes(4, 'big') + name)
+
+    def _write(self, kind, direction, data):
+        '''
+        params:  
+            int kind: PACK_ENTRY or FTP_ENTRY  
+            int direction: SENT or RECIEVED  
+            bytes data: the data of the entry
+        '''
+        self._file.write(ENTRY_HEAD.pack(kind, direction, time.monotonic() - self._start,
+                len(data)))
+        self._file.write(data)
+
+    def record_pack(self, direction, header, payload):
+        '''
+        params:  
+            int direction: SENT or RECIEVED  
+            bytes header: the 17B header of the packet  
+            bytes payload: the encoded payload. Empty if the packet had no args
+        '''
+        self._write(PACK_ENTRY, direction, bytes(header) + bytes(payload))
+
+    def record_ftp(self, direction, data):
+        '''
+        params:  
+            int direction: SENT or RECIEVED  
+            bytes data: raw ftp bytes
+        '''
+        self._write(FTP_ENTRY, direction, bytes(data))
+
+    def record_file(self, direction, filepath, offset, n_bytes):
+        '''
+        params:  
+            int direction: SENT or RECIEVED  
+            str filepath: the file the bytes came from  
+            int offset: the offset of the section  
+            int n_bytes: the length of the section
+        '''
+        with open(filepath, 'rb') as local_file:
+            local_file.seek(offset)
+            self.record_ftp(direction, local_file.read(n_bytes))
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,365 @@
+'''
+Reads session files written by recorder.py and replays them, so that robot side and controller  
+side changes can be benchmarked against real sessions without Google Sheets or hardware.  
+Two drivers are provided, each of which plays one side of the recorded conversation into a  
+Transport:  
+    ControllerPlayback: plays the recorded controller's packets to a real (simulated) robot.  
+      ot2_robot.replay_eve_session sets this up against OT2Robot.execute  
+    StubRobot: answers a real controller the way the recorded robot did. loc_resp (by the wells  
+      looked up) and the files shipped on save are taken from the recording. Readys are  
+      generated by the stub.  
+Either side may be played as fast as possible, or at recorded speed (realtime=True).  
+A session recorded by either end can be used. The recording Armchair is taken to be the  
+controller if its name is 'controller', otherwise the robot.
+'''
+from collections import namedtuple
+import os
+import shutil
+import tempfile
+import time
+from Armchair.armchair import Armchair
+from Armchair.codec import PackCodec
+from Armchair.recorder import SESSION_MAGIC, ENTRY_HEAD, PACK_ENTRY, SENT
+
+#kind is 'pack' or 'ftp'. from_controller is True if the controller sent it. pack_type, cid,
+#and args are None for ftp entries and data is None for packets
+SessionEntry = namedtuple('SessionEntry', ['kind', 'from_controller', 'time', 'pack_type', 'cid',
+        'args', 'data'])
+
+class SessionReader():
+    '''
+    Reads a session file  
+    ATTRIBUTES:  
+        str path: the path to the session file  
+        str name: the name of the Armchair that recorded the session  
+        list<SessionEntry> entries: every entry of the session in order  
+    METHODS:  
+        controller_packs() list<SessionEntry>: the packets sent by the controller  
+        robot_packs() list<SessionEntry>: the packets sent by the robot
+    '''
+    def __init__(self, path):
+        '''
+        params:  
+            str path: the path to the session file  
+        raises:  
+            ValueError: if the file is not a session file
+        '''
+        self.path = path
+        codec = PackCodec()
+        with open(path, 'rb') as session_file:
+            buf = memoryview(session_file.read())
+        if buf[:len(SESSION_MAGIC)].tobytes() != SESSION_MAGIC:
+            raise ValueError('{} is not an Armchair session file'.format(path))
+        offset = len(SESSION_MAGIC)
+        name_len = int.from_bytes(buf[offset:offset+4], 'big')
+        offset += 4
+        self.name = str(buf[offset:offset+name_len], 'utf-8')
+        offset += name_len
+        recorded_by_controller = self.name == 'controller'
+        self.entries = []
+        while offset < len(buf):
+            kind, direction, entry_time, n_bytes = ENTRY_HEAD.unpack_from(buf, offset)
+            offset += ENTRY_HEAD.size
+            data = buf[offset:offset+n_bytes]
+            offset += n_bytes
+            from_controller = (direction == SENT) == recorded_by_controller
+            if kind == PACK_ENTRY:
+                pack_type = Armchair.PACK_TYPES.inv[data[8:9].tobytes()]
+                cid = int.from_bytes(data[9:17], 'big')
+                args = codec.decode(pack_type, data[17:]) if n_bytes > 17 else ()
+                self.entries.append(SessionEntry('pack', from_controller, entry_time, pack_type,
+                        cid, args, None))
+            else:
+                self.entries.append(SessionEntry('ftp', from_controller, entry_time, None, None,
+                        None, data.tobytes()))
+
+    def controller_packs(self):
+        '''
+        returns:  
+            list<SessionEntry>: the packets sent by the controller in order
+        '''
+        return [entry for entry in self.entries if entry.kind == 'pack' and entry.from_controller]
+
+    def robot_packs(self):
+        '''
+        returns:  
+            list<SessionEntry>: the packets sent by the robot in order
+        '''
+        return [entry for entry in self.entries if entry.kind == 'pack' and not entry.from_controller]
+
+class ControllerPlayback():
+    '''
+    Plays the controller's side of a session to a robot. Packets are sent with a normal Armchair,  
+    so the robot sees the same flow control it would from a controller. The readys the recorded  
+    controller sent are not replayed, since this Armchair acks for itself. The init packet is  
+    always sent with simulate=True  
+    ATTRIBUTES:  
+        SessionReader session: the session being played  
+        Armchair portal: the connection to the robot  
+        bool realtime: True to send each packet no sooner than it was sent in the recording  
+    METHODS:  
+        run() float: plays the session. returns elapsed seconds
+    '''
+    def __init__(self, session, transport, realtime=False, log_path='Armchair_Logs'):
+        '''
+        params:  
+            SessionReader session: the session to play  
+            Transport transport: connected to the robot  
+            bool realtime: True to play at recorded speed  
+            str log_path: the directory for the Armchair log
+        '''
+        self.session = session
+        self.realtime = realtime
+        self.portal = Armchair(transport, 'playback', log_path)
+
+    def run(self):
+        '''
+        returns:  
+            float: the number of seconds from the first packet to the robot closing  
+        Postconditions:  
+            every packet the recorded controller sent, up to and including close, has been sent,  
+              and the connection is closed
+        '''
+        ftp_dir = tempfile.mkdtemp()
+        packs = [entry for entry in self.session.controller_packs() if entry.pack_type != 'ready']
+        start = time.monotonic()
+        try:
+            for entry in packs:
+                if self.realtime:
+                    time.sleep(max(entry.time - packs[0].time - (time.monotonic() - start), 0))
+                args = entry.args
+                if entry.pack_type == 'init':
+                    args = (True,) + tuple(args[1:])
+                self.portal.send_pack(entry.pack_type, *args)
+                if entry.pack_type == 'close':
+                    break
+                if entry.pack_type == 'save':
+                    self.portal.recv_ftp(ftp_dir)
+                elif entry.pack_type in ('loc_req', 'stop'):
+                    self.portal.recv_pack()
+            self.portal.close()
+        finally:
+            shutil.rmtree(ftp_dir)
+        return time.monotonic() - start
+
+class StubRobot():
+    '''
+    Stands in for the robot of a recorded session. Every command is acked with a ready once it  
+    has been 'executed'. Responses that carry data come from the recording: a loc_req is  
+    answered with the recorded loc_resp to a loc_req for the same wells (the nth such loc_req  
+    gets the nth answer, and any after the last get the last), and the nth save ships the files  
+    as they were after the nth recorded save. Files are rebuilt from the recorded ftp bytes and  
+    shipped with send_ftp, so deltas and full resyncs behave as they would on a robot.  
+    A loc_req for wells the recording never looked up is an error. It is handled the way the  
+    robot handles one: an error is sent, and the stub waits for the save and close.  
+    If realtime, each command takes as long as the recorded robot took for the command of the  
+    same type in the same position (or the mean for its type if there were fewer)  
+    ATTRIBUTES:  
+        SessionReader session: the recorded session  
+        Armchair portal: the connection to the controller  
+        bool realtime: True to take as long as the recorded robot did  
+    METHODS:  
+        run() void: serves the controller until it sends close
+    '''
+    def __init__(self, session, transport, realtime=False, log_path='Armchair_Logs'):
+        '''
+        params:  
+            SessionReader session: the session to play  
+            Transport transport: connected to the controller  
+            bool realtime: True to play at recorded speed  
+            str log_path: the directory for the Armchair log
+        '''
+        self.session = session
+        self.realtime = realtime
+        self.portal = Armchair(transport, 'stub_robot', log_path)
+        self._loc_resps = self._load_loc_resps()
+        self._n_loc_reqs = {} #maps the key of a lookup to the number of times it has been made
+        self._saves = self._load_saves()
+        self._service_times = self._load_service_times()
+        self._n_executed = {}
+        self._save_dir = None
+
+    def _loc_key(self, wellnames):
+        '''
+        params:  
+            list<str>|str wellnames: the arg of a loc_req. A list of wellnames or 'all'  
+        returns:  
+            tuple<str>|str: a hashable key for the lookup
+        '''
+        return tuple(wellnames) if isinstance(wellnames, (list, tuple)) else wellnames
+
+    def _load_loc_resps(self):
+        '''
+        responses arrive in the order the requests were sent, so the nth recorded loc_resp
+        answers the nth recorded loc_req  
+        returns:  
+            dict<tuple<str>|str:list<tuple>>: the args of the recorded loc_resps to each lookup,
+              in order, by the key of the lookup
+        '''
+        keys = [self._loc_key(entry.args[0]) for entry in self.session.controller_packs()
+                if entry.pack_type == 'loc_req']
+        resps = [entry.args for entry in self.session.robot_packs()
+                if entry.pack_type == 'loc_resp']
+        loc_resps = {}
+        for key, args in zip(keys, resps):
+            loc_resps.setdefault(key, []).append(args)
+        return loc_resps
+
+    def _answer_loc_req(self, wellnames):
+        '''
+        params:  
+            list<str>|str wellnames: the arg of the loc_req  
+        returns:  
+            tuple: the args of the recorded loc_resp to send  
+        raises:  
+            LookupError: if the recording never looked up these wells
+        '''
+        key = self._loc_key(wellnames)
+        if key not in self._loc_resps:
+            raise LookupError('the recorded session {} never looked up {}. The stub can only '
+                    'answer lookups the recording made'.format(self.session.path, wellnames))
+        n = self._n_loc_reqs.get(key, 0)
+        self._n_loc_reqs[key] = n + 1
+        resps = self._loc_resps[key]
+        return resps[min(n, len(resps) - 1)]
+
+    def _load_saves(self):
+        '''
+        returns:  
+            list<dict<str:bytes>>: the contents of each file after each recorded save
+        '''
+        saves = []
+        files = {}
+        entries = [entry for entry in self.session.entries if not entry.from_controller]
+        for i, entry in enumerate(entries):
+            if entry.pack_type != 'sending_files':
+                continue
+            ftp_bytes = b''.join([ftp_entry.data for ftp_entry in
+                    self._take_ftp(entries, i + 1)])
+            ftp_offset = 0
+            for filename, offset, n_bytes, _ in entry.args[0]:
+                section = ftp_bytes[ftp_offset:ftp_offset+n_bytes]
+                ftp_offset += n_bytes
+                files[filename] = files.get(filename, b'')[:offset] + section
+            saves.append(dict(files))
+        return saves
+
+    def _take_ftp(self, entries, i):
+        '''
+        params:  
+            list<SessionEntry> entries: entries sent by the robot  
+            int i: the index of the first entry after a sending_files  
+        returns:  
+            list<SessionEntry>: the ftp entries immediately following
+        '''
+        ftp_entries = []
+        while i < len(entries) and entries[i].kind == 'ftp':
+            ftp_entries.append(entries[i])
+            i += 1
+        return ftp_entries
+
+    def _load_service_times(self):
+        '''
+        the service time of a command is the time from when the robot could have started it  
+        (when it was sent, or when the previous command was acked) until it was acked  
+        returns:  
+            dict<str:list<float>>: the recorded service times of each pack type in order
+        '''
+        service_times = {}
+        inflight = []
+        last_ack = None
+        for entry in self.session.entries:
+            if entry.kind != 'pack':
+                continue
+            if entry.from_controller and entry.pack_type != 'ready' and \
+                    entry.pack_type not in Armchair.GHOST_TYPES:
+                inflight.append(entry)
+            elif not entry.from_controller and entry.pack_type == 'ready':
+                while inflight and inflight[0].cid <= entry.args[-1]:
+                    sent = inflight.pop(0)
+                    start = sent.time if last_ack is None else max(sent.time, last_ack)
+                    service_times.setdefault(sent.pack_type, []).append(entry.time - start)
+                    last_ack = entry.time
+        return service_times
+
+    def _execute(self, pack_type):
+        '''
+        waits for as long as the recorded robot took to execute pack_type if realtime  
+        params:  
+            str pack_type: the type of command being executed
+        '''
+        n = self._n_executed.get(pack_type, 0)
+        self._n_executed[pack_type] = n + 1
+        times = self._service_times.get(pack_type)
+        if not self.realtime or not times:
+            return
+        time.sleep(times[n] if n < len(times) else sum(times) / len(times))
+
+    def _ship_save(self, n, full):
+        '''
+        params:  
+            int n: the number of saves shipped before this one  
+            bool full: True to ship every file in full
+        '''
+        files = self._saves[min(n, len(self._saves) - 1)] if self._saves else {}
+        for filename, data in files.items():
+            with open(os.path.join(self._save_dir, filename), 'wb') as local_file:
+                local_file.write(data)
+        filepaths = [os.path.join(self._save_dir, filename) for filename in files]
+        self.portal.send_ftp(filepaths, incremental=not full)
+
+    def run(self):
+        '''
+        Postconditions:  
+            the controller has sent close, and the connection is closed
+        '''
+        self._save_dir = tempfile.mkdtemp()
+        n_saves = 0
+        try:
+            while True:
+                pack_type, cid, args = self.portal.recv_pack()
+                self._execute(pack_type)
+                if pack_type == 'loc_req':
+                    try:
+                        resp = self._answer_loc_req(args[0])
+                    except LookupError as e:
+                        self._fail(e, n_saves)
+                    self.portal.send_pack('loc_resp', *resp)
+                elif pack_type == 'save':
+                    self._ship_save(n_saves, bool(args and args[0]))
+                    n_saves += 1
+                elif pack_type == 'continue':
+                    pass
+                else:
+                    if pack_type == 'stop':
+                        self.portal.send_pack('stopped')
+                        next_type, _, _ = self.portal.recv_pack()
+                        assert (next_type == 'continue'), "Was stopped waiting for continue, but recieved, {}".format(next_type)
+                    self.portal.send_pack('ready', cid)
+                    if pack_type == 'close':
+                        self.portal.close()
+                        return
+        finally:
+            shutil.rmtree(self._save_dir)
+
+    def _fail(self, e, n_saves):
+        '''
+        handles an error the way the robot does. The error is sent, and then the next save is
+        shipped and the connection closed when the controller asks. Other commands are ignored  
+        params:  
+            Exception e: the error  
+            int n_saves: the number of saves shipped before the error  
+        raises:  
+            Exception: e, once the connection is closed
+        '''
+        print('<<stub_robot>> {}. Sending Error packet'.format(e))
+        self.portal.send_pack('error', e)
+        pack_type, cid, args = self.portal.recv_pack()
+        while pack_type != 'close':
+            if pack_type == 'save':
+                self._ship_save(n_saves, bool(args and args[0]))
+                n_saves += 1
+            pack_type, cid, args = self.portal.recv_pack()
+        self.portal.send_pack('ready', cid)
+        self.portal.close()
+        raise e
@@ -0,0 +1,191 @@
+'''
+Transports carry the bytes of an Armchair conversation. Armchair only ever talks to a transport  
+through the surface of Transport, so the same protocol can run over a real socket  
+(SocketTransport) or entirely in memory (PipeTransport) e.g. for simulations, where the robot  
+runs in a thread of the same process.
+'''
+from abc import ABC
+from abc import abstractmethod
+import threading
+
+class Transport(ABC):
+    '''
+    Abstract duplex byte stream used by Armchair  
+    METHODS:  
+        recv_size(int size) bytes: blocks until exactly size bytes have been recieved  
+        recv_until(bytes delimiter) bytes: blocks until delimiter is recieved. Returns the bytes  
+          before the delimiter. The delimiter is consumed  
+        recv_into(memoryview view) int: blocks until at least one byte is available, and  
+          writes as many as fit into the front of view. Returns the number written  
+        send(bytes data) void: sends all of data  
+        sendfile(file local_file, int offset, int count) void: sends count bytes of an open  
+          binary file starting at offset  
+        close() void: closes the transport
+    '''
+    @abstractmethod
+    def recv_size(self, size):
+        pass
+
+    @abstractmethod
+    def recv_until(self, delimiter):
+        pass
+
+    @abstractmethod
+    def recv_into(self, view):
+        pass
+
+    @abstractmethod
+    def send(self, data):
+        pass
+
+    @abstractmethod
+    def sendfile(self, local_file, offset, count):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+class SocketTransport(Transport):
+    '''
+    Transport over a connected socket wrapped in a boltons BufferedSocket  
+    ATTRIBUTES:  
+        BufferedSocket sock: the connected socket
+    '''
+    def __init__(self, buffered_sock):
+        '''
+        params:  
+            BufferedSocket buffered_sock: a connected socket
+        '''
+        self.sock = buffered_sock
+
+    def recv_size(self, size):
+        return self.sock.recv_size(size)
+
+    def recv_until(self, delimiter):
+        return self.sock.recv_until(delimiter)
+
+    def recv_into(self, view):
+        '''
+        Bytes the BufferedSocket has already read off the wire are used first  
+        raises:  
+            ConnectionError: if the connection was closed
+        '''
+        if self.sock.getrecvbuffer():
+            data = self.sock.recv(len(view))
+            n_bytes = len(data)
+            view[:n_bytes] = data
+        else:
+            n_bytes = self.sock.sock.recv_into(view)
+        if n_bytes == 0:
+            raise ConnectionError('connection closed by peer')
+        return n_bytes
+
+    def send(self, data):
+        self.sock.send(data)
+
+    def sendfile(self, local_file, offset, count):
+        self.sock.sock.sendfile(local_file, offset, count)
+
+    def close(self):
+        self.sock.close()
+
+class _PipeBuffer():
+    '''
+    one direction of a PipeTransport. bytes written by one end and read by the other  
+    ATTRIBUTES:  
+        bytearray data: bytes written but not yet read  
+        threading.Condition cond: guards data and closed. Notified on every write and on close  
+        bool closed: True once either end has been closed
+    '''
+    def __init__(self):
+        self.data = bytearray()
+        self.cond = threading.Condition()
+        self.closed = False
+
+class PipeTransport(Transport):
+    '''
+    One end of an in-memory duplex pipe. Create a connected pair with make_pipe(). Reads block  
+    until the other end has written enough. Once either end is closed, reads that cannot be  
+    satisfied from what was already written raise a ConnectionError
+    '''
+    def __init__(self, inbox, outbox):
+        '''
+        params:  
+            _PipeBuffer inbox: the buffer this end reads from  
+            _PipeBuffer outbox: the buffer this end writes to
+        '''
+        self._inbox = inbox
+        self._outbox = outbox
+
+    def _wait_for(self, ready):
+        '''
+        blocks until ready() is True. Must be called holding self._inbox.cond  
+        params:  
+            func ready: called with no args. returns True when the read can proceed  
+        raises:  
+            ConnectionError: if the pipe was closed before ready() became True
+        '''
+        while not ready():
+            if self._inbox.closed:
+                raise ConnectionError('pipe closed')
+            self._inbox.cond.wait()
+
+    def recv_size(self, size):
+        inbox = self._inbox
+        with inbox.cond:
+            self._wait_for(lambda: len(inbox.data) >= size)
+            data = bytes(inbox.data[:size])
+            del inbox.data[:size]
+        return data
+
+    def recv_until(self, delimiter):
+        inbox = self._inbox
+        with inbox.cond:
+            self._wait_for(lambda: inbox.data.find(delimiter) != -1)
+            i = inbox.data.find(delimiter)
+            data = bytes(inbox.data[:i])
+            del inbox.data[:i+len(delimiter)]
+        return data
+
+    def recv_into(self, view):
+        inbox = self._inbox
+        with inbox.cond:
+            self._wait_for(lambda: len(inbox.data) > 0)
+            n_bytes = min(len(view), len(inbox.data))
+            view[:n_bytes] = inbox.data[:n_bytes]
+            del inbox.data[:n_bytes]
+        return n_bytes
+
+    def send(self, data):
+        outbox = self._outbox
+        with outbox.cond:
+            if outbox.closed:
+                raise ConnectionError('pipe closed')
+            outbox.data += data
+            outbox.cond.notify_all()
+
+    def sendfile(self, local_file, offset, count):
+        local_file.seek(offset)
+        while count:
+            chunk = local_file.read(min(count, 64 * 1024))
+            if not chunk:
+                raise EOFError('file ended before {} bytes were sent'.format(count))
+            self.send(chunk)
+            count -= len(chunk)
+
+    def close(self):
+        for buff in (self._inbox, self._outbox):
+            with buff.cond:
+                buff.closed = True
+                buff.cond.notify_all()
+
+def make_pipe():
+    '''
+    returns:  
+        PipeTransport: one end of a new in-memory duplex pipe  
+        PipeTransport: the other end
+    '''
+    a_to_b = _PipeBuffer()
+    b_to_a = _PipeBuffer()
+    return PipeTransport(b_to_a, a_to_b), PipeTransport(a_to_b, b_to_a)
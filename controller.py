@@ -36,6 +36,8 @@ import argparse
 import re
 import functools
 import datetime
+import io
+from concurrent.futures import ThreadPoolExecutor
 
 from bidict import bidict
 import gspread
@@ -57,6 +59,8 @@ from sklearn.multioutput import MultiOutputRegressor
 from sklearn.linear_model import Lasso
 
 from Armchair.armchair import Armchair
+from Armchair.transport import make_pipe
+from Armchair.replay import SessionReader, StubRobot
 from ot2_robot import launch_eve_server
 from df_utils import make_unique, df_popout, wslpath, error_exit
 from ml_models import DummyMLModel, LinReg
@@ -73,6 +77,8 @@ def init_parser():
     parser.add_argument('-s','--simulate',help='runs robot and pr in simulation mode',action='store_true')
     parser.add_argument('--no-sim',help='won\'t run simulation at the start.',action='store_true')
     parser.add_argument('--no-pr', help='won\'t invoke platereader, even in simulation mode',action='store_true')
+    parser.add_argument('-b','--buff-size',help='the maximum number of commands inflight to the robot',type=int,default=4)
+    parser.add_argument('-r','--record',help='records the session with the robot to this file for replay',default=None)
     return parser
 
 def main(serveraddr):
@@ -83,15 +89,15 @@ def main(serveraddr):
     args = parser.parse_args()
     if args.mode == 'protocol':
         print('launching in protocol mode')
-        launch_protocol_exec(serveraddr,args.name,args.cache,args.simulate,args.no_sim,args.no_pr)
+        launch_protocol_exec(serveraddr,args.name,args.cache,args.simulate,args.no_sim,args.no_pr,args.buff_size,args.record)
     elif args.mode == 'auto':
         print('launching in auto mode')
-        launch_auto(serveraddr,args.name,args.cache,args.simulate,args.no_sim,args.no_pr)
+        launch_auto(serveraddr,args.name,args.cache,args.simulate,args.no_sim,args.no_pr,args.buff_size,args.record)
     else:
         print("invalid argument to mode, '{}'".format(args.mode))
         parser.print_help()
 
-def launch_protocol_exec(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim, no_pr):
+def launch_protocol_exec(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim, no_pr, buff_size=4, record_path=None):
     '''
     main function to launch a controller and execute a protocol
     '''
@@ -99,21 +105,23 @@ def launch_protocol_exec(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim
     if not rxn_sheet_name:
         rxn_sheet_name = input('<<controller>> please input the sheet name ')
     my_ip = socket.gethostbyname(socket.gethostname())
-    controller = ProtocolExecutor(rxn_sheet_name, my_ip, serveraddr, use_cache=use_cache)
+    controller = ProtocolExecutor(rxn_sheet_name, my_ip, serveraddr, buff_size=buff_size, use_cache=use_cache)
+    controller.record_path = record_path
 
     if not no_sim:
         controller.run_simulation(no_pr=no_pr)
     if input('would you like to run the protocol? [yn] ').lower() == 'y':
         controller.run_protocol(simulate, no_pr)
 
-def launch_auto(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim, no_pr):
+def launch_auto(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim, no_pr, buff_size=4, record_path=None):
     '''
     main function to launch an auto scientist that designs it's own experiments
     '''
     if not rxn_sheet_name:
         rxn_sheet_name = input('<<controller>> please input the sheet name ')
     my_ip = socket.gethostbyname(socket.gethostname())
-    auto = AutoContr(rxn_sheet_name, my_ip, serveraddr, use_cache=use_cache)
+    auto = AutoContr(rxn_sheet_name, my_ip, serveraddr, buff_size=buff_size, use_cache=use_cache)
+    auto.record_path = record_path
     #note shorter iterations for testing
     model = MultiOutputRegressor(Lasso(warm_start=True, max_iter=int(1e1)))
     final_spectra = np.loadtxt(
@@ -130,6 +138,227 @@ def launch_auto(serveraddr, rxn_sheet_name, use_cache, simulate, no_sim, no_pr):
         auto.run_protocol(simulate=simulate, model=ml_model,no_pr=no_pr)
 
 
+class ShadowDeck():
+    '''
+    A model of the robot's containers kept by the controller, so that lookups of where
+    containers are and how much they hold don't need a loc_req round trip. It is seeded and
+    corrected by loc_resps, and driven by the commands the controller sends (see apply).
+    Entries the model can't predict, e.g. a source that the robot will have to make more of
+    after an EmptyReagent, are marked uncertain, and must be looked up on the robot again  
+    ATTRIBUTES:  
+        dict<str:tuple<str,int,float,float>> entries: maps chem_name to the loc, deck_pos,
+          vol, and aspiratible vol of the container as the robot would report it in a
+          loc_resp (locs are not translated to the platereader)  
+        set<str> uncertain: names whose entries may be wrong  
+        set<str> multi: names that are MultiContainers on the robot. Recorded from the reagents
+          sent with init (a name with more than one container). Every other container,
+          including those from init_containers and make, is a single Container  
+        bool complete: True if entries has every container on the robot  
+        int n_served: the number of lookups answered by the model since the last check  
+    METHODS:  
+        reset() void: forgets everything. Used when the robot is initialized  
+        names() list<str>: every container the robot has, if complete  
+        stale(list<str> wellnames) list<str>: the wellnames that must be looked up on the robot  
+        sync(list<tuple> loc_resp, bool complete) list<str>: updates entries from a loc_resp.
+          returns the names that the model got wrong  
+        apply(str pack_type, tuple args) void: updates the model for a command sent to the
+          robot  
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Postconditions:  
+            the model knows nothing about the robot  
+        '''
+        self.entries = {}
+        self.uncertain = set()
+        self.multi = set()
+        self.complete = False
+        self.n_served = 0
+
+    def names(self):
+        '''
+        returns:  
+            list<str>: every container the model knows of, including those that were created
+              but have not been looked up yet  
+        '''
+        return list(self.entries.keys()) + [name for name in self.uncertain
+                if name not in self.entries]
+
+    def stale(self, wellnames):
+        '''
+        params:  
+            list<str> wellnames: names that are about to be looked up  
+        returns:  
+            list<str>: the wellnames that are unknown or uncertain  
+        '''
+        return [name for name in wellnames if name not in self.entries or
+                name in self.uncertain]
+
+    def sync(self, loc_resp, complete=False):
+        '''
+        params:  
+            list<tuple<str,str,int,float,float>> loc_resp: the payload of a loc_resp  
+            bool complete: True if loc_resp was for 'all'  
+        returns:  
+            list<str>: the names of entries that were certain, but did not match the robot  
+        Postconditions:  
+            the entries of loc_resp are up to date and certain  
+        '''
+        mismatched = []
+        for name, loc, deck_pos, vol, aspiratible_vol in loc_resp:
+            entry = (loc, deck_pos, vol, aspiratible_vol)
+            predicted = self.entries.get(name)
+            if predicted and name not in self.uncertain and (predicted[:2] != entry[:2] or
+                    not np.allclose(predicted[2:], entry[2:], atol=1e-6)):
+                mismatched.append(name)
+            self.entries[name] = entry
+            self.uncertain.discard(name)
+        self.complete = self.complete or complete
+        return mismatched
+
+    def _add_vol(self, name, vol):
+        '''
+        params:  
+            str name: the container  
+            float vol: the volume added. negative for aspirations  
+        '''
+        if name in self.entries:
+            loc, deck_pos, cont_vol, aspiratible_vol = self.entries[name]
+            self.entries[name] = (loc, deck_pos, cont_vol + vol, aspiratible_vol + vol)
+
+    def _aspirate(self, src, vol):
+        '''
+        params:  
+            str src: the source container  
+            float vol: the volume aspirated  
+        Postconditions:  
+            src is uncertain if the robot may not aspirate from the container it was in (a
+              multicontainer may move on to its next container), or if there isn't enough and
+              the robot will make more  
+        '''
+        if src not in self.entries:
+            return
+        loc, deck_pos, cont_vol, aspiratible_vol = self.entries[src]
+        if src in self.multi or aspiratible_vol < vol - 1e-9:
+            self.uncertain.add(src)
+        self._add_vol(src, -vol)
+
+    def apply(self, pack_type, args):
+        '''
+        params:  
+            str pack_type: the type of a command sent to the robot  
+            tuple args: the args of the command  
+        Postconditions:  
+            the model reflects the robot after the command has executed  
+        '''
+        if pack_type == 'init':
+            self.reset()
+            #reagent_df.reset_index().to_dict(). names with several containers are multis
+            names = pd.Series(args[5]['index'])
+            self.multi = set(names.loc[names.duplicated()])
+        elif pack_type == 'batch':
+            for sub_type, sub_args in args[0]:
+                self.apply(sub_type, sub_args)
+        elif pack_type == 'transfer':
+            src, transfer_steps = args[0], args[1]
+            distribute = len(args) > 2 and args[2]
+            self._aspirate(src, sum([vol for dst, vol in transfer_steps]))
+            if distribute and args[3]:
+                #the disposal volume is thrown out once per load
+                self.uncertain.add(src)
+            for dst, vol in transfer_steps:
+                self._add_vol(dst, vol)
+        elif pack_type == 'make':
+            self.uncertain.add('{}C{}'.format(args[0], args[1]))
+        elif pack_type == 'init_containers':
+            #product_df.to_dict() maps every column to a dict keyed by name
+            for name in next(iter(args[0].values())).keys():
+                self.uncertain.add(name)
+                self.multi.discard(name)
+
+class VolumeLedger():
+    '''
+    The volume of every container over the course of a protocol, computed in one pass over
+    the rxn_df. Volume changes only on transfers and dilutions. Each step dispenses its
+    product columns, and aspirates from its chemical_name: the sum of the row for a
+    transfer, and the reagent volume for a dilution (see Controller._get_dilution_transfer_vols).
+    The water of a dilution is aspirated from WaterC1.0.
+    If transfers are distributed, the robot also throws out disposal_vol with each load it
+    aspirates for a plain transfer (no callbacks) with more than one destination. A load
+    holds at least one destination, so the source is debited disposal_vol per destination.
+    That's an upper bound, so a source the ledger says is sufficient won't run dry.
+    Products start empty. Sources are tracked relative to whatever they start with, so their
+    volumes are usually negative  
+    ATTRIBUTES:  
+        df deltas: INDEX the index of rxn_df. COLS every product and source. the change in
+          volume of each container on each step  
+        np.array<float> disposals: the disposal volume debited from the source on each step  
+        df running: like deltas, but the volume of each container after each step  
+        pd.Series final: maps every product and source to its volume at the end of the
+          protocol  
+    METHODS:  
+        final_vols(list<str> names) pd.Series: the volume of each name at the end  
+        max_vols(list<str> names) pd.Series: the most each name ever holds  
+    '''
+    def __init__(self, rxn_df, products, disposal_vol=0.0):
+        '''
+        params:  
+            df rxn_df: a protocol df  
+            list<str> products: the product columns of rxn_df  
+            float disposal_vol: the disposal volume of distributed transfers. 0 if transfers
+              are not distributed  
+        '''
+        op = rxn_df['op']
+        transfers = (op == 'transfer').to_numpy()
+        dilutions = (op == 'dilution').to_numpy()
+        vols = rxn_df[products].to_numpy(dtype=float, copy=True)
+        vols[~(transfers | dilutions)] = 0
+        #a dilution's total volume is the first product it fills
+        filled = ~np.isclose(vols, 0, atol=1e-9)
+        dilution_vols = np.zeros(len(vols))
+        if vols.size:
+            dilution_vols[dilutions] = vols[np.arange(len(vols)), filled.argmax(axis=1)][dilutions]
+        vol_reagent = np.zeros(len(vols))
+        vol_reagent[dilutions] = dilution_vols[dilutions] * \
+                rxn_df['dilution_conc'].to_numpy(dtype=float)[dilutions] / \
+                rxn_df['conc'].to_numpy(dtype=float)[dilutions]
+        #see Controller._transfer_args for which transfers are distributed
+        distributed = transfers & (filled.sum(axis=1) > 1)
+        if 'callbacks' in rxn_df:
+            distributed &= ~rxn_df['callbacks'].fillna('').astype(bool).to_numpy()
+        self.disposals = np.where(distributed, filled.sum(axis=1) * disposal_vol, 0.0)
+        aspirations = np.where(transfers, vols.sum(axis=1), vol_reagent) + self.disposals
+        sources = rxn_df['chemical_name'].where(transfers | dilutions)
+        #charges each aspiration to the column of its source
+        aspirated = pd.get_dummies(sources, dtype=float).mul(aspirations, axis=0)
+        water = pd.DataFrame({'WaterC1.0':dilution_vols - vol_reagent}, index=rxn_df.index)
+        self.deltas = pd.DataFrame(vols, index=rxn_df.index, columns=products).sub(
+                aspirated, fill_value=0).sub(water, fill_value=0)
+        self.running = self.deltas.cumsum()
+        self.final = self.deltas.sum()
+
+    def final_vols(self, names):
+        '''
+        params:  
+            list<str> names: products or sources  
+        returns:  
+            pd.Series: maps each name to its volume at the end. 0 for names never used  
+        '''
+        return self.final.reindex(names, fill_value=0.0)
+
+    def max_vols(self, names):
+        '''
+        params:  
+            list<str> names: products or sources  
+        returns:  
+            pd.Series: maps each name to the most it holds after any step, or 0 if it never
+              holds anything  
+        '''
+        return self.running.max().clip(lower=0).reindex(names, fill_value=0.0)
+
 class Controller(ABC):
     '''
     This class is a shared interface for the ProtocolExecutor and the ______AI__Executor___  
@@ -168,8 +397,30 @@ class Controller(ABC):
         bool simulate: whether a simulation is being run or not. False by default. changed true 
           temporarily when simulating  
         int buff_size: this is the size of the buffer between Armchair commands. It's size
-          corresponds to the number of commands you want to pile up in the socket buffer.
-          Really more for developers  
+          corresponds to the maximum number of commands you want to pile up in the socket buffer.
+          The Armchair window adapts below this to the work queued on the robot (e.g. it won't
+          pile commands up behind a long pause). Really more for developers  
+        int batch_size: the maximum number of consecutive plain transfers and pauses that are
+          sent to the robot together as a single batch command. 1 turns batching off  
+        bool reorder_transfers: if True, plain transfers between barriers are reordered to
+          save tip changes before the protocol is run (see _reorder_transfers). False by
+          default, in which case the savings are only reported  
+        str record_path: if set, sessions with the real robot are recorded to this file so they
+          can be replayed later (see Armchair/replay.py). None by default  
+        ShadowDeck shadow_deck: the controller's model of the containers on the robot  
+        bool use_shadow_deck: if True, lookups are answered from shadow_deck when it is
+          certain, instead of with a loc_req. True by default  
+        int shadow_check_interval: every this many lookups answered from shadow_deck, the robot
+          is queried anyway to check the model  
+        SavePolicy save_policy: when the robot's files are shipped back during a run. A save is
+          made after every_n commands or every_t seconds, whichever comes first, and at every
+          barrier (scans, stops, close, and errors). Saves between barriers don't wait for the
+          files, which are recieved whenever they arrive  
+        df precheck_violations: every violation found by the last run of the prechecks, with
+          columns VIOLATION_COLS. severity 0 is reported only, 1 could run, and 2 is critical  
+        TransferParams transfer_params: from the header. distribute is True if multi step
+          transfers should aspirate once for many destinations, and disposal_vol is the extra
+          volume to aspirate with each load when distributing  
     PRIVATE ATTRS:  
         dict<str:ChemCacheEntry> _cached_reader_locs: chemical information from the robot
             ChemCacheEntry is a named tuple with below attributes
@@ -181,6 +432,11 @@ class Controller(ABC):
     CONSTANTS:  
         bidict<str:tuple<str,str>> PLATEREADER_INDEX_TRANSLATOR: used to translate from locs on
         wellplate to locs on the opentrons object. Use a json viewer for more structural info  
+        float TIP_CHANGE_TIME: rough seconds for the robot to change tips. Used for estimates  
+        namedtuple ProtocolCommand: a row of rxn_df compiled for execution. See
+          _compile_protocol  
+        list<str> COMMAND_COLS: the columns of rxn_df that are copied into a ProtocolCommand  
+        list<str> VIOLATION_COLS: the columns of precheck_violations  
     METHODS:  
         run_protocol(simulate, port) void: both args have good defaults. simulate can be used to
           simulate on the plate reader and robot, but generally you want false to actually run
@@ -201,6 +457,20 @@ class Controller(ABC):
 
     ChemCacheEntry = namedtuple('ChemCacheEntry',['loc','deck_pos','vol','aspirable_vol'])
     DilutionParams = namedtuple('DilultionParams', ['cont','vol'])
+    TransferParams = namedtuple('TransferParams', ['distribute','disposal_vol'])
+    SavePolicy = namedtuple('SavePolicy', ['every_n', 'every_t'])
+    TIP_CHANGE_TIME = 15 #rough seconds for the robot to drop and pick up tips
+    #i is the index of the row in rxn_df. products are the products with nonzero volume in the
+    #row (np.array<str>) and vols are those volumes (np.array<float>). callbacks is a list<str>.
+    #the rest are the columns of the same name, None if rxn_df doesn't have the column
+    COMMAND_COLS = ['op', 'chemical_name', 'reagent', 'conc', 'pause_time', 'dilution_conc',
+            'max_num_scans', 'scan_protocol', 'scan_filename', 'plot_protocol', 'plot_filename',
+            'message']
+    ProtocolCommand = namedtuple('ProtocolCommand', ['i', 'products', 'vols', 'callbacks'] +
+            COMMAND_COLS)
+    #a violation found by a precheck. row is the index in rxn_df (nan if not about one row),
+    #product is nan if not about one product, and severity is the error code of the violation
+    VIOLATION_COLS = ['check', 'row', 'product', 'severity', 'message']
 
     def __init__(self, rxn_sheet_name, my_ip, server_ip, buff_size=4, use_cache=False, cache_path='Cache'):
         '''
@@ -217,7 +487,22 @@ class Controller(ABC):
         self.use_cache = use_cache
         self.my_ip = my_ip
         self.server_ip = server_ip
-        self.buff_size = 4
+        self.buff_size = buff_size
+        self.batch_size = 16
+        self.reorder_transfers = False
+        self.record_path = None
+        self.shadow_deck = ShadowDeck()
+        self.use_shadow_deck = True
+        self.shadow_check_interval = 25
+        self.save_policy = self.SavePolicy(every_n=10, every_t=60.0)
+        self._n_unsaved = 0 #commands sent since the last save
+        self._last_save_time = time.monotonic()
+        #translates wellmaps in the background, in the order the saves arrived. One is started
+        #for each connection in init_robot and shut down in close_connection
+        self._save_worker = None
+        self._wellmap_translations = [] #futures of translations not yet waited on
+        self._pending_batch = [] #commands waiting to be sent in a batch
+        self.precheck_violations = pd.DataFrame(columns=self.VIOLATION_COLS)
         self.rxn_sheet_name = rxn_sheet_name
         self.simulate = False #by default will be changed if a simulation is run
         self._cached_reader_locs = {} #maps wellname to loc on platereader
@@ -263,8 +548,7 @@ class Controller(ABC):
         #if there are no total vols, don't insert the row, just return
         if self.tot_vols:
             end_vols = pd.Series(self.tot_vols)
-            start_vols = pd.Series([self._vol_calc(name) 
-                                    for name in end_vols.index], index=end_vols.index)
+            start_vols = VolumeLedger(self.rxn_df, self._products).final_vols(end_vols.index)
             del_vols = end_vols - start_vols
             #begin building a dictionary for the row to insert
             transfer_row_dict = {col:del_vols[col] if col in del_vols else np.nan 
@@ -502,6 +786,7 @@ class Controller(ABC):
         Postconditions:  
             simulate, using_temp_ctrl, and temp have been initialized according to values in 
             excel  
+            dilution_params and transfer_params have been initialized from the header  
         '''
         header_dict = {row[0]:row[1] for row in header_data[1:]}
         self.robo_params['using_temp_ctrl'] = header_dict['using_temp_ctrl'] == 'yes'
@@ -510,6 +795,9 @@ class Controller(ABC):
             assert( self.robo_params['temp'] >= 4 and self.robo_params['temp'] <= 95), "invalid temperature"
         self.dilution_params = self.DilutionParams(header_dict['dilution_cont'], 
                 float(header_dict['dilution_vol']))
+        #distribute and disposal_vol are optional, since older sheets don't have them
+        self.transfer_params = self.TransferParams(header_dict.get('distribute') == 'yes',
+                float(header_dict.get('disposal_vol') or 0))
 
     def _plot_setup_overlay(self,title):
         '''
@@ -777,14 +1065,69 @@ class Controller(ABC):
         labware_df['deck_pos'] = pd.to_numeric(labware_df['deck_pos'])
         return labware_df
 
-    def save(self):
-        self.portal.send_pack('save')
-        #server will initiate file transfer
-        files = self.portal.recv_ftp()
-        for filename, file_bytes in files:
-            with open(os.path.join(self.eve_files_path,filename), 'wb') as write_file:
-                write_file.write(file_bytes)
-        self.translate_wellmap()
+    def save(self, full=False, wait=True):
+        '''
+        has the robot ship its logs back. The robot only ships what was appended to each file
+        since the last save, and those deltas are appended to the copies in eve_files_path  
+        params:  
+            bool full: if True, the robot ships every file in full, replacing the local copies  
+            bool wait: if False, returns without waiting for the robot to get to the save. The
+              files are recieved by whatever reads from the portal next after they arrive, and
+              the wellmap is translated on a background worker  
+        Postconditions:  
+            if wait, eve_files_path has up to date copies of the robot's logs and
+              translated_wellmap.tsv has been updated  
+        '''
+        self._send('save', full)
+        self._n_unsaved = 0
+        self._last_save_time = time.monotonic()
+        if wait:
+            #server will initiate file transfer. Files are streamed straight into eve_files_path
+            files, stale = self.portal.recv_ftp(self.eve_files_path)
+            self._on_save_files(True, files, stale)
+            self._wait_for_translations()
+        else:
+            self.portal.recv_ftp_async(self.eve_files_path,
+                    functools.partial(self._on_save_files, False))
+
+    def _on_save_files(self, wait, files, stale):
+        '''
+        called once the files of a save have been recieved  
+        params:  
+            bool wait: the wait of the save  
+            list<tuple<str,str>> files: the files recieved (see Armchair.recv_ftp)  
+            list<str> stale: the files that could not be applied  
+        Postconditions:  
+            a resync has been requested if there were stale files. Otherwise the wellmap has
+              been queued for translation  
+        '''
+        if stale:
+            #our copies don't match what the robot thinks we have
+            print('<<controller>> local copies of {} are out of sync. Resyncing'.format(stale))
+            self.save(full=True, wait=wait)
+        else:
+            #read now, so that the worker isn't reading while the next save is written
+            with open(os.path.join(self.eve_files_path, 'wellmap.tsv'), 'rb') as wellmap:
+                self._wellmap_translations.append(self._save_worker.submit(
+                        self.translate_wellmap, wellmap.read()))
+
+    def _wait_for_translations(self):
+        '''
+        Postconditions:  
+            every queued wellmap translation has finished. Errors in them are raised  
+        '''
+        translations = self._wellmap_translations
+        self._wellmap_translations = []
+        for translation in translations:
+            translation.result()
+
+    def _save_on_policy(self):
+        '''
+        saves without waiting if save_policy says it's time to  
+        '''
+        if self._n_unsaved >= self.save_policy.every_n or \
+                time.monotonic() - self._last_save_time >= self.save_policy.every_t:
+            self.save(wait=False)
         
     def delete_wks_key(self):
         '''
@@ -805,18 +1148,28 @@ class Controller(ABC):
         Postconditions:    
             Log files have been written to self.out_path  
             Connection has been closed  
+            every wellmap translation has finished and the save worker has been shut down  
         '''
         
         print('<<controller>> initializing breakdown')
-        self.save()
-        #server should now send a close command
-        self.portal.send_pack('close')
+        try:
+            self.save()
+            #server should now send a close command
+            self._send('close')
+        finally:
+            #the save waits on its translations, but a failed save may have left some queued
+            if self._save_worker:
+                self._save_worker.shutdown(wait=True)
+                self._save_worker = None
+            self._wellmap_translations = []
         print('<<controller>> shutting down')
         self.portal.close()
         self.delete_wks_key()
         
-    def translate_wellmap(self):
+    def translate_wellmap(self, wellmap=None):
         '''
+        params:  
+            bytes wellmap: the contents of wellmap.tsv. Read from self.eve_files if None  
         Preconditions:  
             there exists a file wellmap.tsv in self.eve_files, and that file has eve level
             machine labels  
@@ -824,10 +1177,35 @@ class Controller(ABC):
             translated_wellmap.tsv has been created. translated is a copy of wellmap with   
             it's locations translated to human locs, but the labware pos remains the same  
         '''
-        df = pd.read_csv(os.path.join(self.eve_files_path,'wellmap.tsv'), sep='\t')
+        if wellmap is None:
+            df = pd.read_csv(os.path.join(self.eve_files_path,'wellmap.tsv'), sep='\t')
+        else:
+            df = pd.read_csv(io.BytesIO(wellmap), sep='\t')
         df['loc'] = df.apply(lambda r: r['loc'] if (r['deck_pos'] not in [4,7]) else self.PLATEREADER_INDEX_TRANSLATOR.inv[(r['loc'],'platereader'+str(r['deck_pos']))],axis=1)
         df.to_csv(os.path.join(self.eve_files_path,'translated_wellmap.tsv'),sep='\t',index=False)
 
+    def _open_portal(self, port, transport=None):
+        '''
+        connects to the robot  
+        params:  
+            int port: the port to connect to on self.server_ip  
+            Transport transport: if supplied, this is used instead of a socket (e.g. the end of
+              an in memory pipe to a simulated or stub robot)  
+        returns:  
+            Armchair: an Armchair connected to the robot. Only socket connections are recorded
+              to self.record_path, so simulations don't overwrite a real session. It logs to
+              Armchair_Logs in self.debug_path  
+        '''
+        record_path = None
+        if not transport:
+            sock = socket.socket(socket.AF_INET)
+            sock.connect((self.server_ip, port))
+            transport = BufferedSocket(sock, maxsize=1e9, timeout=None)
+            record_path = self.record_path
+        print("<<controller>> connected")
+        return Armchair(transport,'controller',os.path.join(self.debug_path, 'Armchair_Logs'),
+                buffsize=self.buff_size, adaptive=True, record_path=record_path)
+
     def init_robot(self, simulate):
         '''
         this does the dirty work of sending accumulated params over network to the robot  
@@ -836,9 +1214,10 @@ class Controller(ABC):
         Postconditions:  
             robot has been initialized with necessary params  
         '''
+        self._save_worker = ThreadPoolExecutor(max_workers=1)
         #send robot data to initialize itself
         #note reagent_df can have index with same name so index is reset for transfer
-        cid = self.portal.send_pack('init', simulate, 
+        cid = self._send('init', simulate, 
                 self.robo_params['using_temp_ctrl'], self.robo_params['temp'],
                 self.robo_params['labware_df'].to_dict(), self.robo_params['instruments'],
                 self.robo_params['reagent_df'].reset_index().to_dict(), self.my_ip,
@@ -866,6 +1245,9 @@ class Controller(ABC):
                 Eve threw error '{}'
                 Attempting to save state on exit
                 '''.format(eve_error))
+                if len(self.portal.error_payload) > 1:
+                    print('<<controller>> the error was in sub command {} of a batch'.format(
+                            self.portal.error_payload[1]))
                 self.portal.reset_error()
                 self.close_connection()
                 self.pr.shutdown()
@@ -1025,73 +1407,266 @@ class Controller(ABC):
                 + float max_vol: the maximum volume that will ever ocupy this container  
         '''
         products = products_to_labware.keys()
-        max_vols = [self._get_rxn_max_vol(product, products) for product in products]
+        ledger = VolumeLedger(self.rxn_df, self._products)
+        max_vols = [self._get_rxn_max_vol(product, ledger) for product in products]
         product_df = pd.DataFrame(products_to_labware, index=['labware','container']).T
         product_df['max_vol'] = max_vols
         return product_df
 
     @abstractmethod
-    def _get_rxn_max_vol(self, name, products):
+    def _get_rxn_max_vol(self, name, ledger):
         '''
         This needs to be implemented to as a helper for _get_product_df.
-        It calculates the maximum volume that a container will hold at a time
+        It calculates the maximum volume that a container will hold at a time  
+        params:  
+            str name: the product  
+            VolumeLedger ledger: the volumes of self.rxn_df  
         '''
         pass
 
     def execute_protocol_df(self):
         '''
-        takes a protocol df and sends every step to robot to execute  
-        params:  
-            int buff: the number of commands allowed in flight at a time  
+        compiles self.rxn_df and sends every step to robot to execute  
         Postconditions:  
             every step in the protocol has been sent to the robot  
         '''
-        for i, row in self.rxn_df.iterrows():
-            print("<<controller>> executing command {} of the protocol df with operation {}.".format(i+4, row['op'])) # added 4 to align with order in Gsheets
-            if row['op'] == 'transfer':
-                self._send_transfer_command(row,i)
-            elif row['op'] == 'pause':
-                cid = self.portal.send_pack('pause',row['pause_time'])
-            elif row['op'] == 'stop':
+        for cmd in self._compile_protocol(self.rxn_df):
+            i = cmd.i
+            print("<<controller>> executing command {} of the protocol df with operation {}.".format(i+4, cmd.op)) # added 4 to align with order in Gsheets
+            #runs of plain transfers and pauses are sent together in batches
+            if cmd.op == 'transfer' and not cmd.callbacks:
+                self._queue_command('transfer', *self._transfer_args(cmd.chemical_name,
+                        self._get_transfer_steps(cmd)))
+                continue
+            elif cmd.op == 'pause':
+                self._queue_command('pause', cmd.pause_time)
+                continue
+            #everything else has to happen after what's queued
+            self._flush_batch()
+            if cmd.op == 'transfer':
+                self._send_transfer_command(cmd,i)
+            elif cmd.op == 'stop':
                 self._stop(i)
-            elif row['op'] == 'scan':
-                self._execute_scan(row, i)
-            elif row['op'] == 'dilution':
-                self._send_dilution_commands(row, i)
-            elif row['op'] == 'mix':
-                self._mix(row, i)
-            elif row['op'] == 'make':
-                self._send_make(row, i)
-            elif row['op'] == 'save':
+            elif cmd.op == 'scan':
+                self._execute_scan(cmd, i)
+            elif cmd.op == 'dilution':
+                self._send_dilution_commands(cmd, i)
+            elif cmd.op == 'mix':
+                self._mix(cmd, i)
+            elif cmd.op == 'make':
+                self._send_make(cmd, i)
+            elif cmd.op == 'save':
                 self.save()
-            elif row['op'] == 'plot':
-                self._create_plot(row, i)
-            elif row['op'] == 'print':
-                self._execute_print(row,i)
-            elif row['op'] == 'scan_until_complete':
-                self._scan_until_complete(row,i)
+            elif cmd.op == 'plot':
+                self._create_plot(cmd, i)
+            elif cmd.op == 'print':
+                self._execute_print(cmd,i)
+            elif cmd.op == 'scan_until_complete':
+                self._scan_until_complete(cmd,i)
             else:
-                raise Exception('invalid operation {}'.format(row['op']))
+                raise Exception('invalid operation {}'.format(cmd.op))
+        self._flush_batch()
 
-    def _execute_print(self, row, i):
-        print(row['message'])
+    def _compile_protocol(self, rxn_df):
+        '''
+        compiles a protocol df into a list of commands. The product columns are read into a
+        single array, and each command holds only the products it touches, so handlers don't
+        need to slice pandas rows  
+        params:  
+            df rxn_df: a protocol df with product columns self._products  
+        returns:  
+            list<ProtocolCommand>: a command for each row of rxn_df in order  
+        '''
+        products = np.asarray(self._products, dtype=object)
+        vols = rxn_df[self._products].to_numpy(dtype=float)
+        nonzero = vols != 0
+        cols = [rxn_df[col].tolist() if col in rxn_df.columns else [None] * len(rxn_df)
+                for col in self.COMMAND_COLS]
+        callbacks = rxn_df['callbacks'].tolist()
+        commands = []
+        for j, i in enumerate(rxn_df.index):
+            row_callbacks = callbacks[j].replace(' ', '').split(',') if callbacks[j] else []
+            commands.append(self.ProtocolCommand(i, products[nonzero[j]], vols[j, nonzero[j]],
+                    row_callbacks, *[col[j] for col in cols]))
+        return commands
+
+    def _pipette_sources(self, cmd):
+        '''
+        params:  
+            ProtocolCommand cmd: a compiled row of self.rxn_df  
+        returns:  
+            list<str>: the chemicals the robot's tips will be dirtied with by this row, in order  
+        '''
+        if cmd.op == 'transfer':
+            return [cmd.chemical_name]
+        elif cmd.op == 'dilution':
+            return ['WaterC1.0', cmd.chemical_name]
+        elif cmd.op == 'mix':
+            return cmd.products.tolist()
+        return []
 
-    def _create_plot(self, row, i):
+    def _count_tip_changes(self, rxn_df):
+        '''
+        estimates the tip changes the robot will make running rxn_df. The robot swaps tips
+        whenever a tip is dirty with something other than water and the next source  
+        params:  
+            df rxn_df: a protocol df  
+        returns:  
+            int: the number of tip changes  
+        '''
+        n_changes = 0
+        last_used = 'clean'
+        for cmd in self._compile_protocol(rxn_df):
+            for src in self._pipette_sources(cmd):
+                if last_used not in ['clean', 'WaterC1.0', src]:
+                    n_changes += 1
+                last_used = src
+        return n_changes
+
+    def _order_transfer_run(self, rows, last_used):
+        '''
+        orders a run of plain transfer rows to group them by source. Rows that touch the same
+        product keep their order, as do rows where one transfers out of a product the other
+        transfers into  
+        params:  
+            list<ProtocolCommand> rows: the compiled rows of the run in sheet order  
+            str last_used: the chemical the tips are dirty with going into the run  
+        returns:  
+            list<int>: the positions (cmd.i) of the rows in the new order  
+            str: the chemical the tips are dirty with after the run  
+        '''
+        srcs = [cmd.chemical_name for cmd in rows]
+        dsts = [set(cmd.products) for cmd in rows]
+        #n_before[j] is the number of unscheduled rows that must go before j
+        n_before = [0] * len(rows)
+        after = [[] for row in rows]
+        for j in range(len(rows)):
+            for k in range(j):
+                if dsts[k] & dsts[j] or srcs[j] in dsts[k] or srcs[k] in dsts[j]:
+                    after[k].append(j)
+                    n_before[j] += 1
+        available = [j for j in range(len(rows)) if not n_before[j]]
+        order = []
+        while available:
+            #prefer rows that don't need a tip change, then water (which leaves tips usable),
+            #then whatever came first in the sheet
+            free = [j for j in available if last_used in ['clean', 'WaterC1.0', srcs[j]]]
+            same = [j for j in free if srcs[j] == last_used]
+            water = [j for j in free if srcs[j] == 'WaterC1.0']
+            j = min(same or water or free or available)
+            available.remove(j)
+            order.append(rows[j].i)
+            last_used = srcs[j]
+            for k in after[j]:
+                n_before[k] -= 1
+                if not n_before[k]:
+                    available.append(k)
+        return order, last_used
+
+    def _reorder_transfers(self):
+        '''
+        reorders the plain transfers (no callbacks) between barriers (every other operation) of
+        self.rxn_df so that transfers from the same source run together, and prints the
+        estimated tip changes and time saved. Row indices are kept, so messages still refer to
+        sheet rows. If not self.reorder_transfers, the savings are only reported  
+        Postconditions:  
+            self.rxn_df has been reordered if self.reorder_transfers  
+        '''
+        order = []
+        run = []
+        last_used = 'clean'
+        #rows split from one row share its index, so the rows are ordered by position
+        for cmd in self._compile_protocol(self.rxn_df.reset_index(drop=True)):
+            if cmd.op == 'transfer' and not cmd.callbacks:
+                run.append(cmd)
+                continue
+            run_order, last_used = self._order_transfer_run(run, last_used)
+            order += run_order
+            run = []
+            order.append(cmd.i)
+            for src in self._pipette_sources(cmd):
+                last_used = src
+        order += self._order_transfer_run(run, last_used)[0]
+        n_changes = self._count_tip_changes(self.rxn_df)
+        reordered = self.rxn_df.iloc[order]
+        n_saved = n_changes - self._count_tip_changes(reordered)
+        if self.reorder_transfers:
+            self.rxn_df = reordered
+            print('<<controller>> reordered transfers to save {} of {} tip changes (~{}s)'.format(
+                    n_saved, n_changes, n_saved * self.TIP_CHANGE_TIME))
+        elif n_saved:
+            print('<<controller>> reordering transfers would save {} of {} tip changes (~{}s). Set reorder_transfers to reorder'.format(
+                    n_saved, n_changes, n_saved * self.TIP_CHANGE_TIME))
+
+    def _send(self, pack_type, *args):
+        '''
+        sends a command to the robot. Every command is sent through here so that the shadow deck
+        can follow along, and so that the save policy is checked after every command  
+        params:  
+            str pack_type: the type of the command  
+            args*: the args of the command  
+        returns:  
+            int: the cid of the command  
+        '''
+        self.shadow_deck.apply(pack_type, args)
+        if pack_type not in Armchair.GHOST_TYPES:
+            self._n_unsaved += len(args[0]) if pack_type == 'batch' else 1
+        cid = self.portal.send_pack(pack_type, *args)
+        #init, stop, and close are barriers that manage their own saves. saves are ghosts
+        if pack_type not in Armchair.GHOST_TYPES + ['init', 'stop', 'close']:
+            self._save_on_policy()
+        return cid
+
+    def _queue_command(self, pack_type, *args):
+        '''
+        queues a command to be sent to the robot in the next batch. If the batch is full it is
+        sent  
+        params:  
+            str pack_type: the type of the command. Must be batchable on the robot  
+            args*: the args of the command  
+        Postconditions:  
+            the command has been added to self._pending_batch, or sent if the batch filled  
+        '''
+        self._pending_batch.append((pack_type, args))
+        if len(self._pending_batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        '''
+        sends all of the queued commands to the robot. If there is more than one, they are sent
+        as a single batch  
+        Postconditions:  
+            self._pending_batch is empty  
+        '''
+        if not self._pending_batch:
+            return
+        commands = self._pending_batch
+        self._pending_batch = []
+        if len(commands) == 1:
+            pack_type, args = commands[0]
+            self._send(pack_type, *args)
+        else:
+            self._send('batch', commands)
+
+    def _execute_print(self, cmd, i):
+        print(cmd.message)
+
+    def _create_plot(self, cmd, i):
         '''
         exectues a plot command  
         params:  
-            pd.Series row: a row of self.rxn_df  
+            ProtocolCommand cmd: a compiled row of self.rxn_df  
             int i: index of this row  
         '''
-        wellnames = row[self._products][row[self._products].astype(bool)].index
-        plot_type = row['plot_protocol']
-        filename = row['plot_filename']
+        wellnames = cmd.products.tolist()
+        plot_type = cmd.plot_protocol
+        filename = cmd.plot_filename
         #make sure you have mapping for all files
 
         self._update_cached_locs(wellnames)
         pr_dict = {self._cached_reader_locs[wellname].loc: wellname for wellname in wellnames}
         #it's not safe to plot in simulation because the scan file may not exist yet
-        df, metadata = self.pr.load_reader_data(row['scan_filename'], pr_dict)
+        df, metadata = self.pr.load_reader_data(cmd.scan_filename, pr_dict)
         #execute the plot depending on what was specified
         if plot_type == 'single_kin':
             for wellname in wellnames:
@@ -1130,38 +1705,41 @@ class Controller(ABC):
         reagent_info.rename(columns={'molar_mass (for dry only)': 'molar_mass'}, inplace=True)
         return reagent_info
 
-    def _send_make(self, row, i):
+    def _send_make(self, cmd, i):
         '''
         sends a make command to the robot  
         params:  
-            pd.Series row: a row of self.rxn_df  
+            ProtocolCommand cmd: a compiled row of self.rxn_df  
             int i: index of this row  
         '''
-        self.portal.send_pack('make', row['reagent'].replace(' ','_'), row['conc'])
+        self._send('make', cmd.reagent.replace(' ','_'), cmd.conc)
 
-    def _execute_scan(self,row,i):
+    def _execute_scan(self,cmd,i):
         '''
         There are a few things entailed in a scan command  
         1) send home to robot  
         2) block until you run out of waits  
         3) figure out what wells you want to scan  
-        4) query the robot for those wells, or use cache if you have it  
-            a) if you had to query robot, send request of reagents  
+        4) query the robot for those wells (always, never just the shadow deck)  
+            a) send request of reagents  
             b) wait on robot response  
             c) translate robot response to human readable  
         5) update layout to scanner and scan  
         params:  
-            pd.Series row: a row of self.rxn_df  
+            ProtocolCommand cmd: a compiled row of self.rxn_df  
             int i: index of this row  
         '''
         
         #1)
-        self.portal.send_pack('home')
+        self._send('home')
         #2)
         self.portal.burn_pipe()
+        #barrier. the platereader reads the robot's files, so bring them up to date
+        self.save()
         #3)
-        wellnames = row[self._products][row[self._products].astype(bool)].index
-        self._update_cached_locs(wellnames)
+        wellnames = cmd.products
+        #the layout goes into the scan data, so it must come from the robot, not the model
+        self._update_cached_locs(wellnames, force_sync=True)
         #4)
         #update the locs on the well
         well_locs = []
@@ -1171,52 +1749,82 @@ class Controller(ABC):
             well_locs.append(entry.loc)
         #5
         self.pr.exec_macro('PlateIn')
-        self.pr.run_protocol(row['scan_protocol'], row['scan_filename'], layout=well_locs)
+        self.pr.run_protocol(cmd.scan_protocol, cmd.scan_filename, layout=well_locs)
         self.pr.exec_macro('PlateOut')
 
-    def _update_cached_locs(self, wellnames):
+    def _update_cached_locs(self, wellnames, force_sync=False):
         '''
-        A query will be
-        made to Eve for the wellnames, and data for those will be stored in the cache  
+        Looks up the wellnames in the shadow deck. A query will be made to Eve for the wellnames
+        the shadow deck is unsure of (or all of them if use_shadow_deck is off, the model is
+        due to be checked, or force_sync), and data for those will be stored in the cache  
         params:  
-            listlike<str> wellnames: the names of the wells you want to lookup  
+            listlike<str>|str wellnames: the names of the wells you want to lookup, or 'all'  
+            bool force_sync: if True, the robot is always queried. Used when a wrong
+              prediction can't be caught later, e.g. the layout of a scan  
         Postconditions:  
             The wellnames are in the cache  
         '''
         if not isinstance(wellnames,str):
             #can't send pandas objects over socket for package differences on robot vs laptop
             wellnames = [wellname for wellname in wellnames]
-        #couldn't find in the cache, so we got to make a query
-        self.portal.send_pack('loc_req', wellnames)
-        pack_type, _, payload = self.portal.recv_pack()
-        assert (pack_type == 'loc_resp'), 'was expecting loc_resp but recieved {}'.format(pack_type)
-        returned_well_locs = payload[0]
+        if not self.use_shadow_deck or force_sync:
+            self._sync_shadow_deck(wellnames)
+        elif wellnames == 'all' and not self.shadow_deck.complete:
+            self._sync_shadow_deck('all')
+        else:
+            if wellnames == 'all':
+                wellnames = self.shadow_deck.names()
+            stale = self.shadow_deck.stale(wellnames)
+            if stale:
+                self._sync_shadow_deck(stale)
+            elif self.shadow_deck.n_served >= self.shadow_check_interval:
+                #checkpoint. validate the model against the robot
+                self._sync_shadow_deck(wellnames)
+            else:
+                self.shadow_deck.n_served += 1
+        if wellnames == 'all':
+            wellnames = self.shadow_deck.names()
         #update the cache
-        for well_entry in returned_well_locs:
-            if well_entry[2] in [4,7]:
+        for wellname in wellnames:
+            loc, deck_pos, vol, aspirable_vol = self.shadow_deck.entries[wellname]
+            if deck_pos in [4,7]:
                 #is on reader. Need to translate index
-                self._cached_reader_locs[well_entry[0]] = self.ChemCacheEntry(*(self.PLATEREADER_INDEX_TRANSLATOR.inv[(well_entry[1],'platereader{}'.format(well_entry[2]))],)+well_entry[2:])
-            else:
-                #not on reader, just use vanilla index
-                self._cached_reader_locs[well_entry[0]] = self.ChemCacheEntry(*well_entry[1:])
+                loc = self.PLATEREADER_INDEX_TRANSLATOR.inv[(loc,'platereader{}'.format(deck_pos))]
+            self._cached_reader_locs[wellname] = self.ChemCacheEntry(loc, deck_pos, vol,
+                    aspirable_vol)
+
+    def _sync_shadow_deck(self, wellnames):
+        '''
+        queries the robot for the wellnames and updates the shadow deck with the response  
+        params:  
+            list<str>|str wellnames: the names of the wells to query, or 'all'  
+        Postconditions:  
+            the shadow deck's entries for wellnames match the robot  
+        '''
+        self._send('loc_req', wellnames)
+        pack_type, _, payload = self.portal.recv_pack()
+        assert (pack_type == 'loc_resp'), 'was expecting loc_resp but recieved {}'.format(pack_type)
+        mismatched = self.shadow_deck.sync(payload[0], wellnames == 'all')
+        if mismatched:
+            print('<<controller>> shadow deck was wrong about {}. Resynced with the robot'.format(
+                    ', '.join(mismatched)))
+        self.shadow_deck.n_served = 0
 
-    def _mix(self,row,i):
+    def _mix(self,cmd,i):
         '''
         this method mixes everything on the platereader with a shake. it mixes other things
         by pipette
         params:  
-            pd.Series row: the row with the mix operation
+            ProtocolCommand cmd: the compiled row with the mix operation. vols are the mix codes
             index i: index of the row in the dataframe
         '''
-        wells_to_mix = row[self._products].loc[row[self._products].astype(bool)].astype(int)
-        wells_to_mix.name = 'mix_code'
-        self._update_cached_locs(wells_to_mix.index)
-        deck_poses = pd.Series({wellname:self._cached_reader_locs[wellname].deck_pos for 
-                wellname in wells_to_mix.index}, name='deck_pos', dtype=int)
-        wells_to_mix_df = pd.concat((wells_to_mix, deck_poses),axis=1)
-        #get platereader rows. true if pr
-        wells_to_mix_df['platereader'] = wells_to_mix_df['deck_pos'].apply(lambda x: x in [4,7]) 
-        if wells_to_mix_df['platereader'].sum() > 0:
+        mix_codes = cmd.vols.astype(int)
+        self._update_cached_locs(cmd.products)
+        deck_poses = np.array([self._cached_reader_locs[wellname].deck_pos for 
+                wellname in cmd.products], dtype=int)
+        #true if pr
+        on_platereader = np.isin(deck_poses, [4,7])
+        if on_platereader.any():
             #TODO technically, you could be mixing the other stuff by hand while you're mixing
             #the stuff in the reader, but if you miscalculated and accidently hand mix on the
             #platereader because of a bug, Mark will be mad, so apart for now. After testing
@@ -1224,30 +1832,28 @@ class Controller(ABC):
             #to multitask
 
             #at least one well nees a shake
-            self.portal.send_pack('home')
+            self._send('home')
             self.portal.burn_pipe() # can't be pulling plate in if you're still mixing
             self.pr.exec_macro('PlateIn')
-            if (row.loc[self._products] == 2).any():
+            if (mix_codes == 2).any():
                 self.pr.shake(60)
             else:
                 self.pr.shake(30)
             self.pr.exec_macro('PlateOut')
-        if (~wells_to_mix_df['platereader']).sum() > 0:
+        if not on_platereader.all():
             #at least one needs to be mixed by hand
-            #still df
-            hand_mix_wells = wells_to_mix_df.loc[~wells_to_mix_df['platereader']].reset_index()
-            #convert to list of tuples
-            hand_mix_wells = [tuple(t) for t in hand_mix_wells[['index','mix_code']].itertuples(index=False)]
-            self.portal.send_pack('mix', hand_mix_wells)
+            hand_mix_wells = list(zip(cmd.products[~on_platereader].tolist(),
+                    mix_codes[~on_platereader].tolist()))
+            self._send('mix', hand_mix_wells)
 
-    def _send_dilution_commands(self,row,i):
+    def _send_dilution_commands(self,cmd,i):
         '''
         used to execute a dilution. This is analogous to microcode. This function will send two
           commands. Water is always added first.
             transfer: transfer water into the container
             transfer: transfer reagent into the container  
         params:  
-            pd.Series row: a row of self.rxn_df  
+            ProtocolCommand cmd: a compiled row of self.rxn_df  
             int i: index of this row  
         Preconditions:  
             The buffer has room for at least one command  
@@ -1255,16 +1861,13 @@ class Controller(ABC):
             Two transfer commands have been sent to the robot to: 1) add water. 2) add reagent.  
             Will block on ready if the buffer is filled  
         '''
-        water_transfer_row, reagent_transfer_row = self._get_dilution_transfer_rows(row)
-        prod_transfer = reagent_transfer_row.loc[self._products].ne(0)
-        product_val = reagent_transfer_row[self._products][prod_transfer].index
-        mix_row = row.copy()
-        mix_row['op'] = 'mix'
-        mix_row.loc[product_val] = 2 
-        self._send_transfer_command(water_transfer_row, i)
-        self._send_transfer_command(reagent_transfer_row, i)
-        self._mix(mix_row,i)
-    def _get_dilution_transfer_rows(self, row):
+        water_transfer_cmd, reagent_transfer_cmd = self._get_dilution_transfer_commands(cmd)
+        mix_cmd = cmd._replace(op='mix', products=reagent_transfer_cmd.products,
+                vols=np.full(len(reagent_transfer_cmd.products), 2.0))
+        self._send_transfer_command(water_transfer_cmd, i)
+        self._send_transfer_command(reagent_transfer_cmd, i)
+        self._mix(mix_cmd,i)
+    def _get_dilution_transfer_commands(self, cmd):
         '''
         Takes in a dilution row and builds two transfer rows to be used by the transfer command.  
         This command will communicate with the robot to get the current deck position of the
@@ -1272,18 +1875,18 @@ class Controller(ABC):
         This is required because if that thing is on a temperature controller, ColdWater shall
         be used instead of Water.  
         params:  
-            pd.Series row: a row of self.rxn_df  
+            ProtocolCommand cmd: a compiled dilution row of self.rxn_df  
         returns:  
-            tuple<pd.Series>: rows to be passed to the send transfer command. water first, then
-              reagent
-              see self._construct_dilution_transfer_row for details  
+            tuple<ProtocolCommand>: rows to be passed to the send transfer command. water first,
+              then reagent
+              see self._construct_dilution_transfer_command for details  
             Note the second row (the reagent row) will have have whichever callbacks are passed.
         Preconditions:  
             robot has been initialized  
             Water or ColdWater is on the deck (depending on if this is on temperature module
             or not.  
         '''
-        reagent = row['chemical_name']
+        reagent = cmd.chemical_name
         #figure out if it is on temperature module
         self._update_cached_locs([reagent])
         deck_pos = self._cached_reader_locs[reagent].deck_pos
@@ -1291,61 +1894,55 @@ class Controller(ABC):
         #iloc is necessary because will give a series by default, but always has one element
         is_temp_cont = df.loc[df['deck_pos'] == deck_pos,'name'].iloc[0] == 'temp_mod_24_tube'
         water_src = 'ColdWaterC1.0' if is_temp_cont else 'WaterC1.0'
-        product_cols = row.loc[self._products]
-        dilution_name_vol = product_cols.loc[~product_cols.apply(lambda x: math.isclose(x,0,abs_tol=1e-9))]
         #TODO investigate if this works
         #assert (dilution_name_vol.size == 1), "Failure on row {} of the protocol. It seems you tried to dilute into multiple containers"
-        target_name = dilution_name_vol.index[0]
-        vol_water, vol_reagent = self._get_dilution_transfer_vols(row)
-        water_transfer_row = self._construct_dilution_transfer_row(water_src, target_name, vol_water)
-
-        reagent_transfer_row = self._construct_dilution_transfer_row(reagent, target_name, vol_reagent)
-        reagent_transfer_row['callbacks'] = row['callbacks'] #give the second row whatever callbacks you had
-        return water_transfer_row, reagent_transfer_row
-
-    def _get_dilution_transfer_vols(self, row):
+        target_name = cmd.products[~np.isclose(cmd.vols, 0, atol=1e-9)][0]
+        vol_water, vol_reagent = self._get_dilution_transfer_vols(cmd)
+        water_transfer_cmd = self._construct_dilution_transfer_command(cmd, water_src, target_name,
+                vol_water)
+        reagent_transfer_cmd = self._construct_dilution_transfer_command(cmd, reagent,
+                target_name, vol_reagent)
+        #give the second row whatever callbacks you had
+        reagent_transfer_cmd = reagent_transfer_cmd._replace(callbacks=cmd.callbacks)
+        return water_transfer_cmd, reagent_transfer_cmd
+
+    def _get_dilution_transfer_vols(self, cmd):
         '''
         calculates the amount of reagent volume needed for a dilution  
         params:  
-            float target_conc: the concentration desired at the end  
-            float reagent_conc: the concentration of the reagent  
-            float total_vol: the total volume requested  
+            ProtocolCommand cmd: a compiled dilution row. conc is the concentration of the
+              reagent, dilution_conc is the concentration desired at the end, and the volume of
+              the product is the total volume requested  
         returns:  
             tuple<float>: size 2
                 volume of water to transfer
                 volume of reagent to transfer  
         '''
-        reagent_conc = row['conc']
-        product_cols = row.loc[self._products]
-        dilution_name_vol = product_cols.loc[~product_cols.apply(lambda x: math.isclose(x,0,abs_tol=1e-9))]
-        total_vol = dilution_name_vol.iloc[0]
-        target_conc = row['dilution_conc']
+        reagent_conc = cmd.conc
+        total_vol = cmd.vols[~np.isclose(cmd.vols, 0, atol=1e-9)][0]
+        target_conc = cmd.dilution_conc
 
         mols_reagent = total_vol*target_conc #mols (not really mols if not milimolar. whatever)
         vol_reagent = mols_reagent/reagent_conc
         vol_water = total_vol - vol_reagent
         return vol_water, vol_reagent
 
-    def _construct_dilution_transfer_row(self, reagent_name, target_name, vol):
+    def _construct_dilution_transfer_command(self, cmd, reagent_name, target_name, vol):
         '''
-        The transfer command expects a nicely formated row of the rxn_df, so here we create a row
-        with everything in it to ship to the transfer command.  
+        The transfer command expects a compiled row of the rxn_df, so here we create one for a
+        step of a dilution to ship to the transfer command.  
         params:  
+            ProtocolCommand cmd: the dilution  
             str reagent_name: used as the chemical_name field  
-            str target_name: used as the product_name field  
+            str target_name: the only product  
             str vol: the volume to transfer  
         returns:  
-            pd.Series: has all the fields of a regular row, but only [chemical_name, target_name,
-              op] have been initialized. The other fields are empty/NaN  
-        '''
-        template = self.rxn_df.iloc[0].copy()
-        template[:] = np.nan
-        template[self._products] = 0.0
-        template['op'] = 'transfer'
-        template['chemical_name'] = reagent_name
-        template[target_name] = vol
-        template['callbacks'] = ''
-        return template
+            ProtocolCommand: a transfer of vol from reagent_name to target_name with no callbacks.
+              The other fields are those of the dilution  
+        '''
+        return cmd._replace(op='transfer', chemical_name=reagent_name,
+                products=np.array([target_name], dtype=object), vols=np.array([vol]),
+                callbacks=[])
 
     def _stop(self, i):
         '''
@@ -1355,36 +1952,93 @@ class Controller(ABC):
         Postconditions:  
             self._inflight_packs has been cleaned  
         '''
-        self.portal.send_pack('stop')
+        #barrier. bring the robot's files up to date for the user
+        self.save()
+        self._send('stop')
         pack_type, _, _ = self.portal.recv_pack()
         assert (pack_type == 'stopped'), "sent stop command and expected to recieve stopped, but instead got {}".format(pack_type)
         if not self.simulate:
             input("stopped on line {} of protocol. Please press enter to continue execution".format(i+1))
-        self.portal.send_pack('continue')
+        self._send('continue')
+
+    def _get_transfer_steps(self, cmd):
+        '''
+        params:  
+            ProtocolCommand cmd: a compiled transfer row of self.rxn_df  
+        returns:  
+            list<tuple<str,float>>: the products with nonzero volume in this row paired with the
+              volume to transfer into them  
+        '''
+        return list(zip(cmd.products.tolist(), cmd.vols.tolist()))
+
+    def _get_disposal_vol(self):
+        '''
+        returns:  
+            float: the volume the robot throws out with each load of a distributed transfer. 0
+              if transfers are not distributed  
+        '''
+        return self.transfer_params.disposal_vol if self.transfer_params.distribute else 0.0
+
+    def _check_source_vols(self):
+        '''
+        checks that every source has enough aspirable volume for everything that will be
+        aspirated from it, including the disposal volume of distributed transfers (see
+        VolumeLedger). Violations are reported like the prechecks, but don't stop the run, since
+        the robot can make more of some sources  
+        Preconditions:  
+            self._cached_reader_locs is up to date for every source  
+        returns:  
+            int found_errors: 1 if a source may run dry, else 0  
+        '''
+        ledger = VolumeLedger(self.rxn_df, self._products, self._get_disposal_vol())
+        sources = [name for name in ledger.final.index if name not in self._products and
+                name in self._cached_reader_locs]
+        needed = -ledger.final_vols(sources)
+        disposals = pd.Series(ledger.disposals, index=self.rxn_df.index).groupby(
+                self.rxn_df['chemical_name']).sum().reindex(sources, fill_value=0.0)
+        available = pd.Series([self._cached_reader_locs[name].aspirable_vol
+                for name in sources], index=sources, dtype=float)
+        short = needed.loc[needed > available + 1e-9].index
+        return self._report_violations([self._make_violations('check_source_vols',
+                [np.nan]*len(short), 1,
+                "{product} needs {needed:.1f}uL ({disposal:.1f}uL of it disposal volume), but only {available:.1f}uL is aspirable. It may run dry",
+                products=short, needed=needed[short], disposal=disposals[short],
+                available=available[short])])
+
+    def _transfer_args(self, src, transfer_steps):
+        '''
+        params:  
+            str src: the chemical name of the source  
+            list<tuple<str,float>> transfer_steps: the dst, vol pairs  
+        returns:  
+            tuple: the arguments of a transfer pack. The distribute options from the header are
+              added if distributing and there is more than one destination  
+        '''
+        if self.transfer_params.distribute and len(transfer_steps) > 1:
+            return (src, transfer_steps, True, self.transfer_params.disposal_vol)
+        return (src, transfer_steps)
 
-    def _send_transfer_command(self, row, i):
+    def _send_transfer_command(self, cmd, i):
         '''
         params:  
-            pd.Series row: a row of self.rxn_df
-              uses the chemical_name, callbacks (and associated args), product_columns  
+            ProtocolCommand cmd: a compiled row of self.rxn_df
+              uses the chemical_name, callbacks (and associated args), products  
             int i: index of this row  
         Postconditions:  
             a transfer command has been sent to the robot  
         '''
-        src = row['chemical_name']
-        containers = row[self._products].loc[row[self._products] != 0]
-        transfer_steps = [name_vol_pair for name_vol_pair in containers.iteritems()]
-        #temporarilly just the raw callbacks
-        callbacks = row['callbacks'].replace(' ', '').split(',') if row['callbacks'] else []
+        src = cmd.chemical_name
+        transfer_steps = self._get_transfer_steps(cmd)
+        callbacks = cmd.callbacks
         if callbacks:
             #if there were callbacks, you must send transfer one at a time, breaking up into
             #iterate through each transfer_step we're doing.
             for callback_num, transfer_step in enumerate(transfer_steps):
                 #send just that transfer step
-                self.portal.send_pack('transfer', src, [transfer_step])
+                self._send('transfer', src, [transfer_step])
                 #then send a callback for each callback you've got 
                 for callback in callbacks:
-                    self._send_callback(callback, transfer_step[0], callback_num, row, i)
+                    self._send_callback(callback, transfer_step[0], callback_num, cmd, i)
 
             #merge all the scans into a single file if there were any scans
             #get the names of all the scan files
@@ -1396,15 +2050,13 @@ class Controller(ABC):
                 return first + second
             
             if 'scan' in callbacks:
-                dst = row['scan_filename'] #also the base name for all files to be merged
+                dst = cmd.scan_filename #also the base name for all files to be merged
                 scan_names = ['{}-{}'.format(dst, getPair(i)) for i in range(len(transfer_steps))] 
                 self.pr.merge_scans(scan_names, dst)
         else:
-            self.portal.send_pack('transfer', src, transfer_steps)
-        
-        self.save()
+            self._send('transfer', *self._transfer_args(src, transfer_steps))
 
-    def _send_callback(self, callback, product, callback_num, row, i):
+    def _send_callback(self, callback, product, callback_num, cmd, i):
         '''
         This method is used to send (or execute) a single callback.  
         params:  
@@ -1413,7 +2065,8 @@ class Controller(ABC):
               scan row.  
             int callback_num: the number of the callback. i.e. 0 if this is the first transfer,
               1 if second, etc. If multiple callbacks, they will all be 0 for a product
-            pd.Series row: the row of this operation. (used to extract metaparameters)  
+            ProtocolCommand cmd: the compiled row of this operation. (used to extract
+              metaparameters)  
             int i: the index of this command in rxn_df. This will be the same for all the
               callbacks of a single transfer.  
         Postconditions:  
@@ -1432,22 +2085,17 @@ class Controller(ABC):
         if callback == 'stop':
             self._stop(i)
         if callback == 'pause':
-            self.portal.send_pack('pause',row['pause_time'])
+            self._send('pause',cmd.pause_time)
         if callback == 'scan':
-            template = row.copy()
-            template.loc[self._products] = 0 
-            template.loc[product] = 1
-            template['op'] = 'scan'
             #rename the scans with the callback_alph appended
-            template['scan_filename'] = '{}-{}'.format(template['scan_filename'], callback_alph)
+            template = cmd._replace(op='scan', products=np.array([product], dtype=object),
+                    vols=np.ones(1), scan_filename='{}-{}'.format(cmd.scan_filename, callback_alph))
             #note that there will be some miscellaneous crap left in the row, but shouldn't affect
             #the scan
             self._execute_scan(template, i_ext)
         if callback == 'mix':
-            template = row.copy()
-            template.loc[self._products] = 0
-            template.loc[product] = 1
-            template['op'] = 'mix'
+            template = cmd._replace(op='mix', products=np.array([product], dtype=object),
+                    vols=np.ones(1))
             self._mix(template, i_ext)
     
     def _get_chemical_name(self,row):
@@ -1472,6 +2120,8 @@ class Controller(ABC):
         '''
         runs all checks on a rxn_df converted to volumes.  
         This code will probably be overridden by children of this class to add more checks.  
+        Postconditions:  
+            self.precheck_violations holds every violation found by the rxn_df checks  
         returns:  
             int found_errors:  
                 code:  
@@ -1479,6 +2129,7 @@ class Controller(ABC):
                 1: Some Errors, but could run  
                 2: Critical. Abort  
         '''
+        self.precheck_violations = pd.DataFrame(columns=self.VIOLATION_COLS)
         found_errors = 0
         found_errors = max(found_errors, self.check_rxn_df())
         found_errors = max(found_errors, self.check_labware())
@@ -1487,6 +2138,47 @@ class Controller(ABC):
         found_errors = max(found_errors,self.check_conc())
         return found_errors
 
+    def _make_violations(self, check, rows, severity, message, products=None, **cols):
+        '''
+        params:  
+            str check: the name of the check that found the violations  
+            iterable<obj> rows: the index in rxn_df of each violation. nan if the violation is
+              not about a single row  
+            int severity: the error code of these violations. 0 is reported only, 1 could
+              run, and 2 is critical  
+            str message: formatted for each violation with row (the index), r_num (the row
+              number, index + 1), product, and the keys of cols  
+            iterable<str> products: the product of each violation if it's about a product  
+            iterable<obj> **cols: any other values to format message with. one per violation  
+        returns:  
+            df: a violation for each row with columns VIOLATION_COLS  
+        '''
+        rows = list(rows)
+        products = [np.nan]*len(rows) if products is None else list(products)
+        cols = {key:list(val) for key, val in cols.items()}
+        messages = [message.format(row=row, r_num=np.nan if pd.isna(row) else row+1,
+                product=product, **{key:val[j] for key, val in cols.items()})
+                for j, (row, product) in enumerate(zip(rows, products))]
+        return pd.DataFrame({'check':[check]*len(rows), 'row':rows, 'product':products,
+                'severity':[severity]*len(rows), 'message':messages},
+                columns=self.VIOLATION_COLS)
+
+    def _report_violations(self, violations):
+        '''
+        prints violations in row order and adds them to self.precheck_violations  
+        params:  
+            list<df> violations: violations from _make_violations  
+        returns:  
+            int found_errors: the highest severity of the violations. 0 if there were none  
+        '''
+        violations = pd.concat(violations, ignore_index=True).sort_values('row',
+                kind='mergesort', na_position='first')
+        for message in violations['message']:
+            print('<<controller>> {}'.format(message))
+        self.precheck_violations = pd.concat([self.precheck_violations, violations],
+                ignore_index=True)
+        return int(violations['severity'].max()) if not violations.empty else 0
+
     def check_labware(self):
         '''
         checks to ensure that the labware has been correctly initialized  
@@ -1547,7 +2239,8 @@ class Controller(ABC):
         '''
         Runs error checks on the reaction df to ensure that formating is correct. Illegal/Ill 
         Advised options are printed and if an error code is returned
-        Will run through and check all rows, even if errors are found
+        Will run through and check all rows, even if errors are found. Each check is a mask
+        over the whole df, and every violation is added to self.precheck_violations  
         returns  
             int found_errors:  
                 code:  
@@ -1555,71 +2248,86 @@ class Controller(ABC):
                 1: Some Errors, but could run  
                 2: Critical. Abort  
         '''
-        found_errors = 0
-        if self.rxn_df.loc[self.rxn_df['op']=='scan']['scan_filename'].duplicated().sum() > 0:
-            print("<<controller>> Multiple scans use same filename. It will be overwritten. Do you wish to proceed?")
-            found_errors = max(found_errors, 1)
-        if self.rxn_df.loc[self.rxn_df['op']=='plot']['plot_filename'].duplicated().sum() > 0:
-            print("<<controller>> Multiple plots use same filename. They will be overwritten. Do you wish to proceed?")
-            found_errors = max(found_errors, 1)
-        for i, r in self.rxn_df.iterrows():
-            r_num = i+1
-            #check pauses
-            if (not ('pause' in r['op'] or 'pause' in r['callbacks'] or r['op'] == 'scan_until_complete')) == (not pd.isna(r['pause_time'])):
-                print("<<controller>> You asked for a pause in row {}, but did not specify the pause_time or vice versa".format(r_num))
-                found_errors = max(found_errors, 2)
-            #check that there's always a volume when you transfer
-            if (r['op'] == 'transfer' and math.isclose(r[self._products].sum(), 0,abs_tol=1e-9)):
-                print("<<controller>> You executed a transfer step in row {}, but you did not transfer any volume.".format(r_num))
-                found_errors = max(found_errors, 1)
-            #check that you have a reagent if you're transfering
-            if r['op'] == 'transfer' and pd.isna(r['reagent']):
-                print('<<controller>> transfer specified without reagent in row {}'.format(r_num))
-                found_errors = max(found_errors,2)
-            #check that scans have a scan file
-            if (r['op'] == 'scan' or 'scan' in r['callbacks']) and pd.isna(r['scan_filename']):
-                print('<<controller>> scan without scan filename in row {}'.format(r_num))
-                found_errors = max(found_errors,2)
-            #check no multiple scans on one callback
-            callbacks = r['callbacks'].replace(' ', '').split(',')
-            if 'scan' in callbacks:
-                callbacks.remove('scan')
-                if 'scan' in callbacks:
-                    print('<<controller>> multiple scans in a callback on line {}'.format(r_num))
-                    found_errors = max(found_errors,2)
-            #check that plots have scans
-            if r['op'] == 'plot':
-                if pd.isna(r['scan_filename']):
-                    print("<<controller>> please specify a scan filename in row '{}'".format(r_num))
-                    found_errors = max(found_errors,2)
-                if pd.isna(r['plot_filename']):
-                    print("<<controller>> please specify a plot filename in row '{}'".format(r_num))
-                    found_errors = max(found_errors,2)
-                rows_above = self.rxn_df.loc[:i,:]
-                scan_rows = rows_above.loc[(rows_above['scan_filename'] == r['scan_filename']) &\
-                        ((rows_above['op'] == 'scan')| (rows_above['op'] == 'scan_until_complete'))]
-                
-                
-                if scan_rows.empty:
-                        print("<<controller>> row {} plots using nonexistent scan file\
-                                ".format(r_num))
-                        found_errors = max(found_errors, 2)
-                else:
-                    last_scan_row = scan_rows.iloc[-1,:]
-                    last_scan_products = last_scan_row[self._products]
-                    scanned_products=last_scan_products.loc[last_scan_products.astype(bool)].index
-                    scanned_products = set(scanned_products)
-                    plotted_products = r[self._products]
-                    plotted_products = set(plotted_products[plotted_products.astype(bool)])
-                    if plotted_products.issubset(scanned_products):
-                        print("<<controller>> row {} plots products that have not been scanned\
-                        ".format(r_num))
-                        found_errors = max(found_errors, 2)
-        return found_errors
+        check = 'check_rxn_df'
+        rxn_df = self.rxn_df
+        op = rxn_df['op']
+        scan_filename = rxn_df['scan_filename']
+        callbacks = rxn_df['callbacks'].fillna('').str.replace(' ', '')
+        #counts the callbacks that are exactly 'scan'/'pause', not just containing them
+        n_scan_callbacks = callbacks.str.count(r'(?<![^,])scan(?![^,])')
+        has_pause_callback = callbacks.str.contains(r'(?<![^,])pause(?![^,])')
+        nonzero = rxn_df[self._products].to_numpy(dtype=float) != 0
+        violations = []
+        #check duplicate filenames
+        scans = op == 'scan'
+        scan_dups = scans & scan_filename.where(scans).duplicated() & scan_filename.notna()
+        violations.append(self._make_violations(check, rxn_df.index[scan_dups], 1,
+                "Multiple scans use same filename, {scan_filename}. It will be overwritten. Do you wish to proceed?",
+                scan_filename=scan_filename[scan_dups]))
+        plots = op == 'plot'
+        plot_filename = rxn_df['plot_filename']
+        plot_dups = plots & plot_filename.where(plots).duplicated() & plot_filename.notna()
+        violations.append(self._make_violations(check, rxn_df.index[plot_dups], 1,
+                "Multiple plots use same filename, {plot_filename}. They will be overwritten. Do you wish to proceed?",
+                plot_filename=plot_filename[plot_dups]))
+        #check pauses
+        wants_pause = op.str.contains('pause', na=False) | has_pause_callback | \
+                (op == 'scan_until_complete')
+        bad_pause = wants_pause == rxn_df['pause_time'].isna()
+        violations.append(self._make_violations(check, rxn_df.index[bad_pause], 2,
+                "You asked for a pause in row {r_num}, but did not specify the pause_time or vice versa"))
+        #check that there's always a volume when you transfer
+        transfers = op == 'transfer'
+        no_vol = transfers & (np.abs(rxn_df[self._products].to_numpy(dtype=float).sum(axis=1))
+                <= 1e-9)
+        violations.append(self._make_violations(check, rxn_df.index[no_vol], 1,
+                "You executed a transfer step in row {r_num}, but you did not transfer any volume."))
+        #check that you have a reagent if you're transfering
+        no_reagent = transfers & rxn_df['reagent'].isna()
+        violations.append(self._make_violations(check, rxn_df.index[no_reagent], 2,
+                'transfer specified without reagent in row {r_num}'))
+        #check that scans have a scan file
+        no_scan_file = (scans | (n_scan_callbacks > 0)) & scan_filename.isna()
+        violations.append(self._make_violations(check, rxn_df.index[no_scan_file], 2,
+                'scan without scan filename in row {r_num}'))
+        #check no multiple scans on one callback
+        multi_scan = n_scan_callbacks > 1
+        violations.append(self._make_violations(check, rxn_df.index[multi_scan], 2,
+                'multiple scans in a callback on line {r_num}'))
+        #check that plots have filenames
+        violations.append(self._make_violations(check, rxn_df.index[plots & scan_filename.isna()], 2,
+                "please specify a scan filename in row '{r_num}'"))
+        violations.append(self._make_violations(check, rxn_df.index[plots & plot_filename.isna()], 2,
+                "please specify a plot filename in row '{r_num}'"))
+        #check that plots have scans. Each plot is matched to the last scan to its file before it
+        pos = np.arange(len(rxn_df))
+        scan_rows = (op.isin(['scan', 'scan_until_complete']) & scan_filename.notna()).to_numpy()
+        plot_rows = (plots & scan_filename.notna()).to_numpy()
+        #keys are object on both sides. An empty side would otherwise infer a different dtype
+        last_scans = pd.merge_asof(
+                pd.DataFrame({'pos':pos[plot_rows],
+                        'scan_filename':pd.Series(scan_filename[plot_rows].to_numpy(), dtype=object)}),
+                pd.DataFrame({'scan_pos':pos[scan_rows],
+                        'scan_filename':pd.Series(scan_filename[scan_rows].to_numpy(), dtype=object)}),
+                left_on='pos', right_on='scan_pos', by='scan_filename')
+        matched = last_scans['scan_pos'].notna().to_numpy()
+        has_scan = np.zeros(len(rxn_df), dtype=bool)
+        has_scan[pos[plot_rows][matched]] = True
+        violations.append(self._make_violations(check, rxn_df.index[plots.to_numpy() & ~has_scan],
+                2, "row {r_num} plots using nonexistent scan file"))
+        plot_pos = last_scans['pos'].to_numpy()[matched]
+        scan_pos = last_scans['scan_pos'].to_numpy()[matched].astype(int)
+        unscanned = (nonzero[plot_pos] & ~nonzero[scan_pos]).any(axis=1)
+        violations.append(self._make_violations(check, rxn_df.index[plot_pos[unscanned]], 2,
+                "row {r_num} plots products that have not been scanned"))
+        return self._report_violations(violations)
 
     def check_tot_vol(self):
         '''
-        This check ensures that the inserted total volume row does not contain negative floats.
+        This check ensures that the inserted total volume row does not contain negative floats,
+        and that products with a total volume are not changed after they're scanned, diluted,
+        or used as a reagent. Transfers after a scan are found with a cumulative max of the scan
+        positions of each product
         returns:  
             int found_errors:  
                 code:  
@@ -1627,68 +2335,53 @@ class Controller(ABC):
                 1: Some Errors, but could run  
                 2: Critical. Abort  
         '''        
-        found_errors = 0;
-        
+        check = 'check_tot_vol'
+        rxn_df = self.rxn_df
+        op = rxn_df['op'].to_numpy()
+        tot_vols = pd.Series(self.tot_vols, dtype=float)
+        violations = []
         #checks for negative input in tot_vol rows
-        for key,val in self.tot_vols.items():
-            product_volumes = self.rxn_df[key]
-            if val < 0:
-                print("<<controller>> Error in total volume row: value " + str(val) + " is negative. We cannot have negative values as input.")
-                found_errors = max(found_errors,2)
-            
-        #checks for scan errors
-        check_scan = self.rxn_df.loc[(self.rxn_df['op'] == 'scan')]
+        negative = tot_vols.loc[tot_vols < 0]
+        violations.append(self._make_violations(check, [np.nan]*len(negative), 2,
+                "Error in total volume row: value {val} is negative. We cannot have negative values as input.",
+                products=negative.index, val=negative))
         #make sure if you're scanning you have a total volume
-        cols_w_scans = check_scan[self._products].astype(int).any() #bool arr if product is scaned
-        cols_w_scans = cols_w_scans.loc[cols_w_scans].index #just the cols that are scanned
-        for col in cols_w_scans:
-            if col not in self.tot_vols:
-                print("<<controller>> {} is scanned, but does not have a specified total volume. Will be scanned at whatever volume it has at the time of scan.".format(col))
-                found_errors = max(found_errors,1)
-        #check more scan issues
-        first_scans_i = check_scan[check_scan.eq(check_scan.max(1),0)&check_scan.ne(0)].stack()   
-        scan_products = []
-        #Creates list for products that have scans
-        for prod in self.tot_vols.keys():
-            for sc in  first_scans_i.index:
-                if prod == sc[1]:
-                    scan_products.append([prod,sc[0]])  
-        #checks if all transfers happen before scan
-        for products in scan_products:
-            specific_prod = self.rxn_df[products[0]]
-            scan_index = products[1]
-            while (scan_index < len(specific_prod)):
-                if self.rxn_df['op'][scan_index] == 'transfer' and specific_prod[scan_index] != 0:
-                    print("<<controller>> Error in product: " +str(products[0]) +" in index: " +str(scan_index) + ", cannot make transfers after scan when total volume column is specified.")
-                    found_errors = max(found_errors,2)
-                    break
-                else:
-                    scan_index +=1
-                
+        scans = op == 'scan'
+        scanned = rxn_df.loc[scans, self._products].ne(0).any()
+        no_tot_vol = scanned.loc[scanned & ~scanned.index.isin(tot_vols.index)].index
+        violations.append(self._make_violations(check, [np.nan]*len(no_tot_vol), 1,
+                "{product} is scanned, but does not have a specified total volume. Will be scanned at whatever volume it has at the time of scan.",
+                products=no_tot_vol))
+        #the rest only concerns products with a total volume
+        tot_vol_products = np.asarray([prod for prod in self._products if prod in self.tot_vols],
+                dtype=object)
+        nonzero = rxn_df[tot_vol_products].to_numpy(dtype=float) != 0
+        #checks if all transfers happen before scan. last_scan is the position of the last scan of
+        #each product at or before each row, -1 if it hasn't been scanned yet
+        pos = np.arange(len(rxn_df))[:, np.newaxis]
+        last_scan = np.maximum.accumulate(np.where(scans[:, np.newaxis] & nonzero, pos, -1),
+                axis=0) if len(rxn_df) else np.empty(nonzero.shape, dtype=int)
+        rows, cols = np.nonzero((op == 'transfer')[:, np.newaxis] & nonzero & (last_scan >= 0))
+        violations.append(self._make_violations(check, rxn_df.index[rows], 2,
+                "Error in product: {product} in index: {row}, cannot make transfers after scan when total volume column is specified.",
+                products=tot_vol_products[cols]))
         #check for illegal dilutions in total vol
-        check_dilutions = self.rxn_df.loc[(self.rxn_df['op'] == 'dilution')]
-        check_dilutions_name = self.rxn_df.loc[(self.rxn_df['op'] == 'dilution'),'chemical_name']
-        first_dilutions_i = check_dilutions[check_dilutions.eq(check_dilutions.max(1),0)&check_dilutions.ne(0)].stack()
-        for prod in self.tot_vols.keys():
-            for dil in first_dilutions_i.index:
-                if prod == dil[1]:
-                    print("<<controller>> Error in product: " + str(prod) + " in index: " +str(dil[0]) + ", cannot dilute products that have a given total volume")
-                    found_errors = max(found_errors,2)
-                    break
+        rows, cols = np.nonzero((op == 'dilution')[:, np.newaxis] & nonzero)
+        violations.append(self._make_violations(check, rxn_df.index[rows], 2,
+                "Error in product: {product} in index: {row}, cannot dilute products that have a given total volume",
+                products=tot_vol_products[cols]))
         #checks for dilutions in reagent slot--illegal!
-        for idx,dil_prod in enumerate(check_dilutions_name):
-            if dil_prod in self.tot_vols.keys():
-                print("<<controller>> Error in reagent row index "+str(idx) +" with product "+  str(dil_prod) + ": cannot have dilutions out of product with total volume specified.")
-                found_errors = max(found_errors,2)
-                
+        from_tot_vol = rxn_df['chemical_name'].isin(tot_vols.index).to_numpy()
+        rows = rxn_df.index[(op == 'dilution') & from_tot_vol]
+        violations.append(self._make_violations(check, rows, 2,
+                "Error in reagent row index {row} with product {product}: cannot have dilutions out of product with total volume specified.",
+                products=rxn_df.loc[rows, 'chemical_name']))
         #Checks reagents to see if there is a transfer that transfers a product with tot_vol
-        check_transfer = self.rxn_df.loc[(self.rxn_df['op'] == 'transfer'),'chemical_name']
-        for idx,trans_prod in enumerate(check_transfer):
-            if trans_prod in self.tot_vols.keys():
-                print("<<controller>> Error in reagent row index "+str(idx) +" with product "+  str(trans_prod) + ": cannot have transfer out of product with total volume specified.")
-                found_errors= max(found_errors,2)
-        
-        return found_errors 
+        rows = rxn_df.index[(op == 'transfer') & from_tot_vol]
+        violations.append(self._make_violations(check, rows, 2,
+                "Error in reagent row index {row} with product {product}: cannot have transfer out of product with total volume specified.",
+                products=rxn_df.loc[rows, 'chemical_name']))
+        return self._report_violations(violations)
 
     def _get_transfer_container(self,reagent,molarity,total_vol,ratio=1.0):
         '''
@@ -1698,7 +2391,7 @@ class Controller(ABC):
         from a number of containers that may hold that reagent at different concentations.
         There are a number of ways to optimize which container should be chosen. This 
         algorithm will always take the most concentrated solution unless there is not sufficient
-        volume, or the volume that would be required to pipette is less than the minimum
+        volume (including a disposal volume if transfers are distributed), or the volume that would be required to pipette is less than the minimum
         pipettable volume. defined here as 2uL.  
         params:  
             str reagent: the name of the reagent that you are searching for a container for  
@@ -1728,7 +2421,8 @@ class Controller(ABC):
             vol = self._get_transfer_vol(cont,molarity,total_vol,ratio)
             if vol > min_vol:
                 filtered_conts.append(cont)
-                if vol < self._cached_reader_locs[cont].aspirable_vol:
+                #if distributed, the transfer may cost a disposal volume as well
+                if vol + self._get_disposal_vol() < self._cached_reader_locs[cont].aspirable_vol:
                     return cont, vol
         raise ConversionError(reagent, molarity, total_vol, ratio, filtered_conts)
 
@@ -1793,30 +2487,6 @@ class Controller(ABC):
         vol = molarity * (total_vol*ratio) / conc
         return vol
         
-    def _vol_calc(self, name):
-        '''
-        calculates the total volume of a column at the end of rxn  
-        params:
-            str name: chem_name
-        returns:
-            volume at end in that name
-        '''
-        dispenses = self.rxn_df.loc[(self.rxn_df['op'] == 'dilution') |
-                (self.rxn_df['op'] == 'transfer')][name].sum()
-        transfer_aspirations = self.rxn_df.loc[(self.rxn_df['op']=='transfer') &\
-                (self.rxn_df['chemical_name'] == name),self._products].sum().sum()
-        dilution_rows = self.rxn_df.loc[(self.rxn_df['op']=='dilution') &\
-                (self.rxn_df['chemical_name'] == name),:]
-        def calc_dilution_vol(row):
-            return self._get_dilution_transfer_vols(row)[1]
-
-        if dilution_rows.empty:
-            dilution_aspirations = 0.0
-        else:
-            dilution_vols = dilution_rows.apply(lambda r: calc_dilution_vol(r),axis=1)
-            dilution_aspirations = dilution_vols.sum()
-        return dispenses - transfer_aspirations - dilution_aspirations
-    
     def _get_conc(self, chem_name):
         '''
         handy method for getting the concentration from a chemical name  
@@ -1880,7 +2550,7 @@ class Controller(ABC):
                     {'labware':'',
                     'container':self.dilution_params.cont,
                     'max_vol':self.dilution_params.vol}, index=[product])
-        self.portal.send_pack('init_containers', product_df.to_dict())
+        self._send('init_containers', product_df.to_dict())
         #2 construct a new dilution row (series)
         colList = self.rxn_df.loc[:,:'reagent'].columns        
         row = pd.Series(np.nan, colList)
@@ -1905,7 +2575,7 @@ class Controller(ABC):
         self._products = cached_products
         self.rxn_df = cached_rxn_df
 
-    def _scan_until_complete(self,row,i):
+    def _scan_until_complete(self,cmd,i):
         """
         This function handles the scan_until_complete operation.
         This involves:
@@ -1919,96 +2589,86 @@ class Controller(ABC):
         #Eps represents the difference variable that we want in order to check if the scans are similar enough
         eps = 3/700 
             
-        scan_product_index = row[self._products].ne(0)
-        
-        wellnames = row[self._products][scan_product_index].index
-        oldScan = self._build_suc_row(row,count)
+        wellnames = cmd.products
+        oldScan = self._build_suc_command(cmd,count)
         self._execute_scan(oldScan,i)
         
         #cached reader locs updated by scan
         pr_dict = {self._cached_reader_locs[wellname].loc: wellname for wellname in wellnames}
         
-        old_scan_data, metadata = self.pr.load_reader_data(oldScan['scan_filename'], pr_dict)
+        old_scan_data, metadata = self.pr.load_reader_data(oldScan.scan_filename, pr_dict)
         
         if not self.simulate: 
-            time.sleep(row['pause_time'])
+            time.sleep(cmd.pause_time)
         
         count += 1
         
-        newScan = self._build_suc_row(row,count)
+        newScan = self._build_suc_command(cmd,count)
         self._execute_scan(newScan,i)
-        new_scan_data,metadata =  self.pr.load_reader_data(newScan['scan_filename'], pr_dict)
+        new_scan_data,metadata =  self.pr.load_reader_data(newScan.scan_filename, pr_dict)
          
         #checks difference, defines old_scan to new scan, until they are similar
         #Divide by 700 eps should = 3/700
         #divide result by 700 aswell
-        while (((((((new_scan_data - old_scan_data)**2)/700)>eps).any()).any()) and (count < row['max_num_scans'])):    
+        while (((((((new_scan_data - old_scan_data)**2)/700)>eps).any()).any()) and (count < cmd.max_num_scans)):    
             oldScan = newScan
             old_scan_data = new_scan_data
             
             if not self.simulate:
-                time.sleep(row['pause_time'])
+                time.sleep(cmd.pause_time)
             
-            newScan = self._build_suc_row(row,count)
+            newScan = self._build_suc_command(cmd,count)
             self._execute_scan(newScan,i)
-            new_scan_data,metadata = self.pr.load_reader_data(newScan['scan_filename'], pr_dict) 
+            new_scan_data,metadata = self.pr.load_reader_data(newScan.scan_filename, pr_dict) 
             count += 1
         #Renames the unique filename back to what it was declared as in the sheet    
-        self.pr._rename_scan(newScan['scan_filename'],row['scan_filename'])
+        self.pr._rename_scan(newScan.scan_filename,cmd.scan_filename)
         
 
-    def _build_suc_row(self,row,count):
-       #Builds a row for the scan_until_complete function
-        
-        newFilename =  "{}_suc_{}".format(row['scan_filename'], count)
-        newRow = row.copy()
-        newRow['op'] = 'scan'
-        newRow['scan_filename'] = newFilename
+    def _build_suc_command(self,cmd,count):
+       #Builds a scan command for the scan_until_complete function
         
-        return newRow
+        newFilename =  "{}_suc_{}".format(cmd.scan_filename, count)
+        return cmd._replace(op='scan', scan_filename=newFilename)
 
     def check_conc(self):
         """
         Makes checks about concentration to see if the concentrations declared are legal declarations
         """
-
-        found_errors = 0
+        check = 'check_conc'
+        rxn_df = self.rxn_df
+        violations = []
         #Check to make sure water always has a concentration defined
-        check_water_conc = (self.rxn_df.loc[(self.rxn_df['reagent']=='Water'),'conc'].isna())
-        if check_water_conc.any():
-            print("<<controller>> Error in index: "+ str(check_water_conc.loc[check_water_conc].index[0])+ " Water needs to always have a concentration defined.")
-            found_errors = max(found_errors,2)
+        no_conc = rxn_df['conc'].isna()
+        rows = rxn_df.index[(rxn_df['reagent'] == 'Water') & no_conc]
+        violations.append(self._make_violations(check, rows, 2,
+                "Error in index: {row} Water needs to always have a concentration defined."))
         #Check to make sure you don't transfer a reagent with a concentration into a reagent with a volume
-        #boolean list of all concentrations that are nan
-                
-        check_conc = (self.rxn_df.loc[(self.rxn_df['op']== 'transfer'),'conc'].isna())
-        transfer_df = self.rxn_df.loc[(self.rxn_df['op'] == 'transfer')]
-        #Check_nan a list of all reagents that dont have a concentration
-        check_nan = (transfer_df.loc[(check_conc),'reagent'].unique())
-        #check_vol list of all reagents that dont have a volume
-        check_vol = (transfer_df.loc[(~check_conc),'reagent'].unique())
-        
-        for prod in self._products:
-            col = self.rxn_df[prod].ne(0)
-            product_df = self.rxn_df.loc[col]
-            check_concs = (product_df.loc[(product_df['op'] == 'transfer'),'conc'].isna())
-            transfer_dfs = product_df.loc[(product_df['op'] == 'transfer')]
-            check_nans = (transfer_dfs.loc[(check_concs),'reagent'].unique())
-            check_vols = (transfer_dfs.loc[(~check_concs),'reagent'].unique())
-            for val in check_nans:
-                if val in check_vols:
-                    print("<<controller>> Error in reagent " + val + ", cannot transfer a reagent without a concentration into the same product with a reagent with concentration.")
-        
+        transfers = rxn_df['op'] == 'transfer'
+        transfer_nonzero = rxn_df.loc[transfers, self._products].ne(0)
+        transfer_no_conc = no_conc.loc[transfers]
+        #for each reagent, which products it's transfered into with and without a concentration
+        by_reagent = pd.concat({
+                'no_conc':transfer_nonzero.mul(transfer_no_conc, axis=0),
+                'conc':transfer_nonzero.mul(~transfer_no_conc, axis=0)
+                }, axis=1).groupby(rxn_df.loc[transfers, 'reagent']).any()
+        if not by_reagent.empty:
+            mixed = (by_reagent['no_conc'] & by_reagent['conc']).stack()
+            mixed = mixed.loc[mixed].index
+        else:
+            mixed = []
+        #this has never stopped a run, so it's only reported
+        violations.append(self._make_violations(check, [np.nan]*len(mixed), 0,
+                "Error in reagent {reagent}, cannot transfer a reagent without a concentration into the same product with a reagent with concentration.",
+                products=[prod for _, prod in mixed], reagent=[reagent for reagent, _ in mixed]))
         #Checks to make sure all reagents with molarity get transferred into products with total volume
-        tot_vol_mol = transfer_df.loc[check_conc,self._products]
-        if not tot_vol_mol.empty:
-            tot_vol_mol = tot_vol_mol.sum().apply(lambda x: not math.isclose(x, 0, abs_tol=1e-9))
-            tot_vol_mol = tot_vol_mol.loc[tot_vol_mol].index
-            for i in tot_vol_mol:
-                if i not in self.tot_vols.keys():
-                    print("<<controller>> Error in product: " + str(i) + " you can only transfer reagents with molarity into products with total volume specified.")
-                    found_errors = max(found_errors, 2)
-        return found_errors
+        molarity_vols = rxn_df.loc[transfers & no_conc, self._products].sum()
+        bad_products = molarity_vols.loc[(molarity_vols.abs() > 1e-9) & \
+                ~molarity_vols.index.isin(list(self.tot_vols))].index
+        violations.append(self._make_violations(check, [np.nan]*len(bad_products), 2,
+                "Error in product: {product} you can only transfer reagents with molarity into products with total volume specified.",
+                products=bad_products))
+        return self._report_violations(violations)
 
 class AutoContr(Controller):
     '''
@@ -2071,13 +2731,14 @@ class AutoContr(Controller):
             model = DummyMLModel(self.reagent_order.shape[0], max_iters=2)
         print('<<controller>> ENTERING SIMULATION')
         port = 50000
-        #launch an eve server in background for simulation purposes
-        b = threading.Barrier(2,timeout=20)
-        eve_thread = threading.Thread(target=launch_eve_server, kwargs={'my_ip':'','barrier':b},name='eve_thread')
+        #launch an eve server in background for simulation purposes. It's connected through an
+        #in memory pipe, so no sockets are needed
+        controller_end, eve_end = make_pipe()
+        eve_thread = threading.Thread(target=launch_eve_server, kwargs={'my_ip':'','barrier':None,
+                'transport':eve_end, 'root_p':os.path.join(self.debug_path, 'Eve_Out_Sim')},
+                name='eve_thread')
         eve_thread.start()
-        #do create a connection
-        b.wait()
-        self._run(port, True, model, no_pr)
+        self._run(port, True, model, no_pr, transport=controller_end)
 
         #collect the eve thread
         eve_thread.join()
@@ -2115,19 +2776,18 @@ class AutoContr(Controller):
         pass
 
     @error_exit
-    def _run(self, port, simulate, model, no_pr):
+    def _run(self, port, simulate, model, no_pr, transport=None):
         '''
-        private function to run
+        private function to run  
+        params:  
+            Transport transport: if supplied, used to talk to the robot instead of connecting
+              to a socket on port  
         '''
         self.batch_num = 0 #used internally for unique filenames
         self.well_count = 0 #used internally for unique wellnames
         self._init_pr(simulate, no_pr)
         #create a connection
-        sock = socket.socket(socket.AF_INET)
-        sock.connect((self.server_ip, port))
-        buffered_sock = BufferedSocket(sock, maxsize=1e9, timeout=None)
-        print("<<controller>> connected")
-        self.portal = Armchair(buffered_sock,'controller','Armchair_Logs', buffsize=4)
+        self.portal = self._open_portal(port, transport)
         self.init_robot(simulate)
         recipes = model.generate_seed_rxns()
 
@@ -2201,7 +2861,7 @@ class AutoContr(Controller):
               order of recipes
         Postconditions:
         '''
-        self.portal.send_pack('init_containers', pd.DataFrame(
+        self._send('init_containers', pd.DataFrame(
                 {'labware':self.template_meta['labware'],
                 'container':self.template_meta['cont'], 
                 'max_vol':self.template_meta['tot_vol']}, index=wellnames).to_dict())
@@ -2220,6 +2880,8 @@ class AutoContr(Controller):
                 successful_build = True
             except ConversionError as e:
                 self._handle_conversion_err(e)
+        self._check_source_vols()
+        self._reorder_transfers()
         self.execute_protocol_df()
 
 
@@ -2256,7 +2918,7 @@ class AutoContr(Controller):
         self.well_count += 1
         return wellname
 
-    def _get_rxn_max_vol(self, name, products):
+    def _get_rxn_max_vol(self, name, ledger):
         '''
         This is used right now because it's best I've got. Ideally, you could drop the part 
         of init that constructs product_df
@@ -2363,12 +3025,12 @@ class AutoContr(Controller):
         found_errors = super().check_rxn_df()
         reagent_ratios  = self.rxn_df.loc[(self.rxn_df['conc'].isna()) & (self.rxn_df['op'] == 'transfer'),\
                 ['Template','reagent']].groupby('reagent').sum()['Template']
-        has_invalid_ratio = reagent_ratios.apply(lambda x: not math.isclose(x, 1.0,
-                abs_tol=1e-9)).any()
-        if has_invalid_ratio:
-            print('<<controller>> precheck error: invalid ratio of reagents (doesn\'t add to 1)')
-            print('  ratios were {}'.format(reagent_ratios))
-            found_errors = max(found_errors, 2)
+        invalid_ratios = reagent_ratios.loc[(reagent_ratios - 1.0).abs() > 1e-9]
+        found_errors = max(found_errors, self._report_violations([self._make_violations(
+                'check_rxn_df', [np.nan]*len(invalid_ratios), 2,
+                "precheck error: invalid ratio of reagents (doesn't add to 1). {reagent} had ratio {ratio}",
+                products=['Template']*len(invalid_ratios), reagent=invalid_ratios.index,
+                ratio=invalid_ratios)]))
         return found_errors
 
 class ProtocolExecutor(Controller): 
@@ -2382,7 +3044,7 @@ class ProtocolExecutor(Controller):
     INHERITED ATTRIBUTES:  
         armchair.Armchair portal, str rxn_sheet_name, str cache_path, bool use_cache,   
         str eve_files_path, str debug_path, str my_ip, str server_ip,  
-        dict<str:object> robo_params, bool simulate, int buff_size  
+        dict<str:object> robo_params, bool simulate, int buff_size, str record_path  
     PRIVATE ATTRS:  
         pd.index _products: the product columns  
     INHERITED PRIVATE ATTRS:  
@@ -2430,14 +3092,14 @@ class ProtocolExecutor(Controller):
         self.simulate = True
         print('<<controller>> ENTERING SIMULATION')
         port = 50000
-        #launch an eve server in background for simulation purposes
-        b = threading.Barrier(2,timeout=20)
-        eve_thread = threading.Thread(target=launch_eve_server, kwargs={'my_ip':'','barrier':b},name='eve_thread')
+        #launch an eve server in background for simulation purposes. It's connected through an
+        #in memory pipe, so no sockets are needed
+        controller_end, eve_end = make_pipe()
+        eve_thread = threading.Thread(target=launch_eve_server, kwargs={'my_ip':'','barrier':None,
+                'transport':eve_end, 'root_p':os.path.join(self.debug_path, 'Eve_Out_Sim')},
+                name='eve_thread')
         eve_thread.start()
-
-        #do create a connection
-        b.wait()
-        self._run(port, simulate=True, no_pr=no_pr)
+        self._run(port, simulate=True, no_pr=no_pr, transport=controller_end)
 
 
 
@@ -2450,6 +3112,41 @@ class ProtocolExecutor(Controller):
         self._cached_reader_locs = stored_cached_reader_locs
         print('<<controller>> EXITING SIMULATION')
     
+    def run_replay(self, session_path, realtime=False, no_pr=True):
+        '''
+        runs the protocol against a stub robot that responds the way the robot did in a
+        recorded session. Used to benchmark the controller without hardware  
+        params:  
+            str session_path: a session recorded by either end (see Armchair/recorder.py)  
+            bool realtime: True for the stub to take as long as the recorded robot did for each
+              command. Otherwise it acks immediately  
+            bool no_pr: True to not use the platereader  
+        returns:  
+            float: the seconds the run took  
+        '''
+        stored_simulate = self.simulate
+        stored_cached_reader_locs = self._cached_reader_locs
+        stored_use_shadow_deck = self.use_shadow_deck
+        self.simulate = True
+        #the stub can only answer lookups of the wells the recording looked up, so every lookup
+        #must be made as it was recorded, rather than answered from the shadow deck
+        self.use_shadow_deck = False
+        print('<<controller>> ENTERING REPLAY')
+        controller_end, robot_end = make_pipe()
+        stub = StubRobot(SessionReader(session_path), robot_end, realtime,
+                os.path.join(self.debug_path, 'Armchair_Logs'))
+        stub_thread = threading.Thread(target=stub.run, name='stub_robot_thread')
+        stub_thread.start()
+        start = time.monotonic()
+        self._run(50000, simulate=True, no_pr=no_pr, transport=controller_end)
+        stub_thread.join()
+        elapsed = time.monotonic() - start
+        self.simulate = stored_simulate
+        self._cached_reader_locs = stored_cached_reader_locs
+        self.use_shadow_deck = stored_use_shadow_deck
+        print('<<controller>> EXITING REPLAY. took {:.3f}s'.format(elapsed))
+        return elapsed
+
     def run_protocol(self, simulate=False, no_pr=False, port=50000):
         '''
         The real deal. Input a server addr and port if you choose and protocol will be run  
@@ -2467,10 +3164,12 @@ class ProtocolExecutor(Controller):
         print('<<controller>> EXITING PROTOCOL')
         
     @error_exit
-    def _run(self, port, simulate, no_pr):
+    def _run(self, port, simulate, no_pr, transport=None):
         '''
         params:  
             int port: the port number to connect on  
+            Transport transport: if supplied, used to talk to the robot instead of connecting
+              to a socket on port  
             bool simulate: (this should never be used in normal operation. It is for debugging
               on the robot)  
             bool no_pr: This should be false normally, but can be set to true to deliberately
@@ -2480,11 +3179,7 @@ class ProtocolExecutor(Controller):
         '''
         self._init_pr(simulate, no_pr)
         #create a connection
-        sock = socket.socket(socket.AF_INET)
-        sock.connect((self.server_ip, port))
-        buffered_sock = BufferedSocket(sock, maxsize=1e9, timeout=None)
-        print("<<controller>> connected")
-        self.portal = Armchair(buffered_sock,'controller','Armchair_Logs', buffsize=4)
+        self.portal = self._open_portal(port, transport)
 
         self.init_robot(simulate)
         successful_build = False
@@ -2500,6 +3195,8 @@ class ProtocolExecutor(Controller):
                 successful_build = True
             except ConversionError as e:
                 self._handle_conversion_err(e)        
+        self._check_source_vols()
+        self._reorder_transfers()
         self.execute_protocol_df()
         self.close_connection()
         self.pr.shutdown()
@@ -2514,7 +3211,7 @@ class ProtocolExecutor(Controller):
         super().init_robot(simulate)
         #send robot data to initialize empty product containers. Because we know things like total
         #vol and desired labware, this makes sense for a planned experiment
-        self.portal.send_pack('init_containers', self.robo_params['product_df'].to_dict())
+        self._send('init_containers', self.robo_params['product_df'].to_dict())
     
     def _rename_products(self, rxn_df):
         '''
@@ -2545,37 +3242,22 @@ class ProtocolExecutor(Controller):
                 rename_key[col] = "{}C1.0".format(col).replace(' ','_')
         rxn_df.rename(rename_key, axis=1, inplace=True)
 
-    def _get_rxn_max_vol(self, name, products):
+    def _get_rxn_max_vol(self, name, ledger):
         '''
         Preconditions:  
-            volume in a container can change only during a 'transfer' or 'dilution'. Easy to add more
-            by changing the vol_change_rows
+            volume in a container can change only during a 'transfer' or 'dilution' (see
+            VolumeLedger)  
             self.rxn_df is initialized  
         params:  
             str name: the column name to be searched  
-            list<str> products: the column names of all reagents (we could look this up in rxn_df, but
-              convenient to pass it in)  
+            VolumeLedger ledger: the volumes of self.rxn_df  
         returns:  
-            float: the maximum volume that this container will ever hold at one time, not taking into 
-              account aspirations for dilutions  
+            float: the maximum volume that this container will ever hold at one time  
         '''
         if name in self.tot_vols:
             return self.tot_vols[name]
         else:
-            vol_change_rows = self.rxn_df.loc[self.rxn_df['op'].apply(lambda x: x in ['transfer','dilution'])]
-            aspirations = vol_change_rows['chemical_name'] == name
-            max_vol = 0
-            current_vol = 0
-            for i, is_aspiration in aspirations.iteritems():
-                if is_aspiration and self.rxn_df.loc[i,'op'] == 'transfer':
-                    #This is a row where we're transfering from this well
-                    current_vol -= self.rxn_df.loc[i, products].sum()
-                elif is_aspiration and self.rxn_df.loc[i, 'op'] == 'dilution':
-                    current_vol -= self._get_dilution_transfer_vols(self.rxn_df.loc[i])[1]
-                else:
-                    current_vol += self.rxn_df.loc[i,name]
-                    max_vol = max(max_vol, current_vol)
-            return max_vol
+            return ledger.max_vols([name])[name]
 
     
     #TESTING
@@ -3168,68 +3850,38 @@ class ScanDataFrame():
 
         well_hist_df = pd.read_csv(os.path.join(self.eve_files_path,'well_history.tsv'), sep='\t')
 
-        timess = well_hist_df.timestamp.values.tolist()
-        for time in timess:
-          
-            index = timess.index(time)
-
-            time = pd.Timestamp(time).strftime('%Y-%m-%d %H:%M:%S:%f')
-            timess[index] = time
-
-
-        well_hist_df['timestamp'] = timess
+        #parse every timestamp at once. well_history.tsv is written from epoch times at export
+        well_hist_df['timestamp'] = pd.to_datetime(well_hist_df['timestamp']).dt.strftime(
+                '%Y-%m-%d %H:%M:%S:%f')
 
         df = pd.read_csv(os.path.join(self.data_path, reaction+'full_df.csv'))
 
-        containers = []
-        times = []
-        volumes =[]
-        vols = []
-        indices = []
-        cons = []
-        chems = []
-        con_list  = well_hist_df['container'].tolist()
-        for container in con_list:
-            if (reaction in  container) or ('blank' in container) or ('control' in container):
-                volume = well_hist_df.loc[well_hist_df['container'] == container].index.tolist()
-                
-                
-                indices.append(container)
-                indices = list(set(indices))
+        con_col = well_hist_df['container'].astype(str)
+        relevant = con_col.str.contains(reaction, regex=False) | \
+                con_col.str.contains('blank', regex=False) | \
+                con_col.str.contains('control', regex=False)
+        indices = list(pd.unique(con_col[relevant]))
+        vols = well_hist_df.index[relevant].tolist()
 
-                vols.extend(volume)
-                vols = list(set(vols))
+        def split_last_c(name):
+            #split around the last 'C' the way str.rfind would
+            c_index = name.rfind('C')
+            return name[:c_index], name[c_index], name[c_index+1:]
 
+        relevant_df = well_hist_df.loc[vols]
+        chems = []
+        cons = []
+        for chemical in relevant_df['chemical']:
+            head, sep, tail = split_last_c(chemical)
+            chems.append(head)
+            cons.append(tail)
+        containers = []
+        for container in relevant_df['container']:
+            head, sep, tail = split_last_c(container)
+            containers.append(head + sep + tail)
+        times = relevant_df['timestamp'].tolist()
+        volumes = relevant_df['vol'].tolist()
 
-        for index in vols:
-            chemical = well_hist_df["chemical"].iloc[index]
-            
-            chem_c_index = chemical.rfind('C')
-            head = chemical[:chem_c_index]
-            sep = chemical[chem_c_index]
-            tail = chemical[chem_c_index+1:]
-            
-            chemical =  head
-            chems.append(chemical)
-            
-            concentration = tail
-            cons.append(concentration)
-            timestamp = well_hist_df["timestamp"].iloc[index]
-            times.append(timestamp)
-            volume = well_hist_df["vol"].iloc[index]
-            volumes.append(volume)
-            
-            container = well_hist_df["container"].iloc[index]
-            
-            cont_c_index = container.rfind('C')
-            head = container[:cont_c_index]
-            sep = container[cont_c_index]
-            tail = container[cont_c_index+1:]
-            
-            container = head +sep + tail
-            containers.append(container)
-                  
-        
         chems_unique = list(set(chems))
     
         chem_info = {}
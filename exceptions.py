@@ -42,3 +42,22 @@ class EmptyReagent(RuntimeError):
         '''
         self.chem_name = chem_name
         super().__init__(message)
+
+class BatchCommandError(RuntimeError):
+    '''
+    This is raised when one of the sub commands of a batch fails. The original exception is
+    chained as the __cause__  
+    '''
+
+    def __init__(self, index, pack_type, error):
+        '''
+        params:  
+            int index: the index of the failed sub command in the batch  
+            str pack_type: the command type of the failed sub command  
+            Exception error: the exception raised by the sub command
+        '''
+        self.index = index
+        self.pack_type = pack_type
+        self.error = error
+        super().__init__("sub command {} ('{}') of batch failed with {}: {}".format(index,
+                pack_type, type(error).__name__, error))
@@ -16,6 +16,7 @@ and if run directly from the command line, that function will be invoked.
 from abc import ABC
 from abc import abstractmethod
 from collections import defaultdict
+from collections import namedtuple
 from datetime import datetime
 import pytz
 import socket
@@ -30,6 +31,9 @@ import logging
 import asyncio
 import threading
 import time
+import array
+import heapq
+import bisect
 import traceback
 import re
 
@@ -46,10 +50,317 @@ from boltons.socketutils import BufferedSocket
 
 from Armchair.armchair import Armchair
 import Armchair.armchair as armchair
+from Armchair.transport import make_pipe
+from Armchair.replay import SessionReader, ControllerPlayback
 from df_utils import *
-from exceptions import EmptyReagent
+from exceptions import EmptyReagent, BatchCommandError
 
 #CONTAINERS
+class WellHistoryJournal():
+    '''
+    Append only journal of every volume change of every container. Each Container.update_vol
+    appends one row as it happens (to memory and to the journal file), and well_history.tsv is
+    only generated from the journal when it is exported (e.g. on save), rather than rebuilding
+    it from every container after every step.  
+    Rows are appended in the order they happen, so the journal is already sorted by time.  
+    The rows are stored by column in typed arrays: epoch timestamps, container ids, interned
+    chemical ids, and volumes. Nothing is formatted until export.  
+    ATTRIBUTES:  
+        str path: the path of the journal file, or None to keep the journal in memory only  
+    METHODS:  
+        register() int: returns a new id for a container to journal under  
+        record(int cont_id, str chem_name, float vol) void: journals a volume change  
+        rewrite_first(int cont_id, str chem_name) void: see Container.rewrite_history_first  
+        history(int cont_id) list<tuple<str,str,float>>: the history of a container  
+        export(str path, dict<str:Container> containers) void: writes well_history.tsv  
+        close() void: closes the journal file  
+    '''
+    TIME_ZONE = 'US/Pacific'
+    TIME_FORMAT = '%d-%b-%Y %H:%M:%S:%f' #the format of Container.history timestamps
+    EXPORT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' #the format of well_history.tsv timestamps
+
+    def __init__(self, path=None):
+        '''
+        params:  
+            str path: the path of the journal file. Overwritten. None to not write a file  
+        '''
+        self.path = path
+        self._n_conts = 0
+        #the columns. _alive is 0 for rows dropped by a rewrite
+        self._timestamps = array.array('d')
+        self._cont_ids = array.array('i')
+        self._chem_ids = array.array('i')
+        self._vols = array.array('d')
+        self._alive = array.array('b')
+        #chemical names are interned. _chem_names[chem_id] is the name
+        self._chem_names = []
+        self._chem_ids_by_name = {}
+        self._file = None
+        if path:
+            self._file = open(path, 'w')
+            self._file.write('#chemical\tchem_id\tname\n#update\tcont_id\tchem_id\tepoch\tvol\n')
+
+    def register(self):
+        '''
+        returns:  
+            int: a new container id  
+        '''
+        self._n_conts += 1
+        return self._n_conts - 1
+
+    def _intern(self, chem_name):
+        '''
+        params:  
+            str chem_name: a chemical name  
+        returns:  
+            int: the id of the chemical name  
+        '''
+        chem_id = self._chem_ids_by_name.get(chem_name)
+        if chem_id is None:
+            chem_id = len(self._chem_names)
+            self._chem_names.append(chem_name)
+            self._chem_ids_by_name[chem_name] = chem_id
+            if self._file:
+                self._file.write('chemical\t{}\t{}\n'.format(chem_id, chem_name))
+        return chem_id
+
+    def record(self, cont_id, chem_name, vol):
+        '''
+        params:  
+            int cont_id: the id of the container  
+            str chem_name: the name of the chemical dispensed, or blank for an aspiration  
+            float vol: the change in volume  
+        '''
+        timestamp = time.time()
+        chem_id = self._intern(chem_name)
+        self._timestamps.append(timestamp)
+        self._cont_ids.append(cont_id)
+        self._chem_ids.append(chem_id)
+        self._vols.append(vol)
+        self._alive.append(1)
+        if self._file:
+            self._file.write('update\t{}\t{}\t{!r}\t{!r}\n'.format(cont_id, chem_id, timestamp,
+                    float(vol)))
+
+    def _rows_of(self, cont_id):
+        '''
+        params:  
+            int cont_id: the id of the container  
+        returns:  
+            np.array<int>: the indices of the live rows of the container in order  
+        '''
+        return np.flatnonzero((np.array(self._cont_ids) == cont_id) & np.array(self._alive, dtype=bool))
+
+    def rewrite_first(self, cont_id, chem_name):
+        '''
+        drops every row of the container but the first, and changes the chemical of the first  
+        params:  
+            int cont_id: the id of the container  
+            str chem_name: the new chemical name of the first row  
+        '''
+        rows = self._rows_of(cont_id)
+        for i in rows[1:]:
+            self._alive[i] = 0
+        self._chem_ids[rows[0]] = self._intern(chem_name)
+        if self._file:
+            self._file.write('rewrite_first\t{}\t{}\n'.format(cont_id, self._chem_ids[rows[0]]))
+
+    def _format_times(self, timestamps, time_format):
+        '''
+        params:  
+            np.array<float> timestamps: epoch timestamps  
+            str time_format: a strftime format  
+        returns:  
+            pd.Index<str>: the timestamps formatted in local time  
+        '''
+        micros = np.round(timestamps * 1e6).astype('int64')
+        return pd.to_datetime(micros, unit='us', utc=True).tz_convert(self.TIME_ZONE).strftime(
+                time_format)
+
+    def history(self, cont_id):
+        '''
+        params:  
+            int cont_id: the id of the container  
+        returns:  
+            list<tuple<str,str,float>>: (timestamp, chemical, vol) for each row of the container  
+        '''
+        rows = self._rows_of(cont_id)
+        times = self._format_times(np.array(self._timestamps)[rows], self.TIME_FORMAT)
+        return [(timestamp, self._chem_names[self._chem_ids[i]], self._vols[i])
+                for timestamp, i in zip(times, rows)]
+
+    def export(self, path, containers):
+        '''
+        writes the history of the containers to a tsv with columns timestamp, chemical, vol,
+        and container, sorted by timestamp. Rows of containers that are no longer in containers
+        (e.g. replaced by a make) are left out  
+        params:  
+            str path: the path to write to  
+            dict<str:Container> containers: maps the name to put in the container column to the
+              Container  
+        '''
+        cont_names = np.full(self._n_conts, None, dtype=object)
+        for name, container in containers.items():
+            for cont in getattr(container, 'cont_list', [container]):
+                cont_names[cont.journal_id] = name
+        cont_ids = np.array(self._cont_ids, dtype=np.int64)
+        row_cont_names = cont_names[cont_ids]
+        keep = np.array(self._alive, dtype=bool) & (row_cont_names != None)
+        history = pd.DataFrame({
+                'timestamp':self._format_times(np.array(self._timestamps)[keep],
+                    self.EXPORT_TIME_FORMAT),
+                'chemical':np.array(self._chem_names, dtype=object)[
+                    np.array(self._chem_ids, dtype=np.int64)[keep]],
+                'vol':np.array(self._vols)[keep],
+                'container':row_cont_names[keep]},
+                columns=['timestamp', 'chemical', 'vol', 'container'])
+        history.to_csv(path, index=False, sep='\t')
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+class DeckState():
+    '''
+    Array backed state of every container on the deck. Each Container is a view onto one row
+    of these arrays (its cid), so the robot can read the state of many containers at once
+    without visiting each object.  
+    Containers that belong to a MultiContainer are put in a group. The aspiratible volume of
+    each group (summed over the containers in the group that have not been used up yet) is
+    kept up to date as volumes change rather than resummed when read.  
+    The arrays grow by doubling, so only the first n entries are meaningful. Don't hold onto
+    the arrays themselves across registrations. Index them through the DeckState  
+    ATTRIBUTES:  
+        int n: the number of containers registered  
+        np.array<float> vol: the volume of each container in uL  
+        np.array<float> height: the height of the liquid in each container. nan if not tracked  
+        np.array<float> dead_vol: the dead volume of each container  
+        np.array<float> max_vol: the capacity of each container  
+        np.array<float> conc: the concentration of each container  
+        np.array<int> group: the group of each container, or -1 if it is not in a group (or has
+          been used up)  
+        list<float> group_aspiratible: the aspiratible volume of each group  
+    METHODS:  
+        register(float vol, float dead_vol, float max_vol, float conc) int: adds a container  
+        add_vol(int cid, float del_vol) void: changes the volume of a container  
+        new_group(list<int> cids) int: groups containers for a MultiContainer  
+        retire(int cid) void: takes a used up container out of its group  
+        aspiratible_vols(list<int> cids) np.array<float>: aspiratible volumes of containers  
+    '''
+    INITIAL_CAPACITY = 64
+    FLOAT_COLUMNS = ['vol', 'height', 'dead_vol', 'max_vol', 'conc']
+
+    def __init__(self):
+        self.n = 0
+        for col in self.FLOAT_COLUMNS:
+            setattr(self, col, np.zeros(self.INITIAL_CAPACITY))
+        self.group = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int64)
+        self.group_aspiratible = []
+
+    def _grow(self):
+        '''
+        Postconditions:  
+            every array has doubled in length  
+        '''
+        capacity = len(self.vol)
+        for col in self.FLOAT_COLUMNS:
+            setattr(self, col, np.concatenate((getattr(self, col), np.zeros(capacity))))
+        self.group = np.concatenate((self.group, np.full(capacity, -1, dtype=np.int64)))
+
+    def register(self, vol, dead_vol, max_vol, conc):
+        '''
+        params:  
+            float vol: the starting volume  
+            float dead_vol: the volume at which the container is considered empty  
+            float max_vol: the capacity of the container  
+            float conc: the concentration  
+        returns:  
+            int: the cid of the new container  
+        '''
+        if self.n == len(self.vol):
+            self._grow()
+        cid = self.n
+        self.n += 1
+        self.vol[cid] = vol
+        self.height[cid] = np.nan
+        self.dead_vol[cid] = dead_vol
+        self.max_vol[cid] = max_vol
+        self.conc[cid] = conc
+        return cid
+
+    def add_vol(self, cid, del_vol):
+        '''
+        params:  
+            int cid: the container  
+            float del_vol: the change in volume  
+        Postconditions:  
+            the volume and the aspiratible volume of its group have been updated  
+        '''
+        self.vol[cid] += del_vol
+        group = self.group[cid]
+        if group >= 0:
+            self.group_aspiratible[group] += del_vol
+
+    def new_group(self, cids):
+        '''
+        params:  
+            list<int> cids: the containers in the group. None may be in a group already  
+        returns:  
+            int: the id of the group  
+        '''
+        group = len(self.group_aspiratible)
+        self.group[cids] = group
+        self.group_aspiratible.append(float(self.aspiratible_vols(cids).sum()))
+        return group
+
+    def retire(self, cid):
+        '''
+        params:  
+            int cid: a container that will no longer be used by its group  
+        Postconditions:  
+            the container's aspiratible volume no longer counts toward its group  
+        '''
+        group = self.group[cid]
+        if group >= 0:
+            self.group_aspiratible[group] -= self.vol[cid] - self.dead_vol[cid]
+            self.group[cid] = -1
+
+    def aspiratible_vols(self, cids):
+        '''
+        params:  
+            list<int> cids: the containers  
+        returns:  
+            np.array<float>: the volume that can be aspirated from each container  
+        '''
+        return self.vol[cids] - self.dead_vol[cids]
+
+LiquidProfile = namedtuple('LiquidProfile', ['aspirate_rate', 'dispense_rate', 'blow_outs',
+        'touch_tip_after_aspirate', 'touch_tip_after_dispense', 'touch_tip_radius',
+        'touch_tip_speed', 'mix_rate', 'mix_reps_scale', 'mix_heights'])
+LiquidProfile.__doc__ = '''
+How a liquid is handled by the pipettes. Profiles are defined in liquid_profiles.json (see
+OT2Robot._load_liquid_profiles) and fields left out there keep Container.DEFAULT_PROFILE  
+ATTRIBUTES:  
+    float aspirate_rate: multiplier of the pipette's default aspirate flow rate (uL/s)  
+    float dispense_rate: multiplier of the pipette's default dispense flow rate (uL/s)  
+    int blow_outs: the number of blowouts after a dispense that empties the tip. 0 for none.
+      Partial dispenses of a distributed load never blow out  
+    bool touch_tip_after_aspirate: if True, the tip is touched to the sides of the source after
+      aspirating (with the Opentrons default radius and speed) to knock off drops  
+    bool touch_tip_after_dispense: if True, the tip is touched to the sides of the destination
+      after dispensing, with touch_tip_radius and touch_tip_speed  
+    float touch_tip_radius: how far toward the wall to touch, as a fraction of the well radius
+      (1.0 is the wall)  
+    float touch_tip_speed: the speed of the head while touching tip in mm/s  
+    float mix_rate: multiplier of the pipette's default flow rates while mixing  
+    float mix_reps_scale: scales the number of mixes (2**mix_code) at each height. At least one
+      mix is always done  
+    int mix_heights: the number of heights that tubes and wells are mixed at. None for the
+      default of the container type (4 for tubes, 3 for wells)  
+'''
+
 class Container(ABC):
     """
     Abstract container class to be overwritten for well, tube, etc.  
@@ -59,6 +370,7 @@ class Container(ABC):
         int deck_pos: the position on the deck  
         str loc: a location on the deck_pos object (e.g. 'A5')  
         Opentrons...Labware labware: an opentrons labware object for the deck_pos
+        Opentrons...Well well: the opentrons well object at loc. Resolved once at construction  
         float conc: the concentration of the substance  
         float disp_height: the height to dispense at  
         float asp_height: the height to aspirate from  
@@ -66,9 +378,15 @@ class Container(ABC):
           timestamp timestamp: the time of the addition/removal. Note that it may not be sorted
           str chem_name: the name of the chemical added or blank if aspiration
           float vol: the volume of chemical added/removed  
+          This is formatted from the epoch timestamps in the journal when read  
+        WellHistoryJournal journal: the journal volume changes are recorded in  
+        int journal_id: the id of this container in the journal  
+        DeckState deck: the deck state that holds vol, height, conc, and max vol  
+        int cid: the row of this container in deck. vol, height, and conc are views of it  
     CONSTANTS:  
         float DEAD_VOL: the volume at which this  
         float MIN_HEIGHT: the minimum height at which to pipette from   
+        LiquidProfile DEFAULT_PROFILE: the handling used when no profile is given  
     ABSTRACT METHODS:  
         _update_height void: updates self.height to height at which to pipet (a bit below water line)  
     IMPLEMENTED METHODS:  
@@ -83,22 +401,34 @@ class Container(ABC):
         mix(Opentrons...pipette pipette, float mix_vol, int mix_code): mixes this container
     """
 
-    def __init__(self, name, deck_pos, loc, labware, vol=0,  conc=1):
+    __slots__ = ('name', 'deck_pos', 'loc', 'labware', 'well', 'journal', 'journal_id', 'deck',
+            'cid')
+
+    def __init__(self, name, deck_pos, loc, labware, vol=0,  conc=1, journal=None, deck=None,
+            well=None):
         self.name = name
         self.deck_pos = deck_pos
         self.loc = loc
         self.labware = labware
-        self.vol = vol
+        #resolve the well once. wells_by_name rebuilds a dict of every well on each call
+        self.well = well if well else labware.wells_by_name()[loc]
+        #containers made outside of a robot (deck=None) keep their state to themselves
+        self.deck = deck if deck else DeckState()
+        self.cid = self.deck.register(vol, self.DEAD_VOL, self.well._geometry._max_volume, conc)
         assert (self.vol < self.MAX_VOL), "tried to set volume of {} to {}uL, but {} has max capacity of {}uL".format(self.name, self.vol, self.name, self.MAX_VOL)
         self._update_height()
-        self.conc = conc
-        self.history = []
+        #containers made outside of a robot (journal=None) keep their history to themselves
+        self.journal = journal if journal else WellHistoryJournal()
+        self.journal_id = self.journal.register()
         if vol:
             #create an entry with yourself as first
-            self.history.append((datetime.now(pytz.timezone('US/Pacific')).strftime('%d-%b-%Y %H:%M:%S:%f'), name, vol))
+            self.journal.record(self.journal_id, name, vol)
 
     DEAD_VOL = 0
     MIN_HEIGHT = 0
+    DEFAULT_PROFILE = LiquidProfile(aspirate_rate=1.0, dispense_rate=1.0, blow_outs=4,
+            touch_tip_after_aspirate=True, touch_tip_after_dispense=True, touch_tip_radius=0.3,
+            touch_tip_speed=40, mix_rate=100.0, mix_reps_scale=1.0, mix_heights=None)
 
     @abstractmethod
     def _update_height(self):
@@ -116,8 +446,8 @@ class Container(ABC):
         '''
         #if you are dispersing without specifying the name of incoming chemical, complain
         assert ((del_vol < 0) or (name and del_vol > 0)), 'Developer Error: dispensing without specifying src'
-        self.history.append((datetime.now(pytz.timezone('US/Pacific')).strftime('%d-%b-%Y %H:%M:%S:%f'), name, del_vol))
-        self.vol = self.vol + del_vol
+        self.journal.record(self.journal_id, name, del_vol)
+        self.deck.add_vol(self.cid, del_vol)
         self._update_height()
         assert (self.vol < self.MAX_VOL + 1e-9), "tried to set volume of {} to {}uL, but {} has max capacity of {}uL".format(self.name, self.vol, self.name, self.MAX_VOL) #1e-9 is fudge
 
@@ -132,14 +462,41 @@ class Container(ABC):
         Postconditions:
             The first transfer in history is a transfer of this chemical into this well  
         '''
-        self.history = [(self.history[0][0], self.name, self.history[0][2])]
+        self.journal.rewrite_first(self.journal_id, self.name)
+
+    @property
+    def history(self):
+        return self.journal.history(self.journal_id)
 
-    def aspirate(self, vol, pipette, lab_deck):
+    #views of this container's row in the deck state
+    @property
+    def vol(self):
+        return float(self.deck.vol[self.cid])
+
+    @property
+    def conc(self):
+        return float(self.deck.conc[self.cid])
+
+    @conc.setter
+    def conc(self, conc):
+        self.deck.conc[self.cid] = conc
+
+    @property
+    def height(self):
+        height = self.deck.height[self.cid]
+        return None if np.isnan(height) else float(height)
+
+    @height.setter
+    def height(self, height):
+        self.deck.height[self.cid] = np.nan if height is None else height
+
+    def aspirate(self, vol, pipette, lab_deck, profile=None):
         '''
         params:  
             float vol: the volume to pipette in uL  
             Opentrons.pipette pipette: the pipette to use in the transfer  
             np.array<Labware> lab_deck: the indexed arrray of labware  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         raises:  
             EmptyReagent if don't have enough volume to pipette  
         Note:  
@@ -155,13 +512,14 @@ class Container(ABC):
         #set aspiration height
         pipette.well_bottom_clearance.aspirate = self.asp_height
         #aspirate(well_obj)
-        pipette.aspirate(vol, lab_deck[self.deck_pos].get_well(self.loc))
+        profile = profile if profile else self.DEFAULT_PROFILE
+        pipette.aspirate(vol, self.get_well(), rate=profile.aspirate_rate)
         #update the vol of src
         self.update_vol(-vol)
         #call cleanup
-        self._aspirate_cleanup(pipette)
+        self._aspirate_cleanup(pipette, profile)
 
-    def _aspirate_cleanup(self, pipette):
+    def _aspirate_cleanup(self, pipette, profile=None):
         '''
         This method is called at the end of an aspiration.
         It is used to do any end of aspiration cleanup like touching tip.  
@@ -169,18 +527,24 @@ class Container(ABC):
         for subclasses.
         params:  
             Opentrons.pipette pipette: the pipette to use in the transfer  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         '''
-        pipette.touch_tip()
+        profile = profile if profile else self.DEFAULT_PROFILE
+        if profile.touch_tip_after_aspirate:
+            pipette.touch_tip()
         #move tip *directly* to center of well/tube so it doesn't interact with the well/tube when it lifts up
         pipette.move_to(self.get_well().top(), force_direct=True)
 
-    def dispense(self, vol, pipette, lab_deck, src):
+    def dispense(self, vol, pipette, lab_deck, src, blow_out=True, profile=None):
         '''
         params:  
             float vol: the volume to pipette in uL  
             Opentrons.pipette pipette: the pipette to use in the transfer  
             np.array<Labware> lab_deck: the indexed arrray of labware  
             float src: the name of the reagent being put into this container
+            bool blow_out: False to leave the rest of the tip in the tip. Used when distributing
+              one aspiration to multiple containers  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         Note:  
             it is the responsibility of the caller to update the pipette  
         Postconditions:  
@@ -189,13 +553,14 @@ class Container(ABC):
         #set dispense height
         pipette.well_bottom_clearance.dispense = self.disp_height
         #dispense(well_obj)
-        pipette.dispense(vol, lab_deck[self.deck_pos].get_well(self.loc))
+        profile = profile if profile else self.DEFAULT_PROFILE
+        pipette.dispense(vol, self.get_well(), rate=profile.dispense_rate)
         #update vol of dst
         self.update_vol(vol,src)
         #cleanup
-        self._dispense_cleanup(pipette)
+        self._dispense_cleanup(pipette, blow_out, profile)
 
-    def _dispense_cleanup(self, pipette):
+    def _dispense_cleanup(self, pipette, blow_out=True, profile=None):
         '''
         This method is called at the end of a dispense.
         It is used to do any end of dispense cleanup like touching tip.  
@@ -203,14 +568,29 @@ class Container(ABC):
         for subclasses.
         params:  
             Opentrons.pipette pipette: the pipette to use in the transfer  
+            bool blow_out: False to skip the blowout (the tip still holds liquid to dispense)  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         '''
+        profile = profile if profile else self.DEFAULT_PROFILE
         #blowout
-        for i in range(4):
-            pipette.blow_out()
+        if blow_out:
+            for i in range(profile.blow_outs):
+                pipette.blow_out()
         #wiggle - touch tip (spin fast inside well)
-        pipette.touch_tip(radius=0.3,speed=40)
+        if profile.touch_tip_after_dispense:
+            pipette.touch_tip(radius=profile.touch_tip_radius, speed=profile.touch_tip_speed)
+
+    def _mix_reps(self, mix_code, profile):
+        '''
+        params:  
+            int mix_code: the mix code  
+            LiquidProfile profile: how to handle the liquid  
+        returns:  
+            int: the number of mixes to do at each height. 2**mix_code scaled by the profile  
+        '''
+        return max(1, int(round(profile.mix_reps_scale * 2**mix_code)))
 
-    def mix(self, pipette, mix_vol, mix_code):
+    def mix(self, pipette, mix_vol, mix_code, profile=None):
         '''
         This method is used to mix the well. Part of the container because
         many of it's children will override this method to mix in a special way.  
@@ -222,21 +602,23 @@ class Container(ABC):
               different mix behaviors within a class, though the container
               just uses it for mix iterations, and many subclasses might
               choose to ignore it.  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         '''
+        profile = profile if profile else self.DEFAULT_PROFILE
         #set aspiration height
         pipette.well_bottom_clearance.aspirate = self.asp_height
         #set dispense height to same as asp
         pipette.well_bottom_clearance.dispense = self.asp_height
         #do the actual mix
-        for i in range(2**mix_code):
-            pipette.mix(1, mix_vol, self.get_well(), rate=100.0)
+        for i in range(self._mix_reps(mix_code, profile)):
+            pipette.mix(1, mix_vol, self.get_well(), rate=profile.mix_rate)
             pipette.blow_out()
 
     def get_well(self):
         '''
         returns Opentrons...Well: the well object this container is in
         '''
-        return self.labware.wells_by_name()[self.loc]
+        return self.well
 
     @property
     def disp_height(self):
@@ -252,7 +634,7 @@ class Container(ABC):
 
     @property
     def MAX_VOL(self):
-        return self.labware.wells_by_name()[self.loc]._geometry._max_volume
+        return float(self.deck.max_vol[self.cid])
 
 class MultiContainer(Container):
     '''
@@ -278,6 +660,8 @@ class MultiContainer(Container):
           object, excpet aspirable vol.  
         int _cont_i: index of current cont in cont_list
         list<Containers> cont_list: The list of containers this class wraps.  
+        int group: the group of cont_list in the DeckState. aspirable_vol is kept by the
+          DeckState for the group, so it is not resummed on every access  
         df history: the history of this MultiContainer. This is a property that runs on top of
           the histories of the container_list  
     INHERITED ATTRIBUTES:  
@@ -291,17 +675,21 @@ class MultiContainer(Container):
     INHERITED METHODS:  
         _update_height void, update_vol(float del_vol) void,  
     '''
+    __slots__ = ('cont_list', '_cont_i', 'cont', 'group')
+
     def __init__(self,cont_list):
         self.cont_list = cont_list
         self._cont_i = 0
         self.cont = cont_list[self._cont_i]
+        self.group = self.cont.deck.new_group([cont.cid for cont in cont_list])
         
-    def aspirate(self, vol, pipette, lab_deck):
+    def aspirate(self, vol, pipette, lab_deck, profile=None):
         '''
         params:  
             float vol: the volume to pipette in uL  
             Opentrons.pipette pipette: the pipette to use in the transfer  
             np.array<Labware> lab_deck: the indexed arrray of labware  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         raises:  
             EmptyReagent if don't have enough volume to pipette  
         Note:  
@@ -328,11 +716,12 @@ class MultiContainer(Container):
         #set aspiration height
         pipette.well_bottom_clearance.aspirate = self.asp_height
         #aspirate(well_obj)
-        pipette.aspirate(vol, lab_deck[self.deck_pos].get_well(self.loc))
+        profile = profile if profile else self.DEFAULT_PROFILE
+        pipette.aspirate(vol, self.get_well(), rate=profile.aspirate_rate)
         #update the vol of src
         self.update_vol(-vol)
         #call cleanup
-        self._aspirate_cleanup(pipette)
+        self._aspirate_cleanup(pipette, profile)
 
     def _update_cont(self):
         '''
@@ -344,10 +733,11 @@ class MultiContainer(Container):
         raises:  
             IndexError if the cont index is out of bounds
         '''
+        self.cont.deck.retire(self.cont.cid)
         self._cont_i += 1
         self.cont = self.cont_list[self._cont_i]
 
-    def dispense(self, vol, pipette, lab_deck, src):
+    def dispense(self, vol, pipette, lab_deck, src, blow_out=True, profile=None):
         '''
         This should never be called on a multicontainer. It exists for class
         compatability, but will raise an error if called.  
@@ -365,7 +755,7 @@ class MultiContainer(Container):
 
     @property
     def aspiratible_vol(self):
-        return sum([container.aspiratible_vol for container in self.cont_list[self._cont_i:]])
+        return self.cont.deck.group_aspiratible[self.group]
     
     @property
     def history(self):
@@ -389,12 +779,24 @@ class MultiContainer(Container):
     def labware(self):
         return self.cont.labware
     @property
+    def well(self):
+        return self.cont.well
+    @property
     def vol(self):
         return self.cont.vol
     @property
     def conc(self):
         return self.cont.conc
     @property
+    def height(self):
+        return self.cont.height
+    @property
+    def deck(self):
+        return self.cont.deck
+    @property
+    def cid(self):
+        return self.cont.cid
+    @property
     def disp_height(self):
         return self.cont.disp_height
     @property
@@ -411,8 +813,14 @@ class MultiContainer(Container):
     def _aspirate_cleanup(self):
         return self.cont._aspirate_cleanup
     @property
+    def _dispense_cleanup(self):
+        return self.cont._dispense_cleanup
+    @property
     def rewrite_history_first(self):
         return self.cont.rewrite_history_first
+    @property
+    def get_well(self):
+        return self.cont.get_well
     #constants
     @property
     def MAX_VOL(self):
@@ -430,7 +838,9 @@ class Tube(Container):
     this is just the mix method for 20000 and 50000. 2000 overrides this method
     anyways.
     '''
-    def mix(self, pipette, mix_vol, mix_code):
+    __slots__ = ('mass',)
+
+    def mix(self, pipette, mix_vol, mix_code, profile=None):
         '''
         This method is used to mix the well. Part of the container because
         many of it's children will override this method to mix in a special way.  
@@ -442,8 +852,10 @@ class Tube(Container):
               different mix behaviors within a class, though the container
               just uses it for mix iterations, and many subclasses might
               choose to ignore it.  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         '''
-        NUM_HEIGHTS = 4
+        profile = profile if profile else self.DEFAULT_PROFILE
+        NUM_HEIGHTS = profile.mix_heights if profile.mix_heights else 4
         # create an array of heights with the first height just a little lower
         # than the surface
         # top height -4 is carefully tuned to get tip in liquid
@@ -468,8 +880,8 @@ class Tube(Container):
             #set dispense height to same as asp
             pipette.well_bottom_clearance.dispense = height
             #do the actual mix
-            for i in range(2**mix_code):
-                pipette.mix(1, mix_vol, self.get_well(), rate=100.0)
+            for i in range(self._mix_reps(mix_code, profile)):
+                pipette.mix(1, mix_vol, self.get_well(), rate=profile.mix_rate)
                 pipette.blow_out()
 
 class Tube20000uL(Tube):
@@ -485,10 +897,12 @@ class Tube20000uL(Tube):
         _update_height void, update_vol(float del_vol) void,  
     """
 
+    __slots__ = ()
     DEAD_VOL = 2000
     MIN_HEIGHT = 4
 
-    def __init__(self, name, deck_pos, loc, labware, mass=6.9731, conc=1):
+    def __init__(self, name, deck_pos, loc, labware, mass=6.9731, conc=1, journal=None, deck=None,
+            well=None):
         '''
         mass is defaulted to the avg_mass so that there is nothing in the container
         '''
@@ -497,7 +911,7 @@ class Tube20000uL(Tube):
         self.mass = mass - avg_tube_mass15 # N = 1 (in grams) 
         assert (self.mass >= -1e-9),'the mass you entered for {} is less than the mass of the tube it\'s in.'.format(name)
         vol = (self.mass / density_water_25C) * 1000 # converts mL to uL
-        super().__init__(name, deck_pos, loc, labware, vol, conc)
+        super().__init__(name, deck_pos, loc, labware, vol, conc, journal, deck, well)
        # 15mm diameter for 15 ml tube  -5: Five mL mark is 19 mm high for the base/noncylindrical protion of tube 
 
     def _update_height(self):
@@ -531,16 +945,18 @@ class Tube50000uL(Tube):
         _update_height void, update_vol(float del_vol) void,  
     """
 
+    __slots__ = ()
     DEAD_VOL = 5000
     MIN_HEIGHT = 4
 
-    def __init__(self, name, deck_pos, loc, labware, mass=13.3950, conc=1):
+    def __init__(self, name, deck_pos, loc, labware, mass=13.3950, conc=1, journal=None, deck=None,
+            well=None):
         density_water_25C = 0.9970479 # g/mL
         avg_tube_mass50 = 13.3950 # grams
         self.mass = mass - avg_tube_mass50 # N = 1 (in grams) 
         assert (self.mass >= -1e-9),'the mass you entered for {} is less than the mass of the tube it\'s in.'.format(name)
         vol = (self.mass / density_water_25C) * 1000 # converts mL to uL
-        super().__init__(name, deck_pos, loc, labware, vol, conc)
+        super().__init__(name, deck_pos, loc, labware, vol, conc, journal, deck, well)
        # 15mm diameter for 15 ml tube  -5: Five mL mark is 19 mm high for the base/noncylindrical protion of tube 
         
     def _update_height(self):
@@ -573,16 +989,18 @@ class Tube2000uL(Tube):
         _update_height void, update_vol(float del_vol) void,  
     """
 
+    __slots__ = ()
     DEAD_VOL = 250 #uL
     MIN_HEIGHT = 6
 
-    def __init__(self, name, deck_pos, loc, labware, mass=1.4, conc=2):
+    def __init__(self, name, deck_pos, loc, labware, mass=1.4, conc=2, journal=None, deck=None,
+            well=None):
         density_water_4C = 0.9998395 # g/mL
         avg_tube_mass2 =  1.4        # grams
         self.mass = mass - avg_tube_mass2 # N = 1 (in grams) 
         assert (self.mass >= -1e-9),'the mass you entered for {} is less than the mass of the tube it\'s in.'.format(name)
         vol = (self.mass / density_water_4C) * 1000 # converts mL to uL
-        super().__init__(name, deck_pos, loc, labware, vol, conc)
+        super().__init__(name, deck_pos, loc, labware, vol, conc, journal, deck, well)
            
     def _update_height(self):
         diameter_2 = 8.30 # mm
@@ -602,7 +1020,7 @@ class Tube2000uL(Tube):
         disp_height_above_liquid = 7 #mm above the liquid level
         return self.height + disp_height_above_liquid if self.height > height_disp_cutoff else min_disp_height
 
-    def mix(self, pipette, mix_vol, mix_code):
+    def mix(self, pipette, mix_vol, mix_code, profile=None):
         '''
         This method is used to mix the well. Part of the container because
         many of it's children will override this method to mix in a special way.  
@@ -614,17 +1032,20 @@ class Tube2000uL(Tube):
               different mix behaviors within a class, though the container
               just uses it for mix iterations, and many subclasses might
               choose to ignore it.  
+            LiquidProfile profile: how to handle the liquid. DEFAULT_PROFILE if None  
         '''
+        profile = profile if profile else self.DEFAULT_PROFILE
         #create an array of heights with the first height just a little lower than the surface
-        heights = np.linspace(self.MIN_HEIGHT, self.asp_height, 3)
+        heights = np.linspace(self.MIN_HEIGHT, self.asp_height,
+                profile.mix_heights if profile.mix_heights else 3)
         for height in heights:
             #set aspiration height
             pipette.well_bottom_clearance.aspirate = height
             #set dispense height to same as asp
             pipette.well_bottom_clearance.dispense = height
             #do the actual mix
-            for i in range(2**mix_code):
-                pipette.mix(1, mix_vol, self.get_well(), rate=100.0)
+            for i in range(self._mix_reps(mix_code, profile)):
+                pipette.mix(1, mix_vol, self.get_well(), rate=profile.mix_rate)
                 pipette.blow_out()
 
 class Well(Container, ABC):
@@ -640,11 +1061,13 @@ class Well(Container, ABC):
     INHERITED METHODS:  
         _update_height void, update_vol(float del_vol) void,  
     """
+    __slots__ = ()
     MIN_HEIGHT = 1
 
-    def __init__(self, name, deck_pos, loc, labware, vol=0, conc=1):
+    def __init__(self, name, deck_pos, loc, labware, vol=0, conc=1, journal=None, deck=None,
+            well=None):
         #vol is defaulted here because the well will probably start without anything in it
-        super().__init__(name, deck_pos, loc, labware, vol, conc)
+        super().__init__(name, deck_pos, loc, labware, vol, conc, journal, deck, well)
            
     def _update_height(self):
         #this method is not needed for a well of such small size because we always aspirate
@@ -673,6 +1096,7 @@ class Well96(Well):
     INHERITED METHODS:  
         _update_height void, update_vol(float del_vol) void,  
     """
+    __slots__ = ()
     DEAD_VOL = 40 #uL
 
     @property
@@ -692,6 +1116,7 @@ class Well24(Well):
     INHERITED METHODS:  
         _update_height void, update_vol(float del_vol) void,  
     '''
+    __slots__ = ()
     DEAD_VOL = 400 #uL
 
     @property
@@ -711,12 +1136,18 @@ class Labware(ABC):
         bool full: True if there are no more empty containers  
         int deck_pos: to map back to deck position  
         str name: the name associated with this labware  
+        list<Opentrons.Well> wells: the wells of labware in index order. Cached because
+          labware.wells() rebuilds the list on every call  
+        dict<str:Opentrons.Well> wells_by_name: maps loc to well. Cached for the same reason  
     CONSTANTS:  
         list<str> CONTAINERS_SERVICED: the container types on this labware  
     ABSTRACT METHODS:  
         get_container_type(loc) str: returns the type of container at that location  
         pop_next_well(vol=None) str: returns the index of the next available well
           If there are no available wells of the volume requested, return None  
+    METHODS:  
+        get_well(str loc) Opentrons.Well: the well at loc  
+        get_max_vol(str loc) float: the capacity of the well at loc  
     '''
 
     CONTAINERS_SERVICED = []
@@ -725,6 +1156,8 @@ class Labware(ABC):
         self.labware = labware
         self.full = False
         self.deck_pos = deck_pos
+        self.wells = labware.wells()
+        self.wells_by_name = labware.wells_by_name()
 
     @abstractmethod
     def pop_next_well(self, vol=None, container_type=None):
@@ -752,7 +1185,16 @@ class Labware(ABC):
         returns:  
             the opentrons well object at that location  
         '''
-        return self.labware.wells_by_name()[loc]
+        return self.wells_by_name[loc]
+
+    def get_max_vol(self, loc):
+        '''
+        params:  
+            str loc: the location on the labaware e.g. A1  
+        returns:  
+            float: the capacity of the well at that location in uL  
+        '''
+        return self.wells_by_name[loc]._geometry._max_volume
 
     @property
     def name(self):
@@ -762,37 +1204,48 @@ class TubeHolder(Labware):
     '''
     Subclass of Labware object that may not have all containers filled, and allows for diff
     sized containers  
+    Empty tubes are kept sorted by capacity, so a request is served best fit (the smallest
+    tube that can hold the volume) with a binary search  
     INHERITED METHODS:
-        pop_next_well(vol=None) str: Note vol is should be provided here, otherwise a random size
-          will be chosen  
+        pop_next_well(vol=None) str: Note vol is should be provided here, otherwise the smallest
+          tube will be chosen  
         get_container_type(loc) str  
     INHERITED_ATTRIBUTES:
         Opentrons.Labware labware, bool full, int deck_pos, str name  
     OVERRIDEN CONSTANTS
         list<str> CONTAINERS_SERVICED  
+    CONSTANTS:  
+        dict<str:tuple<float,float>> TUBE_CAPACITIES: maps container type to the (exclusive)
+          lower and (inclusive) upper bound of the capacities of that type  
     ATTRIBUTES:
         list<str> empty_tubes: contains locs of the empty tubes. Necessary because the user may
           not put tubes into every slot. Sorted order smallest tube to largest  
+        list<float> empty_capacities: the capacity of each tube in empty_tubes (sorted)  
+    METHODS:  
+        fragmentation_stats() dict<str:obj>: statistics on the empty tubes and allocations  
     '''
 
     CONTAINERS_SERVICED = ['Tube50000uL', 'Tube20000uL', 'Tube2000uL']
+    TUBE_CAPACITIES = {'Tube2000uL':(0, 2000), 'Tube20000uL':(2000, 20000),
+            'Tube50000uL':(20000, math.inf)}
 
     def __init__(self, labware, empty_tubes, deck_pos):
         super().__init__(labware,deck_pos)
-        #We create a dictionary of tubes with the container as the key and a list as the 
-        #value. The list contains all tubes that fit that volume range
-        self.empty_tubes={tube_type:[] for tube_type in self.CONTAINERS_SERVICED}
-        for tube in empty_tubes:
-            self.empty_tubes[self.get_container_type(tube)].append(tube)
+        #parallel lists sorted by capacity so that bisect can find the best fit
+        tubes = sorted([(self.get_max_vol(tube), tube) for tube in empty_tubes])
+        self.empty_capacities = [capacity for capacity, tube in tubes]
+        self.empty_tubes = [tube for capacity, tube in tubes]
         self.full = not self.empty_tubes
-
+        #running totals for fragmentation_stats
+        self._n_allocated = 0
+        self._allocated_capacity = 0.0
+        self._requested_vol = 0.0
 
     def pop_next_well(self, vol=None, container_type=None):
         '''
-        Gets the next available tube. If vol is specified, will return an
-        appropriately sized tube. Otherwise it will return a tube. It makes no guarentees that
-        tube will be the correct size. It is not recommended this method be called without
-        a volume argument  
+        Gets the smallest available tube that can hold vol. If container_type is specified, it
+        will be of that type. If vol is not specified, the smallest tube (of that type) is
+        returned. It is not recommended this method be called without a volume argument  
         params:  
             float vol: used to determine an appropriate sized tube  
             str container_type: the type of container requested  
@@ -800,49 +1253,56 @@ class TubeHolder(Labware):
             str: loc the location of the smallest next tube that can accomodate the volume  
             None: if it can't be accomodated  
         '''
-        if not self.full:
-            if container_type:
-                #here I'm assuming you wouldn't want to put more volume in a tube than it can fit
-                viable_tubes = self.empty_tubes[container_type]
-            elif vol:
-                #neat trick
-                viable_tubes = self.empty_tubes[self.get_container_type(vol=vol)]
-                if not viable_tubes:
-                    #but if it didn't work you need to check everything
-                    for tube_type in self.CONTAINERS_SERVICED:
-                        viable_tubes = self.empty_tubes[tube_type]
-                        if viable_tubes:
-                            #check if the volume is still ok
-                            capacity = self.labware.wells_by_name()[viable_tubes[0]]._geometry._max_volume
-                            if vol < capacity:
-                                break
-            else:
-                #volume was not specified
-                #return the next smallest tube.
-                #this always returns because you aren't empty
-                for tube_type in self.CONTAINERS_SERVICED:
-                    if self.empty_tubes[tube_type]:
-                        viable_tubes = self.empty_tubes[tube_type]
-                        break
-            if viable_tubes:
-                tube_loc = viable_tubes.pop()
-                self.update_full()
-                return tube_loc
-            else:
-                return None
-        else:
+        if self.full:
             #self.empty_tubes is empty!
             return None
+        lower, upper = self.TUBE_CAPACITIES[container_type] if container_type \
+                else (-math.inf, math.inf)
+        #first tube above the lower bound of the type, and big enough for vol
+        i = bisect.bisect_right(self.empty_capacities, lower)
+        if vol:
+            i = max(i, bisect.bisect_left(self.empty_capacities, vol))
+        if i >= bisect.bisect_right(self.empty_capacities, upper):
+            return None
+        capacity = self.empty_capacities.pop(i)
+        tube_loc = self.empty_tubes.pop(i)
+        self._n_allocated += 1
+        self._allocated_capacity += capacity
+        self._requested_vol += vol if vol else capacity
+        self.update_full()
+        return tube_loc
 
     def update_full(self):
         '''
         updates self.full
         '''
-        self.full=True
-        for tube_type in self.CONTAINERS_SERVICED:
-            if self.empty_tubes[tube_type]:
-                self.full = False
-                return
+        self.full = not self.empty_tubes
+
+    def fragmentation_stats(self):
+        '''
+        returns:  
+            dict<str:obj>: with keys  
+              + int n_empty: the number of empty tubes left  
+              + dict<str:int> n_empty_by_type: the number of empty tubes of each type  
+              + float empty_capacity: the total capacity of the empty tubes  
+              + float largest_empty: the capacity of the largest empty tube  
+              + float fragmentation: 1 - largest_empty/empty_capacity. 0 if all of the free
+                capacity is in one tube, approaching 1 as it is spread over many small tubes  
+              + int n_allocated: the number of tubes handed out  
+              + float wasted_vol: the capacity of the tubes handed out beyond what was requested  
+        '''
+        n_empty_by_type = {}
+        for container_type, (lower, upper) in self.TUBE_CAPACITIES.items():
+            n_empty_by_type[container_type] = \
+                    bisect.bisect_right(self.empty_capacities, upper) - \
+                    bisect.bisect_right(self.empty_capacities, lower)
+        empty_capacity = sum(self.empty_capacities)
+        largest_empty = self.empty_capacities[-1] if self.empty_capacities else 0.0
+        return {'n_empty':len(self.empty_tubes), 'n_empty_by_type':n_empty_by_type,
+                'empty_capacity':empty_capacity, 'largest_empty':largest_empty,
+                'fragmentation':1 - largest_empty / empty_capacity if empty_capacity else 0.0,
+                'n_allocated':self._n_allocated,
+                'wasted_vol':self._allocated_capacity - self._requested_vol}
         
     def get_container_type(self, loc=None, vol=None):
         '''
@@ -855,7 +1315,7 @@ class TubeHolder(Labware):
             str: the type of container at that loc  
         '''
         if not vol:
-            tube_capacity = self.labware.wells_by_name()[loc]._geometry._max_volume
+            tube_capacity = self.get_max_vol(loc)
         else:
             tube_capacity = vol
         if tube_capacity <= 2000:
@@ -882,12 +1342,12 @@ class WellPlate(Labware):
     def __init__(self, labware, first_well, deck_pos):
         super().__init__(labware, deck_pos)
         #allow for none initialization
-        all_wells = labware.wells()
+        all_wells = self.wells
         self.current_well = 0
         while self.current_well < len(all_wells) and all_wells[self.current_well]._impl._name != first_well:
             self.current_well += 1
         #if you overflowed you'll be correted here
-        self.full = self.current_well >= len(labware.wells())
+        self.full = self.current_well >= len(self.wells)
 
     def pop_next_well(self, vol=None,container_type=None):
         '''
@@ -900,12 +1360,12 @@ class WellPlate(Labware):
             None: if can't accomodate request  
         '''
         if not self.full:
-            well = self.labware.wells()[self.current_well] 
+            well = self.wells[self.current_well] 
             capacity = well._geometry._max_volume
             if capacity > vol:
                 #have a well that works
                 self.current_well += 1
-                self.full = self.current_well >= len(self.labware.wells())
+                self.full = self.current_well >= len(self.wells)
                 return well._impl._name
             else:
                 #requested volume is too large
@@ -971,6 +1431,184 @@ class WellPlate24(WellPlate):
         '''
         return 'Well24'
 
+class MotionPlanner():
+    '''
+    Orders the stops of the pipette head to keep XY travel short. A route starts at a fixed
+    point (e.g. the source) and visits every stop once without returning. It is built nearest
+    neighbor first, and then improved with 2-opt (reversing a stretch of the route whenever
+    that shortens it) until no reversal helps or MAX_PASSES is hit.  
+    CONSTANTS:  
+        int MAX_PASSES: the most 2-opt passes over the route  
+    METHODS:  
+        plan(tuple<float,float> start, list<tuple<float,float>> stops) list<int>: an order to
+          visit the stops in  
+        route_length(tuple<float,float> start, list<tuple<float,float>> stops, list<int> order)
+          float: the XY length of a route  
+    '''
+    MAX_PASSES = 20
+
+    def _distances(self, start, stops):
+        '''
+        params:  
+            tuple<float,float> start: the x, y the route starts at  
+            list<tuple<float,float>> stops: the x, y of each stop  
+        returns:  
+            np.array<float>: shape (n+1, n+1) distances between points. point 0 is start and
+              point i+1 is stops[i]  
+        '''
+        points = np.array([start] + list(stops), dtype=float)
+        return np.hypot(*(points[:, np.newaxis, :] - points[np.newaxis, :, :]).transpose(2, 0, 1))
+
+    def route_length(self, start, stops, order):
+        '''
+        params:  
+            tuple<float,float> start: the x, y the route starts at  
+            list<tuple<float,float>> stops: the x, y of each stop  
+            list<int> order: the order to visit stops in  
+        returns:  
+            float: the distance travelled in mm  
+        '''
+        route = np.array([0] + [i + 1 for i in order])
+        return float(self._distances(start, stops)[route[:-1], route[1:]].sum())
+
+    def plan(self, start, stops):
+        '''
+        params:  
+            tuple<float,float> start: the x, y the route starts at  
+            list<tuple<float,float>> stops: the x, y of each stop  
+        returns:  
+            list<int>: the indices of stops in the order they should be visited  
+        '''
+        dist = self._distances(start, stops)
+        #nearest neighbor. route holds point indices (0 is start)
+        route = [0]
+        unvisited = set(range(1, len(stops) + 1))
+        while unvisited:
+            nearest = min(unvisited, key=lambda point: dist[route[-1], point])
+            route.append(nearest)
+            unvisited.remove(nearest)
+        #2-opt. start stays first and the route is open, so reversing route[i:j+1] only changes
+        #the edges into route[i] and out of route[j]
+        for n_pass in range(self.MAX_PASSES):
+            improved = False
+            for i in range(1, len(route) - 1):
+                for j in range(i + 1, len(route)):
+                    before = dist[route[i-1], route[i]]
+                    after = dist[route[i-1], route[j]]
+                    if j + 1 < len(route):
+                        before += dist[route[j], route[j+1]]
+                        after += dist[route[i], route[j+1]]
+                    if after < before - 1e-9:
+                        route[i:j+1] = route[i:j+1][::-1]
+                        improved = True
+            if not improved:
+                break
+        return [point - 1 for point in route[1:]]
+
+class DeckAllocator():
+    '''
+    Hands out free slots on the deck for new containers. For every (labware request, container
+    type request) pair that has been asked for, it keeps a heap of the viable labware keyed by
+    (priority, deck_pos), so the preferred labware with room is on top. Labware that fills up
+    is dropped lazily when it reaches the top of a heap, rather than filtering and sorting the
+    whole deck for every product.  
+    ATTRIBUTES:  
+        np.array<Labware> lab_deck: the robot's lab_deck  
+        dict<str:dict> labware_types: OT2Robot._LABWARE_TYPES  
+        dict<str:int> priority: maps labware name to priority. Lower is prefered  
+    METHODS:  
+        allocate(float max_vol, str req_labware, str req_container) tuple<int,str,str>: finds a
+          slot  
+        allocate_all(df product_df) iter<tuple<str,int,str,str>>: finds slots for a product_df  
+    '''
+    def __init__(self, lab_deck, labware_types, priority):
+        '''
+        params:  
+            np.array<Labware> lab_deck: the robot's lab_deck. Should be fully initialized  
+            dict<str:dict> labware_types: OT2Robot._LABWARE_TYPES  
+            dict<str:int> priority: maps labware name to priority. Lower is prefered  
+        '''
+        self.lab_deck = lab_deck
+        self.labware_types = labware_types
+        self.priority = priority
+        self._heaps = {}
+
+    def _get_heap(self, req_labware, req_container):
+        '''
+        params:  
+            str req_labware: the requested labware name or group. Falsy for any  
+            str req_container: the requested container type. Falsy for any  
+        returns:  
+            list<tuple<int,int>>: a heap of (priority, deck_pos) of the viable labware. built on
+              first request  
+        '''
+        key = (req_labware, req_container)
+        if key not in self._heaps:
+            heap = []
+            for viable in self.lab_deck:
+                if viable:
+                    labware_ok = not req_labware or (viable.name == req_labware or \
+                            req_labware in self.labware_types[viable.name]['groups'])
+                            #last bit necessary for platereader-> platereader4/platereader7
+                    container_ok = not req_container or \
+                            (req_container in viable.CONTAINERS_SERVICED)
+                    if labware_ok and container_ok and not viable.full:
+                        heap.append((self.priority[viable.name], viable.deck_pos))
+            heapq.heapify(heap)
+            self._heaps[key] = heap
+        return self._heaps[key]
+
+    def allocate(self, max_vol, req_labware=None, req_container=None):
+        '''
+        params:  
+            float max_vol: the maximum volume the container will hold  
+            str req_labware: the requested labware name or group. Falsy for any  
+            str req_container: the requested container type. Falsy for any  
+        returns:  
+            tuple<int,str,str>: deck_pos, loc, and container_type of the slot  
+            None: if no viable labware has room  
+        '''
+        heap = self._get_heap(req_labware, req_container)
+        #labware that is not full but can't take max_vol. put back when done
+        skipped = []
+        slot = None
+        while heap and not slot:
+            viable = self.lab_deck[heap[0][1]]
+            if viable.full:
+                #lazy deletion
+                heapq.heappop(heap)
+                continue
+            loc = viable.pop_next_well(vol=max_vol, container_type=req_container)
+            if loc:
+                slot = (viable.deck_pos, loc, viable.get_container_type(loc))
+            else:
+                skipped.append(heapq.heappop(heap))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return slot
+
+    def allocate_all(self, product_df):
+        '''
+        A generator, so that the caller can build each container before the next slot is taken.
+        If a product doesn't fit, the slots of the products before it are then in use rather
+        than popped from their labware with no container  
+        params:  
+            df product_df: index is chem_name. columns are labware, container, and max_vol  
+        yields:  
+            tuple<str,int,str,str>: chem_name, deck_pos, loc, and container_type for each
+              product in order  
+        raises:  
+            Exception: if a product can't be fit on the deck  
+        '''
+        for chem_name, req_labware, req_container, max_vol in product_df.itertuples():
+            slot = self.allocate(max_vol, req_labware, req_container)
+            if not slot:
+                message = 'No containers to put {} with labware type {} and container type \
+                        {} with maximum volume {}.'.format(chem_name, \
+                        req_labware, req_container, max_vol) 
+                raise Exception(message)
+            yield (chem_name,) + slot
+
 #Robot
 class OT2Robot():
     """
@@ -993,11 +1631,23 @@ class OT2Robot():
         str root_p: the path to the root output  
         str debug_p: the path for debuging  
         str logs_p: the path to the log outputs  
+        WellHistoryJournal history_journal: journal of the volume changes of every container.
+          Kept at root_p/well_history.journal  
+        DeckState deck_state: the volumes, heights, etc. of every container in arrays  
+        DeckAllocator deck_allocator: finds free slots on lab_deck for new containers  
+        MotionPlanner motion_planner: orders the destinations of distributed transfers  
+        dict<str:LiquidProfile> _LIQUID_PROFILES: the handling profiles from
+          liquid_profiles.json by name  
+        dict<str:str> _REAGENT_PROFILES: maps reagent chem_names to a profile name  
+        dict<str:str> _CONTAINER_PROFILES: maps container class names to a profile name  
+        dict<str:float> _HEAD_SPEEDS: max speeds of the head in mm/s by axis  
         dict<str:tuple<Container,float>> dry_containers: maps container name to a container
           object and a volume of water needed to turn it into a reagent  
         dict<str:func> exec_funcs: a registry that holds all of the functions that respond to
           an armchair request mapped by their armchair command_type  
         opentrons.temp_module temp_module: the opentrons object for temperature controller  
+    CONSTANTS:  
+        list<str> BATCHABLE_TYPES: the command types that may be sent as sub commands of a batch  
     METHODS:  
         execute(command_type, cid, arguments) int: Takes in the recieved output of an Armchair
           recv_pack, and executes the command. Will usually send a ready (except for GHOST type)
@@ -1011,6 +1661,7 @@ class OT2Robot():
     _PIPETTE_TYPES = {"300uL_pipette":{"opentrons_name":"p300_single_gen2"},"1000uL_pipette":{"opentrons_name":"p1000_single_gen2"},"20uL_pipette":{"opentrons_name":"p20_single_gen2"}}
 
     exec_funcs = {} #a dictionary mapping armchair commands to their appropriate handler func
+    BATCHABLE_TYPES = ['transfer', 'pause', 'mix', 'make', 'home']
 
     def exec_func(name, exit_code, send_ready, exec_funcs):
         '''
@@ -1045,7 +1696,7 @@ class OT2Robot():
             return func
         return echo_func
 
-    def __init__(self, simulate, using_temp_ctrl, temp, labware_df, instruments, reagent_df, my_ip, controller_ip, portal, dry_containers_df):
+    def __init__(self, simulate, using_temp_ctrl, temp, labware_df, instruments, reagent_df, my_ip, controller_ip, portal, dry_containers_df, root_p='Eve_Out'):
         '''
         params:  
             bool simulate: if true, the robot will run in simulation mode only  
@@ -1068,6 +1719,7 @@ class OT2Robot():
                 + str loc: location on labware
                 + int deck_pos: the location on deck
                 + float required_vol: the volume of water needed to create the solution
+            str root_p: the directory to write output to. Wiped on init  
         postconditions:  
             protocol has been initialzied  
             containers and tip_racks have been created  
@@ -1077,6 +1729,7 @@ class OT2Robot():
               to operating with them  
         '''
         self._load_calibrations()
+        self._load_liquid_profiles()
         #convert args back to df
         labware_df = pd.DataFrame(labware_df)
         #index of reagent_df needs to be set because it can have multiple chemicals of same
@@ -1106,8 +1759,14 @@ class OT2Robot():
         labware_df['empty_list'] = labware_df['empty_list'].apply(lambda x: x.split(',')
                 if x else [])
         self._init_params()
-        self._init_directories()
+        self._init_directories(root_p)
+        self.history_journal = WellHistoryJournal(os.path.join(self.root_p, 'well_history.journal'))
+        self.deck_state = DeckState()
         self._init_labware(labware_df, using_temp_ctrl, temp)
+        self.deck_allocator = DeckAllocator(self.lab_deck, self._LABWARE_TYPES,
+                self._exec_init_containers.priority)
+        self.motion_planner = MotionPlanner()
+        self._xy_cache = {} #maps cid to the x, y of the top of that container
         self._init_dry_containers(dry_containers_df)
         self._init_instruments(instruments, labware_df)
         self._init_reagents(reagent_df)
@@ -1119,24 +1778,65 @@ class OT2Robot():
         with open("calibrations.json", 'r') as file:
             self._CALIBRATIONS = json.load(file)
 
-    def _init_directories(self):
+    def _load_liquid_profiles(self):
+        '''
+        Loads in the liquid handling profiles file. Every profile is a partial LiquidProfile
+        applied over Container.DEFAULT_PROFILE, so missing fields keep the default handling.  
+        Postconditions:  
+            _LIQUID_PROFILES, _REAGENT_PROFILES, _CONTAINER_PROFILES, and _HEAD_SPEEDS have
+              been loaded. If there is no liquid_profiles.json, everything uses the default  
+        '''
+        profiles_json = {}
+        if os.path.exists("liquid_profiles.json"):
+            with open("liquid_profiles.json", 'r') as file:
+                profiles_json = json.load(file)
+        self._LIQUID_PROFILES = {'default':Container.DEFAULT_PROFILE}
+        for name, fields in profiles_json.get('profiles', {}).items():
+            self._LIQUID_PROFILES[name] = Container.DEFAULT_PROFILE._replace(**fields)
+        self._REAGENT_PROFILES = profiles_json.get('reagents', {})
+        self._CONTAINER_PROFILES = profiles_json.get('container_types', {})
+        for profile_name in list(self._REAGENT_PROFILES.values()) + \
+                list(self._CONTAINER_PROFILES.values()):
+            assert (profile_name in self._LIQUID_PROFILES), "liquid profile {} is used but not defined".format(profile_name)
+        self._HEAD_SPEEDS = profiles_json.get('head_speeds', {'X':250, 'Y':250})
+
+    def _get_profile(self, chem_name):
+        '''
+        A profile for the reagent takes precedence over a profile for its container type  
+        params:  
+            str chem_name: the name of the chemical being handled  
+        returns:  
+            LiquidProfile: the profile to handle chem_name with  
+        '''
+        if chem_name in self._REAGENT_PROFILES:
+            return self._LIQUID_PROFILES[self._REAGENT_PROFILES[chem_name]]
+        cont = self.containers[chem_name]
+        if isinstance(cont, MultiContainer):
+            cont = cont.cont
+        cont_type = type(cont).__name__
+        if cont_type in self._CONTAINER_PROFILES:
+            return self._LIQUID_PROFILES[self._CONTAINER_PROFILES[cont_type]]
+        return Container.DEFAULT_PROFILE
+
+    def _init_directories(self, root_p):
         '''
         The debug/directory structure of the robot is not intended to be stored for long periods
         of time. This is becuase the files should be shipped over FTP to laptop. In the event
         of an epic fail, e.g. where network went down and has no means to FTP back to laptop  
+        params:  
+            str root_p: the path to the root output  
         Postconditions: the following directory structure has been contstructed
-            Eve_Out: root  
+            root_p: root (Eve_Out by default)  
                 Debug: populated with error information. Used on crash  
                 Logs: log files for eve  
         '''
         #clean up last time
-        if os.path.exists('Eve_Out'):
-            shutil.rmtree('Eve_Out')
+        if os.path.exists(root_p):
+            shutil.rmtree(root_p)
         #make new folders
-        os.mkdir('Eve_Out')
-        os.mkdir('Eve_Out/Debug')
-        os.mkdir('Eve_Out/Logs')
-        self.root_p = 'Eve_Out/'
+        os.makedirs(os.path.join(root_p, 'Debug'))
+        os.makedirs(os.path.join(root_p, 'Logs'))
+        self.root_p = root_p
         self.debug_p = os.path.join(self.root_p, 'Debug')
         self.logs_p = os.path.join(self.root_p, 'Logs')
 
@@ -1214,10 +1914,16 @@ class OT2Robot():
           **kwargs:  
             + float mass: the mass of the starting contents  
             + float conc: the concentration of the starting components  
+            + WellHistoryJournal journal: defaults to self.history_journal  
+            + DeckState deck: defaults to self.deck_state  
+            + Opentrons...Well well: defaults to the cached well of the labware at loc  
         returns:  
             Container: a container object of the type you specified  
         '''
         labware = self.lab_deck[deck_pos].labware
+        kwargs.setdefault('journal', self.history_journal)
+        kwargs.setdefault('well', self.lab_deck[deck_pos].get_well(loc))
+        kwargs.setdefault('deck', self.deck_state)
         if container_type == 'Tube2000uL':
             return Tube2000uL(name, deck_pos, loc, labware, **kwargs)
         elif container_type == 'Tube20000uL':
@@ -1236,10 +1942,10 @@ class OT2Robot():
        
     def _init_params(self):
         '''
-        Set speed to something we like
+        Set speed to something we like. Set by head_speeds in liquid_profiles.json
         '''
-        self.protocol.max_speeds['X'] = 250
-        self.protocol.max_speeds['Y'] = 250
+        for axis, speed in self._HEAD_SPEEDS.items():
+            self.protocol.max_speeds[axis] = speed
 
     def _init_temp_mod(self, name, using_temp_ctrl, temp, deck_pos, empty_tubes):
         '''
@@ -1407,42 +2113,16 @@ class OT2Robot():
             every container has been initialized according to the parameters specified  
         '''
         product_df = pd.DataFrame(product_df)
-        for chem_name, req_labware, req_container, max_vol in product_df.itertuples():
-            container = None
-            #if you've already initialized this complane
-            if chem_name in self.containers:
+        #if you've already initialized this complane
+        duplicates = product_df.index[product_df.index.duplicated()]
+        for chem_name in product_df.index:
+            if chem_name in self.containers or chem_name in duplicates:
                 raise Exception("you tried to initialize {},\
                         but there is already an entry for {}".format(chem_name, chem_name))
-            #filter labware
-            viable_labware =[]
-            for viable in self.lab_deck:
-                if viable:
-                    labware_ok = not req_labware or (viable.name == req_labware or \
-                            req_labware in self._LABWARE_TYPES[viable.name]['groups'])
-                            #last bit necessary for platereader-> platereader4/platereader7
-                    container_ok = not req_container or (req_container in viable.CONTAINERS_SERVICED)
-                    if labware_ok and container_ok:
-                        viable_labware.append(viable)
-            #sort the list so that platreader slots are prefered
-            viable_labware.sort(key=lambda x: self._exec_init_containers.priority[x.name])
-            #iterate through the filtered labware and pick the first one that 
-            loc, deck_pos, container_type  = None, None, None
-            i = 0
-            while not loc:
-                try:
-                    viable = viable_labware[i]
-                except IndexError: 
-                    message = 'No containers to put {} with labware type {} and container type \
-                            {} with maximum volume {}.'.format(chem_name, \
-                            req_labware, req_container, max_vol) 
-                    raise Exception(message)
-                next_container_loc = viable.pop_next_well(vol=max_vol,container_type=req_container)
-                if next_container_loc:
-                    #that piece of labware has space for you
-                    loc = next_container_loc
-                    deck_pos = viable.deck_pos
-                    container_type = viable.get_container_type(loc)
-                i += 1
+        #assign every product a slot in one pass, prefering platereader slots. Each container is
+        #built as soon as its slot is taken
+        for chem_name, deck_pos, loc, container_type in \
+                self.deck_allocator.allocate_all(product_df):
             self.containers[chem_name] = self._construct_container(container_type, 
                     chem_name, deck_pos, loc)
 
@@ -1530,16 +2210,14 @@ class OT2Robot():
         pipette = self.pipettes[arm]['pipette']
         self.pipettes[arm]['last_used'] = chem_name #gotta update the last used
         cont = self.containers[chem_name]
+        profile = self._get_profile(chem_name)
         #perform the mix
-        cont.mix(pipette, self.pipettes[arm]['size'], mix_code)
+        cont.mix(pipette, self.pipettes[arm]['size'], mix_code, profile)
         
         #pull a little out of that well and shake off the drops
         pipette.well_bottom_clearance.dispense = cont.disp_height
-        #blowout
-        for i in range(4):
-            pipette.blow_out()
-        #wiggle - touch tip (spin fast inside well)
-        pipette.touch_tip(radius=0.3,speed=40)
+        #blowout and wiggle
+        cont._dispense_cleanup(pipette, True, profile)
 
     def _get_necessary_vol(self, mass, molar_mass, conc):
         '''
@@ -1612,14 +2290,21 @@ class OT2Robot():
         '''
         response = []
         #permits the str all of wellnames
-        wellnames = self.containers.keys() if wellnames == 'all' else wellnames
-        for name in wellnames:
-            cont = self.containers[name]
+        wellnames = list(self.containers.keys()) if wellnames == 'all' else wellnames
+        conts = [self.containers[name] for name in wellnames]
+        #read the volumes of every requested container from the deck state at once
+        cids = [cont.cid for cont in conts]
+        vols = self.deck_state.vol[cids]
+        aspiratible_vols = self.deck_state.aspiratible_vols(cids)
+        for i, (name, cont) in enumerate(zip(wellnames, conts)):
+            #a multicontainer can aspirate from all of its remaining containers
+            aspiratible_vol = cont.aspiratible_vol if isinstance(cont, MultiContainer) \
+                    else aspiratible_vols[i]
             response.append((name,
                     cont.loc,
                     cont.deck_pos,
-                    cont.vol,
-                    cont.aspiratible_vol))
+                    float(vols[i]),
+                    float(aspiratible_vol)))
         self.portal.send_pack('loc_resp', response)
 
     @exec_func('pause', 1, True, exec_funcs)
@@ -1634,22 +2319,186 @@ class OT2Robot():
             time.sleep(pause_time)
 
     @exec_func('transfer', 1, True, exec_funcs)
-    def _exec_transfer(self, src, transfer_steps):
+    def _exec_transfer(self, src, transfer_steps, distribute=False, disposal_vol=0.0):
         '''
         this command executes a transfer. 
         params:  
             str src: the chem_name of the source well  
             list<tuple<str,float>> transfer_steps: each element is a dst, vol pair  
+            bool distribute: if true, each aspiration is dispensed into as many destinations as
+              the pipette can hold (see _distribute)  
+            float disposal_vol: in distribute mode, the extra volume aspirated with each load
+              and blown out to trash after the last dispense of the load  
         '''
         #check to make sure that both tips are not dirty with a chemical other than the one you will pipette
         for arm in self.pipettes.keys():
             if self.pipettes[arm]['last_used'] not in ['WaterC1.0', 'clean', src]:
                 self._get_clean_tips()
                 break; #cause now they're clean
+        if distribute:
+            self._distribute(src, transfer_steps, disposal_vol)
+            return
         for dst, vol in transfer_steps:
             self._transfer_step(src,dst,vol)
             new_tip=False #don't want to use a new tip_next_time
 
+    def _distribute(self, src, transfer_steps, disposal_vol):
+        '''
+        executes transfer steps by aspirating once for multiple destinations. Steps are grouped
+        by the pipette they prefer, and ordered by the motion planner to keep the head's travel
+        short. They are then packed in order into loads that fit in that pipette (with the
+        disposal volume). Each load is aspirated once and dispensed into each of its
+        destinations without blowing out. The disposal volume is then blown out to trash.  
+        Steps too large to share a load are transfered normally.  
+        params:  
+            str src: the chem_name of the source well  
+            list<tuple<str,float>> transfer_steps: each element is a dst, vol pair  
+            float disposal_vol: extra volume to aspirate with each load  
+        Postconditions:  
+            every dst has recieved exactly its vol, and has a history entry for it  
+            src has been debited the volume of each load (including disposal)  
+        '''
+        steps_by_arm = {}
+        for dst, vol in transfer_steps:
+            steps_by_arm.setdefault(self._get_preffered_pipette(vol), []).append((dst, vol))
+        for arm, steps in steps_by_arm.items():
+            steps = self._plan_route(src, steps)
+            capacity = self.pipettes[arm]['size']
+            load = []
+            load_vol = disposal_vol
+            for dst, vol in steps:
+                if vol + disposal_vol > capacity:
+                    #doesn't fit in a load on it's own
+                    self._transfer_step(src, dst, vol)
+                    continue
+                if load_vol + vol > capacity + 1e-9:
+                    self._distribute_load(src, load, disposal_vol, arm)
+                    load = []
+                    load_vol = disposal_vol
+                load.append((dst, vol))
+                load_vol += vol
+            if load:
+                self._distribute_load(src, load, disposal_vol, arm)
+
+    def _get_xy(self, chem_name):
+        '''
+        params:  
+            str chem_name: the name of a container  
+        returns:  
+            tuple<float,float>: the deck x, y of the top of the container in mm  
+        '''
+        cont = self.containers[chem_name]
+        if cont.cid not in self._xy_cache:
+            point = cont.get_well().top().point
+            self._xy_cache[cont.cid] = (point.x, point.y)
+        return self._xy_cache[cont.cid]
+
+    def _plan_route(self, src, steps):
+        '''
+        reorders steps so the head travels as little as possible going from src through each
+        dst. The planner only finds a local optimum, so the planned route is used (and the
+        predicted travel saved printed) only if it is shorter than the order of steps  
+        params:  
+            str src: the chem_name of the source  
+            list<tuple<str,float>> steps: dst, vol pairs  
+        returns:  
+            list<tuple<str,float>>: the same steps in the planned order, or steps if planning
+              didn't shorten the route  
+        '''
+        if len(steps) < 2:
+            #nothing to reorder
+            return steps
+        start = self._get_xy(src)
+        stops = [self._get_xy(dst) for dst, vol in steps]
+        order = self.motion_planner.plan(start, stops)
+        before = self.motion_planner.route_length(start, stops, list(range(len(steps))))
+        after = self.motion_planner.route_length(start, stops, order)
+        if before - after <= 1e-6:
+            return steps
+        print('<<eve>> planned route from {} through {} destinations: {:.1f}mm, saving {:.1f}mm'.format(
+                src, len(steps), after, before - after))
+        return [steps[i] for i in order]
+
+    def _distribute_load(self, src, load, disposal_vol, arm):
+        '''
+        aspirates a load once and dispenses it into each of its destinations  
+        params:  
+            str src: the chem_name of the source container  
+            list<tuple<str,float>> load: the dst, vol pairs to dispense. Must fit in the pipette
+              with the disposal volume  
+            float disposal_vol: extra volume to aspirate, and blow out to trash at the end  
+            str arm: the robot arm to use  
+        '''
+        for arm_to_check in self.pipettes.keys():
+            assert (self.pipettes[arm_to_check]['last_used'] in ['clean', 'WaterC1.0', src]), "trying to distribute {}, with {} arm, but {} arm was dirty with {}".format(src, arm, arm_to_check, self.pipettes[arm_to_check]['last_used'])
+        self.protocol._commands.append('HEAD: {} : distributing {} to {}'.format(datetime.now(pytz.timezone('US/Pacific')).strftime('%d-%b-%Y %H:%M:%S:%f'), src, ', '.join([dst for dst, vol in load])))
+        pipette = self.pipettes[arm]['pipette']
+        profile = self._get_profile(src)
+        self._aspirate_src(src, sum([vol for dst, vol in load]) + disposal_vol, arm)
+        for i, (dst, vol) in enumerate(load):
+            #blow out after the last destination only if there is no disposal volume to keep
+            last_dst = i == len(load) - 1
+            self.containers[dst].dispense(vol, pipette, self.lab_deck, src,
+                    blow_out=last_dst and not disposal_vol, profile=profile)
+        if disposal_vol:
+            pipette.blow_out(self.protocol.fixed_trash['A1'])
+
+    @exec_func('batch', 1, True, exec_funcs)
+    def _exec_batch(self, commands):
+        '''
+        executes the sub commands of a batch in order. A single ready is sent for the whole
+        batch once they have all executed  
+        Consecutive distributed transfers from the same source are merged into one, so that
+        the motion planner can order all of their destinations together  
+        params:  
+            list<tuple<str,tuple>> commands: each element is a command type and the args for
+              that command  
+        raises:  
+            BatchCommandError: if a sub command fails. Has the index of the failed sub command
+              (the first of the merged transfers if it was a merged transfer)  
+        '''
+        i = 0
+        while i < len(commands):
+            command_type, arguments = commands[i]
+            assert (command_type in self.BATCHABLE_TYPES), \
+                    "command '{}' cannot be batched".format(command_type)
+            n_merged = 1
+            if command_type == 'transfer':
+                arguments, n_merged = self._merge_distributes(commands, i)
+            try:
+                #the unwrapped handler, so that sub commands don't send their own readys
+                self.exec_funcs[command_type].__wrapped__(self, *arguments)
+            except Exception as e:
+                raise BatchCommandError(i, command_type, e) from e
+            i += n_merged
+
+    def _merge_distributes(self, commands, i):
+        '''
+        params:  
+            list<tuple<str,tuple>> commands: the sub commands of a batch  
+            int i: the index of a transfer in commands  
+        returns:  
+            tuple: the arguments of a transfer with the steps of commands[i] and every
+              distributed transfer right after it with the same source and disposal volume  
+            int: the number of commands merged  
+        '''
+        def distribute_key(arguments):
+            #(src, disposal_vol) of a distributed transfer, or None if not distributed
+            if len(arguments) > 2 and arguments[2]:
+                return (arguments[0], arguments[3] if len(arguments) > 3 else 0.0)
+            return None
+        arguments = commands[i][1]
+        key = distribute_key(arguments)
+        if key is None:
+            return arguments, 1
+        steps = list(arguments[1])
+        j = i + 1
+        while j < len(commands) and commands[j][0] == 'transfer' and \
+                distribute_key(commands[j][1]) == key:
+            steps += commands[j][1][1]
+            j += 1
+        return (key[0], steps, True, key[1]), j - i
+
     @exec_func('stop', 1, True, exec_funcs)
     def _exec_stop(self):
         '''
@@ -1680,7 +2529,6 @@ class OT2Robot():
         #transfer the liquid in as many steps are necessary
         for i in range(n_substeps):
             self._liquid_transfer(src, dst, substep_vol, arm)
-        self.dump_well_histories()
         return
 
     def _get_clean_tips(self):
@@ -1764,14 +2612,31 @@ class OT2Robot():
             assert (self.pipettes[arm_to_check]['last_used'] in ['clean', 'WaterC1.0', src]), "trying to transfer {}->{}, with {} arm, but {} arm was dirty with {}".format(src, dst, arm, arm_to_check, self.pipettes[arm_to_check]['last_used'])
         self.protocol._commands.append('HEAD: {} : transfering {} to {}'.format(datetime.now(pytz.timezone('US/Pacific')).strftime('%d-%b-%Y %H:%M:%S:%f'), src, dst))
         pipette = self.pipettes[arm]['pipette']
-        src_cont = self.containers[src] #the src container
         dst_cont = self.containers[dst] #the dst container
+        self._aspirate_src(src, vol, arm)
+        #dispense into destination container
+        dst_cont.dispense(vol, pipette, self.lab_deck, src, profile=self._get_profile(src))
 
+    def _aspirate_src(self, src, vol, arm):
+        '''
+        aspirates from src, making more of src if it runs out  
+        params:  
+            str src: the chemical name of the source container  
+            float vol: the volume to aspirate  
+            str arm: the robot arm to use  
+        Postconditions:  
+            the pipette on arm holds vol of src and is marked dirty with src  
+        raises:  
+            EmptyReagent: if src is empty and more can't be made  
+        '''
+        pipette = self.pipettes[arm]['pipette']
         sufficient_vol = False
         #attempt to aspirate and make if you can't
         while not sufficient_vol:
             try:
-                src_cont.aspirate(vol, pipette, self.lab_deck)
+                #looked up every time because a make replaces the container
+                self.containers[src].aspirate(vol, pipette, self.lab_deck,
+                        self._get_profile(src))
                 #pipette is now dirty
                 self.pipettes[arm]['last_used'] = src
                 sufficient_vol=True
@@ -1785,8 +2650,6 @@ class OT2Robot():
                     raise e
         #update the pipette to be dirty
         self.pipettes[arm]['last_used'] = src
-        #dispense into destination container
-        dst_cont.dispense(vol, pipette, self.lab_deck, src)
 
     def dump_well_map(self):
         '''
@@ -1796,7 +2659,7 @@ class OT2Robot():
         names = self.containers.keys()
         locs = []
         deck_poses = []
-        vols = []
+        cids = []
         chem_names = []
         container_types = []
         for name in names:
@@ -1808,7 +2671,7 @@ class OT2Robot():
                 for subcont in cont.cont_list:
                     locs.append(subcont.loc)
                     deck_poses.append(subcont.deck_pos)
-                    vols.append(subcont.vol)
+                    cids.append(subcont.cid)
                     chem_names.append(name)
                     container_types.append(
                             self.lab_deck[cont.deck_pos].get_container_type(cont.loc)
@@ -1817,11 +2680,13 @@ class OT2Robot():
                 #is just a regular container
                 locs.append(cont.loc)
                 deck_poses.append(cont.deck_pos)
-                vols.append(cont.vol)
+                cids.append(cont.cid)
                 chem_names.append(name)
                 container_types.append(
                         self.lab_deck[cont.deck_pos].get_container_type(cont.loc)
                         )
+        #read every volume from the deck state at once
+        vols = self.deck_state.vol[cids]
         well_map = pd.DataFrame({'chem_name':list(chem_names), 'loc':locs, 'deck_pos':deck_poses, 
                 'vol':vols,'container':container_types})
         well_map.sort_values(by=['deck_pos', 'loc'], inplace=True)
@@ -1838,19 +2703,12 @@ class OT2Robot():
 
     def dump_well_histories(self):
         '''
-        gathers the history of every reaction and puts it in a single df. Writes that df to file
+        exports the history of every container from the journal to well_history.tsv. Rows are
+        in the order they were journaled, so rows that were already shipped keep their place
+        (see _exec_save)
         '''
         path=os.path.join(self.logs_p, 'well_history.tsv')
-        histories=[]
-        for name, container in self.containers.items():
-            df = pd.DataFrame(container.history, columns=['timestamp', 'chemical', 'vol'])
-            df['container'] = name
-            histories.append(df)
-        all_history = pd.concat(histories, ignore_index=True)
-        all_history['timestamp'] = pd.to_datetime(all_history['timestamp'], format='%d-%b-%Y %H:%M:%S:%f')
-        all_history.sort_values(by=['timestamp'], inplace=True)
-        all_history.reset_index(inplace=True, drop=True)
-        all_history.to_csv(path, index=False, sep='\t')
+        self.history_journal.export(path, self.containers)
 
     def exception_handler(self, e):
         '''
@@ -1876,15 +2734,25 @@ class OT2Robot():
             pipette = arm_dict['pipette']
             pipette.drop_tip()
         self.protocol.home()
+        #report how well the tube racks were used, so they can be loaded better next time
+        for labware in self.lab_deck:
+            if isinstance(labware, TubeHolder):
+                print('<<eve>> tube holder {} at {}: {}'.format(labware.name, labware.deck_pos,
+                        labware.fragmentation_stats()))
+        self.history_journal.close()
         self.portal.send_pack('ready', cid)
         #kill link
         print('<<eve>> shutting down')
         self.portal.close()
 
     @exec_func('save', 1, False, exec_funcs)
-    def _exec_save(self):
+    def _exec_save(self, full=False):
         '''
         saves state, and then ships files back to controller over FTP  
+        By default only the bytes appended to each file since the last save are shipped. Files
+        that were rewritten (e.g. wellmap.tsv when volumes change) are shipped in full  
+        params:  
+            bool full: if True, every file is shipped in full so the controller can resync  
         '''
         #write logs
         self.dump_protocol_record()
@@ -1893,13 +2761,16 @@ class OT2Robot():
         #ship logs
         filenames = list(os.listdir(self.logs_p))
         filepaths = [os.path.join(self.logs_p, filename) for filename in filenames]
-        self.portal.send_ftp(filepaths)
-        
+        self.portal.send_ftp(filepaths, incremental=not full)
+
     def _error_handler(self, e):
         try:
             print('''<<eve>> ----------------Eve Errror--------------
             Sending Error packet''')
-            self.portal.send_pack('error', e)
+            if isinstance(e, BatchCommandError):
+                self.portal.send_pack('error', e, e.index)
+            else:
+                self.portal.send_pack('error', e)
             print('<<eve>> Waiting on close')
             self.portal.recv_first('save')
             self._exec_save()
@@ -1915,22 +2786,37 @@ def launch_eve_server(**kwargs):
     **kwargs:  
         + str my_ip: the ip address to launch the server on. required arg  
         + threading.Barrier barrier: if specified, will launch as a thread instead of a main  
+        + Transport transport: if specified, the server talks to the controller over this  
+          (e.g. an in memory pipe for simulation) instead of listening on a socket  
+        + str root_p: the directory for eve's output. Defaults to Eve_Out  
+        + str record_path: if specified, the session is recorded to this file for replay  
+        + str log_path: the directory for the Armchair log and metrics. Defaults to
+          Armchair_Logs beside root_p. It can't be in root_p, because root_p is wiped when
+          the robot is initialized, after the log has been opened  
     '''
     my_ip = kwargs['my_ip']
-    PORT_NUM = 50000
-    #construct a socket
-    sock = socket.socket(socket.AF_INET)
-    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-    sock.bind((my_ip,PORT_NUM))
-    print('<<eve>> listening on port {}'.format(PORT_NUM))
-    sock.listen(5)
-    if kwargs['barrier']:
-        #running in thread mode with barrier. Barrier waits for both threads
-        kwargs['barrier'].wait()
-    client_sock, client_addr = sock.accept()
+    root_p = kwargs.get('root_p', 'Eve_Out')
+    record_path = kwargs.get('record_path')
+    log_path = kwargs.get('log_path', os.path.join(os.path.dirname(os.path.abspath(root_p)),
+            'Armchair_Logs'))
+    sock = None
+    if kwargs.get('transport'):
+        portal = Armchair(kwargs['transport'],'eve',log_path, record_path=record_path)
+    else:
+        PORT_NUM = 50000
+        #construct a socket
+        sock = socket.socket(socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind((my_ip,PORT_NUM))
+        print('<<eve>> listening on port {}'.format(PORT_NUM))
+        sock.listen(5)
+        if kwargs['barrier']:
+            #running in thread mode with barrier. Barrier waits for both threads
+            kwargs['barrier'].wait()
+        client_sock, client_addr = sock.accept()
+        buffered_sock = BufferedSocket(client_sock, timeout=None)
+        portal = Armchair(buffered_sock,'eve',log_path, record_path=record_path)
     print('<<eve>> connected')
-    buffered_sock = BufferedSocket(client_sock, timeout=None)
-    portal = Armchair(buffered_sock,'eve','Armchair_Logs')
     eve = None
     pack_type, cid, args = portal.recv_pack()
     if pack_type == 'init':
@@ -1938,15 +2824,39 @@ def launch_eve_server(**kwargs):
         #I don't know why this line is needed, but without it, Opentrons crashes because it doesn't
         #like to be run from a thread
         asyncio.set_event_loop(asyncio.new_event_loop())
-        eve = OT2Robot(simulate, using_temp_ctrl, temp, labware_df, instruments, reagents_df,my_ip, controller_ip, portal, dry_containers_df)
+        eve = OT2Robot(simulate, using_temp_ctrl, temp, labware_df, instruments, reagents_df,my_ip, controller_ip, portal, dry_containers_df, root_p)
         portal.send_pack('ready', cid)
     connection_open=True
     while connection_open:
         pack_type, cid, payload = portal.recv_pack()
         connection_open = eve.execute(pack_type, cid, payload)
-    sock.close()
+    if sock:
+        sock.close()
     return
 
+def replay_eve_session(session_path, realtime=False, root_p='Eve_Out_Replay'):
+    '''
+    replays the controller's side of a recorded session into a simulated eve server. Used to
+    benchmark changes to the robot against real sessions  
+    params:  
+        str session_path: the path to a session recorded by either end (see Armchair/recorder.py)  
+        bool realtime: True to send commands no faster than they were recorded. Otherwise
+          commands are sent as fast as flow control allows  
+        str root_p: the directory for eve's output. Both ends log to Armchair_Logs beside it  
+    returns:  
+        float: the seconds it took eve to execute the session  
+    '''
+    controller_end, eve_end = make_pipe()
+    eve_thread = threading.Thread(target=launch_eve_server, kwargs={'my_ip':'','barrier':None,
+            'transport':eve_end, 'root_p':root_p}, name='eve_thread')
+    eve_thread.start()
+    playback = ControllerPlayback(SessionReader(session_path), controller_end, realtime,
+            os.path.join(os.path.dirname(os.path.abspath(root_p)), 'Armchair_Logs'))
+    elapsed = playback.run()
+    eve_thread.join()
+    print('<<eve>> replayed {} in {:.3f}s'.format(session_path, elapsed))
+    return elapsed
+
 
 
 def hack_to_get_ip():
@@ -0,0 +1,101 @@
+'''
+tests of AsyncArmchair against a synchronous Armchair playing the robot  
+'''
+import asyncio
+import os
+import socket
+import threading
+
+import pytest
+from boltons.socketutils import BufferedSocket
+
+from Armchair.armchair import Armchair
+from Armchair.async_armchair import AsyncArmchair
+
+LOCS = {'A1':('A1', 'Tube2000uL', 1, 100.0, 50.0), 'B1':('B1', 'Tube20000uL', 2, 500.0, 300.0)}
+
+def serve(sock, wellmap_path):
+    '''
+    plays the robot: answers two loc_reqs sent back to back, errors on the first command, sends
+    files for a save and acks the close  
+    params:  
+        socket sock: the robot's end of the connection  
+        str wellmap_path: the file to send for the save
+    '''
+    portal = Armchair(BufferedSocket(sock, timeout=10), 'eve', log_enabled=False,
+            metrics_enabled=False)
+    first = portal.recv_pack()
+    second = portal.recv_pack()
+    for pack_type, cid, (wellnames,) in [first, second]:
+        assert pack_type == 'loc_req'
+        portal.send_pack('loc_resp', [LOCS[wellname] for wellname in wellnames])
+    #a loc_req that is never answered, and then a command that fails
+    assert portal.recv_pack()[0] == 'loc_req'
+    pack_type, cid, _ = portal.recv_pack()
+    assert pack_type == 'home'
+    portal.send_pack('error', ValueError('no tips'))
+    assert portal.recv_pack()[0] == 'save'
+    portal.send_ftp([wellmap_path])
+    pack_type, cid, _ = portal.recv_pack()
+    assert pack_type == 'close'
+    portal.send_pack('ready', cid)
+    portal.close()
+
+async def converse(sock, dst_path):
+    '''
+    plays the controller  
+    params:  
+        socket sock: the controller's end of the connection  
+        str dst_path: the directory to save files to  
+    returns:  
+        list: what was observed, in order
+    '''
+    reader, writer = await asyncio.open_connection(sock=sock)
+    portal = AsyncArmchair(reader, writer, 'controller', log_enabled=False)
+    await portal.start()
+    errors = []
+    portal.handlers['error'] = lambda cid, payload: errors.append(payload[0])
+    observed = []
+    #both are in flight at once, and each gets its own response
+    observed.append(await asyncio.gather(portal.request('loc_req', ['B1']),
+            portal.request('loc_req', ['A1'])))
+    unanswered = asyncio.ensure_future(portal.request('loc_req', ['A1']))
+    waiting = asyncio.ensure_future(portal.recv('continue'))
+    await asyncio.sleep(0)
+    await portal.send_pack('home')
+    #everything waiting fails, but the reader keeps going
+    for pending in [unanswered, waiting]:
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(pending, 5)
+    observed.append((portal.state, errors))
+    #the error flow: save, reset, and close
+    files, stale = await asyncio.wait_for(portal.request_ftp(dst_path), 5)
+    observed.append(([filename for filename, _ in files], stale))
+    with pytest.raises(ConnectionError):
+        await portal.send_pack('close')
+    portal.reset_error()
+    await portal.send_pack('close')
+    await asyncio.wait_for(portal.close(), 5)
+    return observed
+
+def test_concurrent_requests_and_error_flow(tmp_path):
+    wellmap_path = os.path.join(str(tmp_path), 'wellmap.tsv')
+    with open(wellmap_path, 'w') as wellmap:
+        wellmap.write('chem_name\tloc\n')
+    dst_path = os.path.join(str(tmp_path), 'recieved')
+    os.makedirs(dst_path)
+    controller_sock, robot_sock = socket.socketpair()
+    robot = threading.Thread(target=serve, args=(robot_sock, wellmap_path))
+    robot.start()
+    try:
+        observed = asyncio.run(converse(controller_sock, dst_path))
+    finally:
+        robot.join(10)
+    assert observed[0] == [([LOCS['B1']],), ([LOCS['A1']],)]
+    state, errors = observed[1]
+    assert state == 1
+    assert [type(error) for error in errors] == [ValueError]
+    assert observed[2] == (['wellmap.tsv'], [])
+    with open(os.path.join(dst_path, 'wellmap.tsv')) as wellmap:
+        assert wellmap.read() == 'chem_name\tloc\n'
+    assert not robot.is_alive()
@@ -0,0 +1,94 @@
+'''
+round trip tests of the Armchair payload codec  
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+from Armchair.codec import PACK_SCHEMAS, PackCodec, Field, Any, SCHEMA_ENCODING, DILL_ENCODING
+
+LABWARE = pd.DataFrame({'name':['tube_holder_10', 'platereader4'], 'deck_pos':[1, 4],
+        'first_usable':['A1', 'B2']}).to_dict()
+
+#args for every packet type with a schema, including those with optional args left off
+PACKS = [
+    ('init', (True, False, 25.0, LABWARE, {'left':{'name':'300uL_pipette', 'tip_racks':[2]}},
+            {'index':{0:'WaterC1.0', 1:'WaterC1.0'}, 'conc':{0:1.0, 1:None}}, '10.0.0.2',
+            {})),
+    ('error', (ValueError('no tips'),)),
+    ('error', (IndexError('sub command out of range'), 3)),
+    ('ready', (7,)),
+    ('ready', (7, 3)),
+    ('transfer', ('WaterC1.0', [('P1', 10.0), ('P2', 2.5)])),
+    ('transfer', ('WaterC1.0', [('P1', 10.0), ('P2', 2.5)], True, 5.0)),
+    ('init_containers', ({'labware':{'P1':''}, 'max_vol':{'P1':2000.0}},)),
+    ('sending_files', ([('wellmap.tsv', 0, 120, 3735928559), ('eve.log', 64, 0, 0)],)),
+    ('save', ()),
+    ('save', (True,)),
+    ('batch', ([('transfer', ('AC1.0', [('P1', 1.0)])), ('pause', (2.0,)), ('home', ())],)),
+    ('pause', (2.5,)),
+    ('loc_req', (['A1', 'B1'],)),
+    ('loc_req', ('all',)),
+    ('loc_resp', ([('P1', 'A1', 4, 100.0, 80.0)],)),
+    ('make', ('AC1.0', 2.0)),
+    ('mix', ([('P1', 2), ('P2', 1)],)),
+]
+
+def same(a, b):
+    '''
+    equality that compares exceptions by type and message  
+    '''
+    if isinstance(a, BaseException):
+        return type(a) == type(b) and a.args == b.args
+    if isinstance(a, (list, tuple)):
+        return type(a) == type(b) and len(a) == len(b) and all(map(same, a, b))
+    return a == b
+
+def test_every_schema_is_covered():
+    assert set(PACK_SCHEMAS) == {pack_type for pack_type, _ in PACKS}
+
+@pytest.mark.parametrize('pack_type, args', PACKS)
+def test_round_trip(pack_type, args):
+    codec = PackCodec()
+    payload = codec.encode(pack_type, args)
+    assert payload[:1] == SCHEMA_ENCODING
+    assert same(codec.decode(pack_type, payload), args)
+
+def test_numpy_values():
+    codec = PackCodec()
+    args = ({'vol':{'P1':np.float64(1.5)}, 'n':{'P1':np.int64(3)}, 'full':{'P1':np.bool_(True)}},)
+    assert codec.decode('init_containers', codec.encode('init_containers', args)) == \
+            ({'vol':{'P1':1.5}, 'n':{'P1':3}, 'full':{'P1':True}},)
+
+def test_unknown_exception_decodes_as_runtime_error():
+    class RobotError(Exception):
+        pass
+    codec = PackCodec()
+    error, = codec.decode('error', codec.encode('error', (RobotError('jammed'),)))
+    assert type(error) == RuntimeError
+    assert 'RobotError' in str(error) and 'jammed' in str(error)
+
+@pytest.mark.parametrize('pack_type, args', [
+    ('transfer', ('WaterC1.0', 10.0)),
+    ('make', ('AC1.0',)),
+    ('init_containers', (object(),)),
+    ('home', ('unexpected',)),
+])
+def test_args_that_dont_fit_raise(pack_type, args):
+    with pytest.raises(TypeError):
+        PackCodec().encode(pack_type, args)
+
+def test_dill_fallback():
+    pytest.importorskip('dill')
+    codec = PackCodec(dill_fallback=True)
+    args = ('AC1.0', {1, 2})
+    payload = codec.encode('make', args)
+    assert payload[:1] == DILL_ENCODING
+    #decoding dill doesn't need the fallback to be turned on
+    assert PackCodec().decode('make', payload) == args
+    assert codec.encode('make', ('AC1.0', 2.0))[:1] == SCHEMA_ENCODING
+
+def test_field_is_abstract():
+    with pytest.raises(TypeError):
+        Field()
+    assert isinstance(Any(), Field)
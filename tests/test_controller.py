@@ -0,0 +1,48 @@
+'''
+tests of the controller's checks that don't need a robot or a platereader  
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+controller = pytest.importorskip('controller')
+
+def make_executor(rows, products):
+    '''
+    params:  
+        list<dict> rows: the rows of rxn_df. Missing columns are nan and missing products 0  
+        list<str> products: the product columns  
+    returns:  
+        ProtocolExecutor: an executor with only rxn_df and what the checks need set  
+    '''
+    rxn_df = pd.DataFrame(rows)
+    for col in ['op', 'reagent', 'conc', 'chemical_name', 'pause_time', 'dilution_conc',
+            'scan_filename', 'plot_filename', 'callbacks']:
+        if col not in rxn_df:
+            rxn_df[col] = np.nan
+    for product in products:
+        rxn_df[product] = rxn_df[product].fillna(0.0).astype(float) if product in rxn_df else 0.0
+    rxn_df['pause_time'] = rxn_df['pause_time'].astype(float)
+    executor = controller.ProtocolExecutor.__new__(controller.ProtocolExecutor)
+    executor.rxn_df = rxn_df
+    executor._products = pd.Index(products)
+    executor.precheck_violations = pd.DataFrame(columns=controller.Controller.VIOLATION_COLS)
+    return executor
+
+def test_plot_without_scans():
+    executor = make_executor([
+            {'op':'transfer', 'reagent':'Water', 'conc':1.0, 'chemical_name':'WaterC1.0',
+                    'P1':10.0},
+            {'op':'plot', 'scan_filename':'s2', 'plot_filename':'p', 'P1':1.0}], ['P1'])
+    assert executor.check_rxn_df() == 2
+    messages = executor.precheck_violations['message'].tolist()
+    assert messages == ['row 2 plots using nonexistent scan file']
+
+def test_plot_after_scan():
+    executor = make_executor([
+            {'op':'transfer', 'reagent':'Water', 'conc':1.0, 'chemical_name':'WaterC1.0',
+                    'P1':10.0},
+            {'op':'scan', 'scan_filename':'s2', 'P1':1.0},
+            {'op':'plot', 'scan_filename':'s2', 'plot_filename':'p', 'P1':1.0}], ['P1'])
+    assert executor.check_rxn_df() == 0
+    assert executor.precheck_violations.empty
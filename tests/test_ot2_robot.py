@@ -0,0 +1,76 @@
+'''
+tests of the robot's planning that don't need Opentrons hardware  
+'''
+import numpy as np
+import pytest
+
+ot2_robot = pytest.importorskip('ot2_robot')
+
+def make_robot(xys):
+    '''
+    params:  
+        dict<str:tuple<float,float>> xys: the x, y of each container by name  
+    returns:  
+        OT2Robot: a robot with only what route planning needs set  
+    '''
+    robot = ot2_robot.OT2Robot.__new__(ot2_robot.OT2Robot)
+    robot.motion_planner = ot2_robot.MotionPlanner()
+    robot._get_xy = xys.__getitem__
+    return robot
+
+def test_planned_route_never_longer():
+    rng = np.random.default_rng(0)
+    planner = ot2_robot.MotionPlanner()
+    for trial in range(500):
+        n_stops = rng.integers(3, 12)
+        points = rng.uniform(0, 400, size=(n_stops + 1, 2))
+        xys = {'src':tuple(points[0])}
+        xys.update({'P{}'.format(i):tuple(point) for i, point in enumerate(points[1:])})
+        #sheets are often already in a good order, e.g. left to right across the deck. The
+        #planner's local optimum can be worse than that
+        steps = [('P{}'.format(i), 10.0) for i in np.argsort(points[1:, 0])]
+        planned = make_robot(xys)._plan_route('src', steps)
+        assert sorted(planned) == sorted(steps)
+        def length(route):
+            return planner.route_length(xys['src'], [xys[name] for name, vol in route],
+                    list(range(len(route))))
+        assert length(planned) <= length(steps) + 1e-6
+
+class FakeLabware():
+    '''
+    a labware with a list of free locs that all hold 2000uL tubes  
+    '''
+    CONTAINERS_SERVICED = ['Tube2000uL']
+
+    def __init__(self, deck_pos, locs):
+        self.name = 'tube_holder_10'
+        self.deck_pos = deck_pos
+        self.locs = list(locs)
+        self.full = not self.locs
+
+    def pop_next_well(self, vol=None, container_type=None):
+        if not self.locs or (vol and vol > 2000):
+            return None
+        loc = self.locs.pop(0)
+        self.full = not self.locs
+        return loc
+
+    def get_container_type(self, loc):
+        return 'Tube2000uL'
+
+def test_init_containers_keeps_slots_allocated_before_a_failure():
+    robot = ot2_robot.OT2Robot.__new__(ot2_robot.OT2Robot)
+    labware = FakeLabware(1, ['A1', 'A2'])
+    robot.lab_deck = np.array([None, labware], dtype=object)
+    robot.deck_allocator = ot2_robot.DeckAllocator(robot.lab_deck,
+            ot2_robot.OT2Robot._LABWARE_TYPES, {'tube_holder_10':1})
+    robot.containers = {}
+    robot._construct_container = lambda container_type, chem_name, deck_pos, loc: (deck_pos, loc)
+    product_df = {'labware':{'P1':'', 'P2':'', 'P3':''},
+            'container':{'P1':'', 'P2':'', 'P3':''},
+            'max_vol':{'P1':1000.0, 'P2':5000.0, 'P3':1000.0}}
+    with pytest.raises(Exception):
+        robot._exec_init_containers(product_df)
+    #P1 took A1 and still has it. P2 didn't fit, so P3 was never placed and A2 is still free
+    assert robot.containers == {'P1':(1, 'A1')}
+    assert labware.locs == ['A2']
@@ -0,0 +1,100 @@
+'''
+tests of replaying recorded sessions with StubRobot  
+'''
+import os
+import threading
+
+import pytest
+
+from Armchair.armchair import Armchair
+from Armchair.replay import SessionReader, StubRobot
+from Armchair.transport import make_pipe
+
+LOCS = {'A1':('A1', 'Tube2000uL', 1, 100.0, 50.0), 'B1':('B1', 'Tube20000uL', 2, 500.0, 300.0)}
+
+def record_session(record_path, lookups):
+    '''
+    records a controller looking up wells from a robot that answers with LOCS, with the volume
+    of each answer counting the lookups made so far  
+    params:  
+        str record_path: the session file to write  
+        list<list<str>> lookups: the wellnames of each loc_req  
+    '''
+    controller_end, robot_end = make_pipe()
+    def robot():
+        portal = Armchair(robot_end, 'eve', log_enabled=False, metrics_enabled=False)
+        for n in range(len(lookups)):
+            pack_type, cid, (wellnames,) = portal.recv_pack()
+            portal.send_pack('loc_resp', [LOCS[wellname][:3] + (float(n), 0.0)
+                    for wellname in wellnames])
+        pack_type, cid, _ = portal.recv_pack()
+        portal.send_pack('ready', cid)
+        portal.close()
+    robot_thread = threading.Thread(target=robot, daemon=True)
+    robot_thread.start()
+    portal = Armchair(controller_end, 'controller', log_enabled=False, metrics_enabled=False,
+            record_path=record_path)
+    for wellnames in lookups:
+        portal.send_pack('loc_req', wellnames)
+        portal.recv_pack()
+    portal.send_pack('close')
+    portal.close()
+    robot_thread.join(10)
+
+def start_stub(record_path, tmp_path):
+    '''
+    returns:  
+        Armchair: the controller's end of a connection to a StubRobot for the session  
+        threading.Thread: the stub's thread  
+        list<Exception>: filled with what the stub raised, if anything
+    '''
+    controller_end, robot_end = make_pipe()
+    stub = StubRobot(SessionReader(record_path), robot_end, log_path=str(tmp_path))
+    raised = []
+    def run():
+        try:
+            stub.run()
+        except Exception as e:
+            raised.append(e)
+            #so the controller isn't left waiting on a dead stub
+            robot_end.close()
+    stub_thread = threading.Thread(target=run, daemon=True)
+    stub_thread.start()
+    portal = Armchair(controller_end, 'controller', log_enabled=False, metrics_enabled=False)
+    return portal, stub_thread, raised
+
+def test_loc_resps_are_matched_by_wellnames(tmp_path):
+    record_path = os.path.join(str(tmp_path), 'session.armchair')
+    record_session(record_path, [['A1'], ['B1'], ['A1']])
+    portal, stub_thread, raised = start_stub(record_path, tmp_path)
+    #fewer lookups, in a different order, and one more of A1 than was recorded
+    answers = []
+    for wellnames in [['B1'], ['A1'], ['A1'], ['A1']]:
+        portal.send_pack('loc_req', wellnames)
+        answers.append(portal.recv_pack()[2][0][0])
+    portal.send_pack('close')
+    portal.close()
+    stub_thread.join(10)
+    assert not raised
+    assert [(loc, vol) for loc, _, _, vol, _ in answers] == \
+            [('B1', 1.0), ('A1', 0.0), ('A1', 2.0), ('A1', 2.0)]
+
+def test_unrecorded_lookup_is_an_error(tmp_path):
+    record_path = os.path.join(str(tmp_path), 'session.armchair')
+    record_session(record_path, [['A1']])
+    portal, stub_thread, raised = start_stub(record_path, tmp_path)
+    portal.send_pack('loc_req', ['B1'])
+    with pytest.raises(ConnectionError):
+        portal.recv_pack()
+    assert isinstance(portal.error_payload[0], LookupError)
+    #the error flow of the controller
+    portal.reset_error()
+    portal.send_pack('save')
+    ftp_dst = os.path.join(str(tmp_path), 'recieved')
+    os.makedirs(ftp_dst)
+    portal.recv_ftp(ftp_dst)
+    portal.send_pack('close')
+    portal.close()
+    stub_thread.join(10)
+    assert not stub_thread.is_alive()
+    assert [type(e) for e in raised] == [LookupError]